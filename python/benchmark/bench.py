@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+
+# Benchmarks of the summarizer's hot paths, run against a mock ollama server (see
+# mock_ollama.py) so no model is needed.  Each case runs in a fresh process so its peak
+# memory can be measured.  Run it like this:
+#
+#   make bench
+#   python python/benchmark/bench.py --sizes=1K,1M,64M,1G --e2e-sizes=64K,1M --workers=4
+#
+# Compare the output of two commits (or use --json and diff the results) to catch
+# throughput or memory regressions.
+
+import os
+import sys
+import json
+import time
+import random
+import resource
+import tempfile
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+PYTHON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [PYTHON_DIR, os.path.join(PYTHON_DIR, 'osummarize'), os.path.dirname(os.path.abspath(__file__))]
+
+from mock_ollama import MockOllamaServer, make_bullets, make_response, MALFORMATIONS  # noqa: E402
+
+# Words of the synthetic documents; sentences are 8 to 20 words, paragraphs 3 to 7
+# sentences, and every 20th paragraph starts with a whisper timestamp.
+VOCABULARY = ("the model summary chunk token server latency memory throughput transcript "
+              "meeting project budget design review release customer feature question answer "
+              "because however therefore although quickly carefully important different").split()
+
+# Synthetic documents are generated this many bytes at a time.
+BLOCK_SIZE = 1024 * 1024
+
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+DEFAULTS = {
+    "sizes": "1K,1M,64M",           # document sizes for the cpu bound cases (up to 1G)
+    "e2e-sizes": "16K,128K",        # document sizes summarized through the mock server
+    "workers": "4",
+    "hosts": "1",                   # mock servers the requests are spread over
+    "parallel": "4",                # requests each mock server works on at a time
+    "chunk-size": "500",
+    "overlap": "50",
+    "latency": "0.05",              # seconds before the first token of each response
+    "token-rate": "1000",           # generated tokens/s per request
+    "prompt-rate": "5000",          # prompt tokens/s evaluated per request (100 or so on CPU-only hosts)
+    "malformed": "0.1",             # fraction of responses damaged by the mock server
+    "overloaded": "0",              # fraction of requests the mock server turns away with a 503
+    "responses": "10000",           # responses parsed by the parse_bullets case
+    "bullets": "100000",            # bullets formatted by the format_line case
+    "only": "",                     # comma separated case names to run
+}
+
+
+def parse_size(text):
+    """Return the number of bytes of a size like 64K, 1M or 1G."""
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in SIZE_UNITS:
+        return int(float(text[:-1]) * SIZE_UNITS[text[-1]])
+    return int(text)
+
+
+def format_size(size):
+    for unit in ('G', 'M', 'K'):
+        if size >= SIZE_UNITS[unit] and size % SIZE_UNITS[unit] == 0:
+            return f"{size // SIZE_UNITS[unit]}{unit}"
+    return str(size)
+
+
+def iter_synthetic_text(size, seed=0):
+    """Yield about BLOCK_SIZE characters at a time of a size byte synthetic transcript."""
+    rng = random.Random(seed)
+    produced = 0
+    paragraph = 0
+    while produced < size:
+        parts = []
+        block_length = 0
+        while block_length < BLOCK_SIZE and produced + block_length < size:
+            paragraph += 1
+            sentences = []
+            if paragraph % 20 == 1:
+                seconds = paragraph * 7
+                sentences.append(f"[{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}.000 --> "
+                                 f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}.500]")
+            for _ in range(rng.randint(3, 7)):
+                words = rng.choices(VOCABULARY, k=rng.randint(8, 20))
+                sentences.append(' '.join(words).capitalize() + '.')
+            text = ' '.join(sentences) + '\n\n'
+            parts.append(text)
+            block_length += len(text)
+        block = ''.join(parts)[:size - produced]
+        produced += len(block)
+        yield block
+
+
+def percentiles(values):
+    """Return the p50, p90 and p99 of values in milliseconds."""
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def at(fraction):
+        return values[min(len(values) - 1, int(fraction * len(values)))] * 1000
+
+    return {"p50_ms": at(0.50), "p90_ms": at(0.90), "p99_ms": at(0.99)}
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux and in bytes on macos.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+# Each case runs in a child process and returns a dict of results; the peak memory of
+# the child is added to them.
+def run_case(case, kwargs):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        result = CASES[case](**kwargs)
+    result["peak_mb"] = peak_rss_mb()
+    return result
+
+
+def case_split_into_chunks(size, chunk_size, overlap):
+    from utils.chat_utils import split_into_chunks
+    text = ''.join(iter_synthetic_text(size))
+    start = time.perf_counter()
+    chunks = split_into_chunks(text, chunk_size, overlap)
+    seconds = time.perf_counter() - start
+    return {"seconds": seconds, "bytes": size, "ops": len(chunks), "unit": "chunks"}
+
+
+def case_split_into_token_chunks(size, chunk_size, overlap):
+    from utils.chat_utils import split_into_token_chunks, get_tokenizer
+    get_tokenizer()
+    text = ''.join(iter_synthetic_text(size))
+    start = time.perf_counter()
+    chunks = split_into_token_chunks(text, chunk_size, overlap)
+    seconds = time.perf_counter() - start
+    return {"seconds": seconds, "bytes": size, "ops": len(chunks), "unit": "chunks"}
+
+
+def case_parse_bullets(responses, malformed):
+    # fixup_line was replaced by the single pass parse_bullets; this times the parser
+    # over responses shaped (and damaged) like the mock server's.
+    from utils.chat_utils import parse_bullets, ParseStats
+    rng = random.Random(1)
+    text = next(iter_synthetic_text(64 * 1024))
+    raw_responses = []
+    for _ in range(responses):
+        start = rng.randrange(len(text) - 2000)
+        damage = rng.choice(MALFORMATIONS) if rng.random() < malformed else None
+        raw_responses.append(make_response(make_bullets(text[start:start + 2000], 5), False, damage, rng.random()))
+    total_stats = ParseStats()
+    timings = []
+    started = time.perf_counter()
+    for raw_response in raw_responses:
+        start = time.perf_counter()
+        _, stats = parse_bullets(raw_response)
+        timings.append(time.perf_counter() - start)
+        total_stats.add(stats)
+    seconds = time.perf_counter() - started
+    return {"seconds": seconds, "bytes": sum(map(len, raw_responses)), "ops": responses, "unit": "responses",
+            "latencies": percentiles(timings), "note": str(total_stats)}
+
+
+def case_format_line(bullets):
+    from osummarize import format_line
+    rng = random.Random(2)
+    lines = ['* ' + ' '.join(rng.choices(VOCABULARY, k=rng.randint(5, 80))) for _ in range(bullets)]
+    timings = []
+    started = time.perf_counter()
+    for line in lines:
+        start = time.perf_counter()
+        format_line(line, 100)
+        timings.append(time.perf_counter() - start)
+    seconds = time.perf_counter() - started
+    return {"seconds": seconds, "bytes": sum(map(len, lines)), "ops": bullets, "unit": "bullets",
+            "latencies": percentiles(timings)}
+
+
+# Return the per call latencies recorded by the metrics while running func.
+# Run func and return the trace records (see llm_metrics.call_record) of its LLM calls.
+def traced_calls(func):
+    from utils.llm_metrics import get_metrics
+    with tempfile.NamedTemporaryFile('r', suffix='.jsonl') as trace:
+        get_metrics().trace_path = trace.name
+        func()
+        return [json.loads(line) for line in trace]
+
+
+def latencies(records):
+    return percentiles([record['wall_s'] for record in records])
+
+
+def case_osummarize(size, chunk_size, overlap, workers, stream):
+    from osummarize import process_chunks
+    with tempfile.TemporaryDirectory() as directory:
+        input_file = os.path.join(directory, 'doc.txt')
+        with open(input_file, 'w') as file:
+            for block in iter_synthetic_text(size):
+                file.write(block)
+        output_file = os.path.join(directory, 'doc.md')
+        result = {}
+
+        def run():
+            start = time.perf_counter()
+            chunks, _, stats, _ = process_chunks(input_file, output_file, chunk_size, overlap, 100, True, workers,
+                                              use_cache=False, stream=stream, quiet=True)
+            result.update(seconds=time.perf_counter() - start, ops=chunks, note=str(stats))
+
+        records = traced_calls(run)
+    result.update(bytes=size, unit="chunks", latencies=latencies(records))
+    return result
+
+
+def case_process_chunks(size, chunk_size, overlap, workers):
+    # The streamlit variant: the whole text in, the whole summary out.
+    from utils.chat_utils import process_chunks
+    text = ''.join(iter_synthetic_text(size))
+    result = {}
+
+    def run():
+        start = time.perf_counter()
+        summary = process_chunks(text, chunk_size, overlap, workers, use_cache=False)
+        result.update(seconds=time.perf_counter() - start, ops=summary.count("\n***"))
+
+    records = traced_calls(run)
+    result.update(bytes=size, unit="chunks", latencies=latencies(records))
+    return result
+
+
+def case_prompt_reuse(size, chunk_size, overlap, workers, server, prefix_cache):
+    # The summarizers' requests (SUMMARY_PROMPT as the system message ahead of each
+    # chunk) against a server of their own that either reuses the evaluation of the
+    # prompt prefix they share, as ollama's runner does, or evaluates every prompt in
+    # full, the way it would without the shared prefix.
+    from utils.chat_utils import split_into_chunks, summarize_chunks, SUMMARY_PROMPT
+    mock = MockOllamaServer(prefix_cache=prefix_cache, **server).start()
+    os.environ["OLLAMA_HOSTS"] = mock.url
+    chunks = split_into_chunks(''.join(iter_synthetic_text(size)), chunk_size, overlap)
+    result = {}
+
+    def run():
+        start = time.perf_counter()
+        for _ in summarize_chunks(chunks, SUMMARY_PROMPT, workers, use_cache=False):
+            pass
+        result.update(seconds=time.perf_counter() - start, ops=len(chunks))
+
+    records = traced_calls(run)
+    mock.stop()
+    prompt_tokens = sum(record['prompt_tokens'] for record in records)
+    prompt_seconds = sum(record['prompt_eval_s'] for record in records)
+    result.update(bytes=size, unit="chunks", latencies=latencies(records),
+                  note=f"{prompt_tokens} prompt tokens evaluated in {prompt_seconds:.1f}s")
+    return result
+
+
+CASES = {
+    "split_into_chunks": case_split_into_chunks,
+    "split_into_token_chunks": case_split_into_token_chunks,
+    "parse_bullets": case_parse_bullets,
+    "format_line": case_format_line,
+    "osummarize": case_osummarize,
+    "osummarize_stream": case_osummarize,
+    "process_chunks": case_process_chunks,
+    "prompt_reused": case_prompt_reuse,
+    "prompt_full": case_prompt_reuse,
+}
+
+
+def plan_cases(settings):
+    """Return the (name, label, case, kwargs) of every run, in order."""
+    chunk_size = int(settings["chunk-size"])
+    overlap = int(settings["overlap"])
+    workers = int(settings["workers"])
+    sizes = [parse_size(size) for size in settings["sizes"].split(',') if size]
+    e2e_sizes = [parse_size(size) for size in settings["e2e-sizes"].split(',') if size]
+    server = {"latency": float(settings["latency"]), "token_rate": float(settings["token-rate"]),
+              "prompt_rate": float(settings["prompt-rate"]), "parallel": int(settings["parallel"])}
+    runs = []
+    for size in sizes:
+        runs.append(("split_into_chunks", format_size(size), "split_into_chunks",
+                     {"size": size, "chunk_size": chunk_size, "overlap": overlap}))
+    for size in sizes:
+        runs.append(("split_into_token_chunks", format_size(size), "split_into_token_chunks",
+                     {"size": size, "chunk_size": chunk_size, "overlap": overlap}))
+    runs.append(("parse_bullets", settings["responses"], "parse_bullets",
+                  {"responses": int(settings["responses"]), "malformed": float(settings["malformed"])}))
+    runs.append(("format_line", settings["bullets"], "format_line", {"bullets": int(settings["bullets"])}))
+    for size in e2e_sizes:
+        runs.append(("osummarize", format_size(size), "osummarize",
+                     {"size": size, "chunk_size": chunk_size, "overlap": overlap, "workers": workers,
+                      "stream": False}))
+        runs.append(("osummarize_stream", format_size(size), "osummarize_stream",
+                     {"size": size, "chunk_size": chunk_size, "overlap": overlap, "workers": 1, "stream": True}))
+        runs.append(("process_chunks", format_size(size), "process_chunks",
+                     {"size": size, "chunk_size": chunk_size, "overlap": overlap, "workers": workers}))
+        for name, prefix_cache in (("prompt_reused", 1), ("prompt_full", 0)):
+            runs.append((name, format_size(size), name,
+                         {"size": size, "chunk_size": chunk_size, "overlap": overlap, "workers": workers,
+                          "server": server, "prefix_cache": prefix_cache}))
+    only = [name for name in settings["only"].split(',') if name]
+    return [run for run in runs if not only or run[0] in only]
+
+
+def format_result(name, label, result):
+    seconds = result["seconds"]
+    rate = result["bytes"] / seconds / (1024 * 1024) if seconds else 0.0
+    ops_rate = result["ops"] / seconds if seconds else 0.0
+    latencies = result.get("latencies", {})
+    latency_text = ' '.join(f"{latencies[key]:>8.3f}" if key in latencies else f"{'-':>8}"
+                            for key in ("p50_ms", "p90_ms", "p99_ms"))
+    return (f"{name:<24} {label:>7} {seconds:>9.3f} {rate:>9.2f} {ops_rate:>11.1f} {result['unit']:<9} "
+            f"{latency_text} {result['peak_mb']:>8.1f}  {result.get('note', '')}")
+
+
+HEADER = (f"{'case':<24} {'size':>7} {'seconds':>9} {'MB/s':>9} {'ops/s':>11} {'ops':<9} "
+          f"{'p50_ms':>8} {'p90_ms':>8} {'p99_ms':>8} {'peak_MB':>8}")
+
+
+if __name__ == "__main__":
+    from osummarize import parse_options
+    args, options = parse_options(sys.argv[1:], list(DEFAULTS) + ["json"])
+    if args:
+        print(f"Usage: {sys.argv[0]} " + ' '.join(f"[--{name}=<{name}>]" for name in DEFAULTS) + " [--json]")
+        print("\nDefaults:")
+        for name, value in DEFAULTS.items():
+            print(f"  --{name}={value}")
+        sys.exit(1)
+    settings = dict(DEFAULTS, **options)
+
+    servers = [MockOllamaServer(latency=float(settings["latency"]), token_rate=float(settings["token-rate"]),
+                                prompt_rate=float(settings["prompt-rate"]),
+                                malformed=float(settings["malformed"]), parallel=int(settings["parallel"]),
+                                overloaded=float(settings["overloaded"]), seed=number).start()
+               for number in range(int(settings["hosts"]))]
+    # The children inherit these; the cache would otherwise hide the server's latency.
+    os.environ["OLLAMA_HOSTS"] = ','.join(server.url for server in servers)
+    os.environ["LLM_CACHE_DISABLE"] = "1"
+    os.environ.pop("LLM_TRACE_FILE", None)
+
+    if "json" not in options:
+        print(f"Mock ollama servers at {os.environ['OLLAMA_HOSTS']}: latency {settings['latency']}s, "
+              f"{settings['token-rate']} tokens/s, {settings['parallel']} parallel, {settings['malformed']} malformed, "
+              f"{settings['overloaded']} overloaded")
+        print(HEADER)
+    # A fresh process per case (spawned, not forked, so it doesn't start out with the
+    # parent's memory) keeps each case's peak memory separate.
+    context = multiprocessing.get_context('spawn')
+    for name, label, case, kwargs in plan_cases(settings):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(run_case, case, kwargs).result()
+        if "json" in options:
+            print(json.dumps(dict(result, case=name, size=label)))
+        else:
+            print(format_result(name, label, result))
+        sys.stdout.flush()
+    for server in servers:
+        server.stop()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+# A stand-in for an ollama server that answers /api/chat and /api/generate requests
+# with summary-shaped responses, so the summarizers can be exercised and timed without
+# a model.  Used by bench.py; it can also be run on its own, e.g.:
+#
+#   python python/benchmark/mock_ollama.py --port=11434 --latency=0.2 --malformed=0.1
+
+import sys
+import json
+import time
+import random
+import threading
+from os.path import commonprefix
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Characters per token used to make up the token counts.
+CHARS_PER_TOKEN = 4
+
+# Tokens sent per streamed message.
+STREAM_PIECE_TOKENS = 4
+
+# Seconds a model stays loaded after a request that doesn't set keep_alive (ollama's
+# OLLAMA_KEEP_ALIVE default) and the units of keep_alive durations like "30m".
+DEFAULT_KEEP_ALIVE = 300.0
+DURATION_UNITS = {'s': 1.0, 'm': 60.0, 'h': 3600.0}
+
+# Ways of damaging a response, modelled on what llama3 actually gets wrong.
+MALFORMATIONS = ('unescaped_quote', 'missing_brace', 'truncated', 'prose', 'single_quotes')
+
+
+class MockOllamaServer(ThreadingHTTPServer):
+    """
+    HTTP server speaking enough of the ollama API for chat_utils (chat and generate,
+    streamed or not, format="json", tags and version).
+
+    Each response takes latency seconds plus the prompt tokens at prompt_rate and the
+    generated tokens at token_rate tokens/s; the first request also takes load_time
+    seconds (loading the model), and requests that arrive while it loads wait for it.
+    The model is unloaded again after the request's keep_alive (ollama's default if it
+    has none) without requests.  Like ollama's OLLAMA_NUM_PARALLEL, at most `parallel`
+    requests are worked on at a time; the others wait their turn.  Like ollama's runner,
+    each of these slots keeps the prompt it last evaluated (unless prefix_cache is 0): a
+    request goes to the free slot whose prompt shares the longest prefix with its own,
+    and only the rest of its prompt is evaluated.  A fraction `malformed` of the responses are damaged in one of the MALFORMATIONS ways, and a
+    fraction `overloaded` of the requests are turned away with a 503 the way ollama
+    does when its queue is full.  Port 0 picks a free port (see url).
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.05, token_rate=500.0, prompt_rate=5000.0, load_time=0.0,
+                 malformed=0.0, bullets=5, seed=0, parallel=4, overloaded=0.0, prefix_cache=1):
+        super().__init__(('127.0.0.1', port), MockOllamaHandler)
+        self.latency = latency
+        self.token_rate = token_rate
+        self.prompt_rate = prompt_rate
+        self.load_time = load_time
+        self.malformed = malformed
+        self.overloaded = overloaded
+        self.bullets = bullets
+        self.random = random.Random(seed)
+        self.prefix_cache = prefix_cache
+        # The prompt each slot last evaluated, or None while the slot is busy.
+        self.slots = [''] * parallel
+        self.slots_free = threading.Condition()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.loaded_at = None
+        self.unload_at = 0.0
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    # Return the load time to charge to this request (the time until the model is loaded,
+    # which the first request starts) and the malformation to apply, if any.
+    def next_request(self, keep_alive=None):
+        with self.lock:
+            self.requests += 1
+            now = time.monotonic()
+            if self.loaded_at is None or now > self.unload_at:
+                self.loaded_at = now + self.load_time
+            load_time = max(0.0, self.loaded_at - now)
+            self.unload_at = max(self.loaded_at, now) + parse_keep_alive(keep_alive)
+            damage = None
+            if self.random.random() < self.malformed:
+                damage = self.random.choice(MALFORMATIONS)
+            return load_time, damage, self.random.random()
+
+    def take_slot(self, prompt):
+        """Wait for a free slot; return it and the number of characters of prompt it has cached."""
+        with self.slots_free:
+            while all(cached is None for cached in self.slots):
+                self.slots_free.wait()
+            free = [slot for slot, cached in enumerate(self.slots) if cached is not None]
+            shared = {slot: len(commonprefix([self.slots[slot], prompt])) for slot in free}
+            slot = max(free, key=shared.__getitem__)
+            self.slots[slot] = None
+            return slot, shared[slot] if self.prefix_cache else 0
+
+    def free_slot(self, slot, prompt):
+        with self.slots_free:
+            self.slots[slot] = prompt
+            self.slots_free.notify()
+
+    def turn_away(self):
+        """Return True if this request should get a 503 (see overloaded)."""
+        with self.lock:
+            return self.random.random() < self.overloaded
+
+
+def parse_keep_alive(value):
+    """Return a keep_alive (seconds or a duration like "30m") in seconds; negative is forever."""
+    if value is None:
+        return DEFAULT_KEEP_ALIVE
+    if isinstance(value, str):
+        value = value.strip()
+        unit = DURATION_UNITS.get(value[-1:])
+        seconds = float(value[:-1]) * unit if unit else float(value)
+    else:
+        seconds = float(value)
+    return float('inf') if seconds < 0 else seconds
+
+
+def make_bullets(text, count):
+    """Return count made up bullets that quote words of text."""
+    words = text.split() or ['nothing']
+    step = max(1, len(words) // count)
+    return [f"Point {i + 1} is about " + ' '.join(words[i * step:i * step + 12])
+            for i in range(count)]
+
+
+def make_response(bullets, structured, damage, position):
+    """
+    Return the text of a response with the given bullets: the json array of {"key": ...}
+    maps that SUMMARY_PROMPT asks for, or the {"bullets": [...]} object of json mode,
+    damaged as named by damage.  position (0 <= position < 1) picks where to damage it.
+    """
+    if structured:
+        content = json.dumps({"bullets": [{"key": bullet} for bullet in bullets]})
+        # json mode only ever goes wrong by running out of tokens.
+        if damage:
+            content = content[:int(len(content) * position)]
+        return content
+
+    lines = [json.dumps({"key": bullet}) for bullet in bullets]
+    where = int(len(lines) * position)
+    if damage == 'unescaped_quote':
+        lines[where] = lines[where].replace(' is ', ' is "quoted" ', 1)
+    elif damage == 'missing_brace':
+        lines[where] = lines[where].rstrip('}')
+    elif damage == 'single_quotes':
+        lines[where] = lines[where].replace('"', "'")
+    content = '[\n' + '\n'.join(lines) + '\n]'
+    if damage == 'truncated':
+        content = content[:int(len(content) * position)]
+    elif damage == 'prose':
+        content = "Here is the summary of the text:\n\n" + content + "\n\nLet me know if you need more."
+    return content
+
+
+class MockOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: MockOllamaServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/api/tags':
+            self.send_json({"models": [{"name": "llama3:8b", "model": "llama3:8b"}]})
+        elif self.path == '/api/version':
+            self.send_json({"version": "0.0.0-mock"})
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        if self.path == '/api/chat':
+            prompt = ''.join(message.get('content', '') for message in request.get('messages', []))
+            text = request['messages'][-1]['content'] if request.get('messages') else ''
+        elif self.path == '/api/generate':
+            prompt = request.get('system', '') + request.get('prompt', '')
+            text = request.get('prompt', '')
+        else:
+            self.send_json({"error": "not found"}, 404)
+            return
+        # A preloading request (no messages or prompt) only loads the model.
+        if not prompt:
+            load_time, _, _ = self.server.next_request(request.get('keep_alive'))
+            time.sleep(load_time)
+            self.send_json(self.final_message(request, '', 0, 0, load_time, 0.0, 0.0))
+            return
+
+        server = self.server
+        if server.turn_away():
+            self.send_json({"error": "server busy, please try again.  maximum pending requests exceeded"}, 503)
+            return
+        slot, cached_chars = server.take_slot(prompt)
+        try:
+            self.answer(request, prompt, text, cached_chars)
+        finally:
+            server.free_slot(slot, prompt)
+
+    def answer(self, request, prompt, text, cached_chars):
+        server = self.server
+        load_time, damage, position = server.next_request(request.get('keep_alive'))
+        structured = request.get('format') == 'json'
+        content = make_response(make_bullets(text, server.bullets), structured, damage, position)
+
+        # Only the part of the prompt that isn't in the slot's cache is evaluated.
+        prompt_tokens = max(1, (len(prompt) - cached_chars) // CHARS_PER_TOKEN + 1)
+        completion_tokens = len(content) // CHARS_PER_TOKEN + 1
+        prompt_seconds = prompt_tokens / server.prompt_rate
+        eval_seconds = completion_tokens / server.token_rate
+        time.sleep(load_time + server.latency + prompt_seconds)
+
+        if not request.get('stream', True):
+            time.sleep(eval_seconds)
+            self.send_json(self.final_message(request, content, prompt_tokens, completion_tokens,
+                                              load_time, prompt_seconds, eval_seconds))
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        step = STREAM_PIECE_TOKENS * CHARS_PER_TOKEN
+        for start in range(0, len(content), step):
+            time.sleep(STREAM_PIECE_TOKENS / server.token_rate)
+            self.send_chunk(self.message(request, content[start:start + step], False))
+        self.send_chunk(self.final_message(request, '', prompt_tokens, completion_tokens,
+                                           load_time, prompt_seconds, eval_seconds))
+        self.wfile.write(b'0\r\n\r\n')
+
+    def send_chunk(self, data):
+        line = (json.dumps(data) + '\n').encode('utf-8')
+        self.wfile.write(b'%x\r\n' % len(line) + line + b'\r\n')
+
+    def message(self, request, content, done):
+        data = {"model": request.get('model', ''), "created_at": time.strftime('%Y-%m-%dT%H:%M:%SZ'), "done": done}
+        if self.path == '/api/chat':
+            data["message"] = {"role": "assistant", "content": content}
+        else:
+            data["response"] = content
+        return data
+
+    def final_message(self, request, content, prompt_tokens, completion_tokens, load_time, prompt_seconds,
+                      eval_seconds):
+        data = self.message(request, content, True)
+        data.update({
+            "done_reason": "stop",
+            "prompt_eval_count": prompt_tokens,
+            "eval_count": completion_tokens,
+            "load_duration": int(load_time * 1e9),
+            "prompt_eval_duration": int(prompt_seconds * 1e9),
+            "eval_duration": int(eval_seconds * 1e9),
+            "total_duration": int((load_time + self.server.latency + prompt_seconds + eval_seconds) * 1e9),
+        })
+        return data
+
+
+if __name__ == "__main__":
+    settings = {"port": 11434, "latency": 0.2, "token_rate": 500.0, "prompt_rate": 5000.0, "load_time": 0.0,
+                "malformed": 0.0, "bullets": 5, "seed": 0, "parallel": 4, "overloaded": 0.0, "prefix_cache": 1}
+    for arg in sys.argv[1:]:
+        name, _, value = arg.lstrip('-').replace('-', '_').partition('=')
+        if name not in settings or not value:
+            print(f"Usage: {sys.argv[0]} " + ' '.join(f"[--{key.replace('_', '-')}=<{key}>]" for key in settings))
+            sys.exit(1)
+        settings[name] = type(settings[name])(value)
+    server = MockOllamaServer(**settings)
+    print(f"Mock ollama server listening on {server.url}")
+    server.serve_forever()
@@ -4,23 +4,81 @@ import sys
 import json
 import re
 import os
-from utils.chat_utils import call_ollama_api
-
-# Return a string of the text from the file.
-# Handle pdf files by first extracting the text from the pdf.
-def load_text(file_path):
+import glob
+import time
+import hashlib
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from utils.llm_metrics import get_metrics, set_default_site
+from utils.llm_policy import LLMCallError
+from utils.chat_utils import estimate_tokens, ordered_map, call_ollama_api, call_ollama_api_stream, failed_chunk_note, get_backend, reduce_summaries, parse_summary, ParseStats, JSON_SUMMARY_PROMPT, iter_chunks, iter_pdf_pages, WordChunker, TokenChunker, ContentChunker, DEFAULT_WORKERS
+
+# Text files are read this many characters at a time.
+READ_BLOCK_SIZE = 1024 * 1024
+
+# Yield the text of the file a piece at a time so that chunking and summarization can
+# start before the whole file has been read and memory use doesn't grow with the file.
+# Handle pdf files by extracting the text a batch of pages at a time.
+def iter_text(file_path):
     if file_path.endswith('.pdf'):
-        import PyPDF2
+        # Pages are extracted in parallel and cached (see iter_pdf_pages).
         with open(file_path, 'rb') as pdf_file:
-            pdf_reader = PyPDF2.PdfReader(pdf_file)
-            text = ""
-            for page_num in range(len(pdf_reader.pages)):
-                page = pdf_reader.pages[page_num]
-                text += page.extract_text()
-        return text
+            data = pdf_file.read()
+        for page_text in iter_pdf_pages(data):
+            # Keep the last word of a page from running into the first word of the next.
+            yield page_text + '\n'
+        return
 
     with open(file_path, 'r') as file:
-        return file.read()
+        while True:
+            block = file.read(READ_BLOCK_SIZE)
+            if not block:
+                break
+            yield block
+
+# Byte values that separate words in UTF-8 text.  Bytes below 0x80 are never part of a
+# multi-byte UTF-8 sequence, so cutting next to one of these always gives valid UTF-8.
+WHITESPACE_BYTES = (b'\n', b' ', b'\t', b'\r')
+
+# Yield the text of a (possibly larger than RAM) text file a block at a time by mapping
+# the file into memory instead of reading it into the heap.  Only the block being
+# decoded is copied.  Each block ends, in order of preference, at a line break or
+# sentence end near the end of the block, at any whitespace, or, for text without any
+# whitespace, at the start of a UTF-8 character so no character is ever split.
+def iter_mmap_text(file_path, block_size=READ_BLOCK_SIZE):
+    import mmap
+    with open(file_path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            size = len(mapped)
+            pos = 0
+            while pos < size:
+                end = min(pos + block_size, size)
+                if end < size:
+                    end = find_block_end(mapped, pos, end)
+                yield mapped[pos:end].decode('utf-8', errors='replace')
+                pos = end
+
+# Return where to end a block of mapped bytes that would ideally end at `end`.
+def find_block_end(mapped, start, end):
+    # Prefer a line break or sentence end in the last eighth of the block.
+    near = max(start + 1, end - (end - start) // 8)
+    for boundary in (b'\n', b'. '):
+        cut = mapped.rfind(boundary, near, end)
+        if cut >= 0:
+            return cut + len(boundary)
+    for whitespace in WHITESPACE_BYTES:
+        cut = mapped.rfind(whitespace, start + 1, end)
+        if cut >= 0:
+            return cut + 1
+    # No whitespace at all: back up to the first byte of a UTF-8 character
+    # (continuation bytes look like 0b10xxxxxx).
+    cut = end
+    while cut > start + 1 and mapped[cut] & 0xC0 == 0x80:
+        cut -= 1
+    return cut
 
 def save_to_file(responses, output_file):
     print(f"Saving responses to {output_file}")
@@ -37,6 +95,9 @@ timestamp_pattern = r'\[(\d{2}:)?\d{2}:\d{2}\.\d{3} --> (\d{2}:)?\d{2}:\d{2}\.\d
 # The youtube transcript timestamps look like (27:16) or (1:27:16)
 youtube_timestamp_pattern = r'\((\d{1,2}:)?\d{2}:\d{2}\)'
 
+timestamp_re = re.compile(timestamp_pattern)
+youtube_timestamp_re = re.compile(youtube_timestamp_pattern)
+
 # This prompt works well but you'll need to fixup the output as the LLM is not so
 # consistent with producing well formed json.
 SUMMARY_PROMPT = """
@@ -54,83 +115,11 @@ The key and bullet point should always be on a single line.
 """
 
 
-def split_into_chunks(text, chunk_size, overlap):
-
-    print(f"Splitting text into chunks of {chunk_size} tokens with an overlap of {overlap} tokens")
-    count = 1
-    words = text.split()
-    chunks = []
-    start = 0
-    while start < len(words):
-        print(f"Extracting text chunk {count}")
-
-        # Ensure that we do not go out of index
-        end = start + chunk_size
-        chunk = words[start:end]
-        chunks.append(' '.join(chunk))
-        # Move start forward by chunk size minus the overlap
-        start = end - overlap
-        count = count + 1
-
-    # If the last chunk is less than overlap tokens, merge it with the previous chunk
-    # to avoid a dangling last chunk with little context for summarization.
-    if len(chunks) > 1 and len(chunks[-1].split()) < overlap:
-        chunks[-2] += ' ' + chunks[-1]
-        chunks.pop()
-    return chunks
-
 DEBUG = False
 def debug_print(text):
     if DEBUG:
         print(text)
 
-# This function is used to fix up the line so that it can be parsed by json.loads.
-# Unfortunately, LLMs don't always produce proper json even when specifically asked.
-def fixup_line(line):
-
-    # Replace multiple opening braces and optional spaces with a single opening brace
-    line = re.sub(r'\{\s*\{+', '{', line)
-
-    # Replace multiple closing braces and optional spaces with a single closing brace
-    line = re.sub(r'\}\s*\}+', '}', line)
-
-    # If line ends with '""}]' make it end with '"}'.
-    if line.endswith('""}]'):
-        line = line.replace('""}]', '"}')
-
-    # If line ends with '}]', make it end with '}'.
-    if line.endswith('}]'):
-        line = line.replace('}]', '}')
-
-    # If the line ends with a '},', remove the comma.
-    if line.endswith('},'):
-        line = line[:-1]
-
-    # Sometimes the line is not delimted by braces, if so, add them.
-    if not line.startswith('{'):
-        line = '{' + line
-    if not line.endswith('}'):
-        line = line + '}'
-
-    # Sometimes a line has two quotes followed by and ending brace, if so,
-    # just have one quote followed by the ending brace.
-    if '""}' in line:
-        line = line.replace('""}', '"}')
-
-    # Sometimes a line ends with '}, }' and we only need one ending brace.
-    if '}, }' in line:
-        line = line.replace('}, }', '}')
-
-    # Strip off any closing bracket.
-    if line.endswith(']'):
-        line = line[:-1]
-
-    # Trans for a trailing '"} }' to '"}'
-    if '"} }' in line:
-        line = line.replace('"} }', '"}')
-
-    return line
-
 # Take a line of the form "* ...", and format it so that it fits within the max_width.
 # Any lines exceeding max_width are split into multiple lines. The indentation of the
 # line is preserved. The function returns an array of strings where each string is a
@@ -177,87 +166,429 @@ def write_formatted_bullet(file, bullet_point, max_width, doFormat):
         file.write(line + '\n')
     file.flush()
 
+# The journal of an output file is kept next to it as <output_file>.journal; an
+# incremental run writes its new journal to <output_file>.journal.new until it is over.
+JOURNAL_SUFFIX = ".journal"
+PENDING_JOURNAL_SUFFIX = ".new"
+
+class ChunkJournal:
+    """
+    Append-only checkpoint of a summarization run: one json line per finished chunk
+    with its index, the sha256 of its text and its parsed bullets, after a header line
+    that identifies the prompt and the model.  Each line is flushed as soon as its chunk
+    is done, so when a run is interrupted (a crash, an ollama restart) a resumed run
+    replays the finished chunks and only sends the rest to the model.  A last line of
+    {"done": <chunks>} marks a run that completed.
+
+    Chunks are looked up by the hash of their text, so with content defined chunks (see
+    ContentChunker) the journal of the previous run of an edited input also has the
+    bullets of every chunk the edit didn't touch.  In incremental mode the journal is
+    read that way and a new one is written from scratch for the new run, so it never
+    holds more than the chunks of the latest version of the input.  The new journal
+    only replaces the old one when the run is over (see close); until then it is kept
+    at `pending`, so an interrupted run loses neither and the next run reads both.
+    """
+
+    def __init__(self, path, prompt, model='', resume=False, incremental=False):
+        self.path = path
+        self.pending = path + PENDING_JOURNAL_SUFFIX
+        self.incremental = incremental
+        self.header = {"journal": 1, "prompt": hashlib.sha256(prompt.encode('utf-8')).hexdigest(), "model": model}
+        self.entries = {}
+        self.used = set()
+        # The hashes of the chunks in the journal being written.
+        self.written = set()
+        existing = None
+        if resume or incremental:
+            existing = self._load(path)
+            # The journal being written by an interrupted incremental run has the
+            # latest chunks.
+            for loaded in (existing, self._load(self.pending)):
+                if loaded is not None:
+                    self.entries.update(loaded[0])
+        if incremental:
+            self.file = open(self.pending, 'w')
+            self._write(self.header)
+        elif existing is not None and existing[0]:
+            self.file = open(path, 'a')
+            self.written = set(existing[0])
+            # Finish off a line that was cut short by a crash so it stays unreadable
+            # on its own instead of corrupting the next entry.
+            if not existing[1]:
+                self.file.write('\n')
+        else:
+            self.file = open(path, 'w')
+            self._write(self.header)
+
+    # Return the bullets of each chunk in the journal at path if it is for the same
+    # prompt and model, by the hash of the chunk's text, and whether its last line is
+    # complete, or None.
+    def _load(self, path):
+        entries = {}
+        line = ''
+        try:
+            with open(path, 'r') as file:
+                for number, line in enumerate(file):
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if number == 0:
+                        if record != self.header:
+                            return None
+                    elif isinstance(record, dict) and 'hash' in record:
+                        entries[record['hash']] = record.get('bullets')
+        except OSError:
+            return None
+        return entries, line.endswith('\n')
+
+    def _write(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.file.flush()
+
+    @staticmethod
+    def digest(chunk):
+        return hashlib.sha256(str(chunk).encode('utf-8')).hexdigest()
+
+    def lookup(self, chunk):
+        """Return the journaled bullets of a chunk with the same text, or None."""
+        digest = self.digest(chunk)
+        bullets = self.entries.get(digest)
+        if bullets is not None:
+            self.used.add(digest)
+        return bullets
+
+    def unused(self):
+        """Return the number of journaled chunks that no chunk of this run matched."""
+        return len(self.entries.keys() - self.used)
+
+    def record(self, index, chunk, bullets):
+        """Write the bullets of a finished chunk unless the journal already has them."""
+        digest = self.digest(chunk)
+        if digest not in self.written:
+            self.written.add(digest)
+            self._write({"index": index, "hash": digest, "bullets": bullets})
+
+    def finish(self, chunks):
+        self._write({"done": chunks})
+
+    def close(self):
+        """
+        Close the journal of a run that went through all its chunks.  The new journal of
+        an incremental run then takes the place of the old one; otherwise a new journal
+        left by an interrupted incremental run is no longer needed.
+        """
+        self.file.close()
+        if self.incremental:
+            os.replace(self.pending, self.path)
+        else:
+            try:
+                os.remove(self.pending)
+            except FileNotFoundError:
+                pass
+
+# Return True if the journal at path ends with the "done" line of a completed run, or
+# if there is no journal (the output predates journals).  While an incremental run's new
+# journal is pending (see ChunkJournal), its output isn't complete either.
+def journal_complete(path):
+    if os.path.exists(path + PENDING_JOURNAL_SUFFIX):
+        return False
+    try:
+        with open(path, 'rb') as file:
+            file.seek(0, os.SEEK_END)
+            file.seek(max(0, file.tell() - 64))
+            tail = file.read()
+    except OSError:
+        return True
+    return tail.rstrip(b'\n').rsplit(b'\n', 1)[-1].startswith(b'{"done":')
+
 # Process chunks of text and summarize each chunk using some LLM model.
 # The output is written to the output file.
 # The chunk_size is the number of words in each chunk and overlap is the number of words
 # that each chunk overlaps with the previous chunk.
-def process_chunks(input_file, output_file, chunk_size, overlap, max_width, doFormat):
-    text = load_text(input_file)
-    chunks = split_into_chunks(text, chunk_size, overlap)
+# If use_mmap is True, a text input file is memory mapped instead of read (see iter_mmap_text).
+# Up to `workers` chunks are summarized at the same time; the output is still written
+# in chunk order.  Chunk summaries are cached on disk unless use_cache is False.
+# In stream mode, chunks are summarized one at a time and each bullet is written as
+# soon as the model has produced its line instead of when the whole chunk is done.
+# If reduce is True, the bullets of all chunks are then summarized again (recursively,
+# see reduce_summaries) into an overall summary written at the end.
+# If by_tokens is True, chunk_size and overlap are numbers of tokens instead of words and
+# chunks are cut on sentence and paragraph boundaries.
+# If structured is True, the model is asked for json output (ollama's format="json"),
+# which is used as is when it has the expected shape; not supported in stream mode.
+# Finished chunks are written to a journal next to the output file (see ChunkJournal);
+# if resume is True, chunks found in the journal are replayed instead of summarized.
+# If incremental is True, chunks end at content defined boundaries (see ContentChunker)
+# so that an edit to the input only changes the chunks around it, and every chunk whose
+# text is in the journal of the previous run is replayed from it; only the changed
+# chunks go to the model.
+def process_chunks(input_file, output_file, chunk_size, overlap, max_width, doFormat, workers=DEFAULT_WORKERS,
+                   use_cache=True, stream=False, reduce=False, by_tokens=False, use_mmap=False,
+                   structured=False, executor=None, quiet=False, resume=False, incremental=False):
+    # In quiet mode (batch mode) the progress messages are left out.
+    log = (lambda *args, **kwargs: None) if quiet else print
+    if by_tokens:
+        log(f"Splitting text into chunks of {chunk_size} tokens with an overlap of {overlap} tokens")
+        chunker = TokenChunker(chunk_size, overlap)
+    elif incremental:
+        log(f"Splitting text into chunks of up to {chunk_size} words at content defined boundaries "
+            f"with an overlap of {overlap} words")
+        chunker = ContentChunker(chunk_size, overlap)
+    else:
+        log(f"Splitting text into chunks of {chunk_size} words with an overlap of {overlap} words")
+        chunker = WordChunker(chunk_size, overlap)
+    # The whole pipeline is lazy: the input is read, chunked and summarized as the
+    # output is written, so only a few chunks are in memory at any time.
+    if use_mmap and not input_file.endswith('.pdf'):
+        pieces = iter_mmap_text(input_file)
+    else:
+        pieces = iter_text(input_file)
+    chunks = iter_chunks(pieces, chunker)
 
+    prompt = JSON_SUMMARY_PROMPT if structured else SUMMARY_PROMPT
+    journal = None
     if output_file == "to_stdout":
         output_object = sys.stdout
     else:
+        journal = ChunkJournal(output_file + JOURNAL_SUFFIX, prompt, get_backend().model, resume, incremental)
         output_object = open(output_file, 'w')
 
+    # Return the journaled bullets of a chunk (and no pieces) or, if it isn't in the
+    # journal, the response as an iterable of pieces: the lines of the response as the
+    # model generates them in stream mode, otherwise the whole response.  The last
+    # item is the LLMCallError of a chunk that failed (in stream mode, iterating the
+    # pieces raises it instead).
+    def summarize(item):
+        index, chunk = item
+        bullets = journal.lookup(chunk) if journal is not None else None
+        if bullets is not None:
+            return bullets, [], None
+        if stream:
+            return None, call_ollama_api_stream(str(chunk), prompt, use_cache), None
+        try:
+            return None, [call_ollama_api(str(chunk), prompt, use_cache, 'json' if structured else '')], None
+        except LLMCallError as e:
+            return None, [], e
+
     with output_object as file:
         count = 1
-        total_chunks = len(chunks)
-        responses = []
-        for chunk in chunks:
-            print(f"Summarizing chunk {count} of {total_chunks}", file=sys.stderr)
+        tokens = 0
+        replayed_chunks = 0
+        failed_chunks = 0
+        chunk_bullets = []
+        total_stats = ParseStats()
+        # The summarizer reads ahead of the writer by a few chunks, so give each its
+        # own view of the chunks.
+        chunks, chunks_to_summarize = itertools.tee(enumerate(chunks))
+        if stream:
+            responses = map(summarize, chunks_to_summarize)
+        else:
+            responses = ordered_map(summarize, chunks_to_summarize, workers, executor)
+        for (index, chunk), (replayed, pieces, error) in zip(chunks, responses):
+            # Word chunks don't know their size in tokens; estimate it for the report.
+            tokens += chunk.tokens if by_tokens else estimate_tokens(str(chunk))
+            if by_tokens:
+                log(f"Summarizing chunk {count} ({chunk.tokens} tokens)", file=sys.stderr)
+            else:
+                log(f"Summarizing chunk {count}", file=sys.stderr)
             debug_print(f"Chunk:\n\n {chunk}\n\n")
-            raw_response = call_ollama_api(chunk, SUMMARY_PROMPT)
-            debug_print(f"Raw response:\n\n {raw_response}\n\n")
 
             tmp_response = []
 
             # If this chunk has a timestamp on it (e.g., like a whisper timestamp),
             # let's print it to help guide the user to the original text.
-            match = re.search(timestamp_pattern, chunk)
+            match = chunk.search(timestamp_re)
             if match:
                 # Print the matched timestamp
                 file.write(match.group() + '\n')
 
             # If this chunk has a youtube timestamp on it, let's print it to help
             # guide the user to the original text.
-            match = re.search(youtube_timestamp_pattern, chunk)
+            match = chunk.search(youtube_timestamp_re)
             if match:
                 # Print the matched timestamp
                 file.write(match.group() + '\n')
 
-            # Take only the lines in response that start with '"key":', strip any comma
-            # that comes after a closing brace, then build an array of strings with
-            # each of the values.
-            errors_found = 0
-            for line in raw_response.split('\n'):
-                if '"key":' in line:
-                    original_line = line
-
-                    # Fixing up twice helps.
-                    line = fixup_line(line)
-                    line = fixup_line(line)
-
-                    try:
-                        data = json.loads(line)
-                    except json.JSONDecodeError as e:
-                        # If we can't parse the line as JSON, just append it as is
-                        # to avoid losing data; we'll strip the key part to make it
-                        # look like an almost legitimate bullet point.
-                        bullet_point = '* ' + line.split('"key":')[1].strip()
+            # Pull the bullets out of the response.  In stream mode each line is parsed
+            # as soon as it arrives; otherwise the whole response is parsed in one go.
+            chunk_stats = ParseStats()
+            if replayed is not None:
+                replayed_chunks += 1
+                for bullet_point in replayed:
+                    tmp_response.append(bullet_point)
+                    write_formatted_bullet(file, bullet_point, max_width, doFormat)
+            try:
+                for piece in pieces:
+                    debug_print(f"Raw response:\n\n {piece}\n\n")
+                    bullets, stats = parse_summary(piece, structured)
+                    chunk_stats.add(stats)
+                    for bullet_point in bullets:
                         tmp_response.append(bullet_point)
-                        errors_found += 1
-
                         # Update the output file so the user to see the summarization as it occurs.
                         write_formatted_bullet(file, bullet_point, max_width, doFormat)
-                        continue
-                    bullet_point = '* ' + data['key']
-                    tmp_response.append(bullet_point)
-                    # Update the output file so the user to see the summarization as it occurs.
-                    write_formatted_bullet(file, bullet_point, max_width, doFormat)
+            except LLMCallError as e:
+                error = e
+            # Failed chunks are marked in the output and left out of the journal so
+            # that a resumed run retries them.  Replayed chunks are recorded too, as the
+            # journal being written may not have them (e.g., in incremental mode).
+            if error is not None:
+                failed_chunks += 1
+                file.write(failed_chunk_note(count, error) + '\n')
+                log(f"  Chunk {count} failed: {error}", file=sys.stderr)
+            elif journal is not None:
+                journal.record(index, chunk, tmp_response)
 
             # Put a line to delimit chunks.
             file.write('\n')
-            if errors_found > 0:
-                print(f"  Errors found: {errors_found}")
+            if chunk_stats.repaired or chunk_stats.dropped:
+                log(f"  Parsed {chunk_stats}", file=sys.stderr)
+            total_stats.add(chunk_stats)
             processed_response = '\n'.join(tmp_response)
             debug_print(f"Processed response:\n\n{processed_response}\n\n")
-            responses.append(processed_response)
+            # Only the bullets are kept, and only if they are needed for the overall summary.
+            if reduce:
+                chunk_bullets.append(tmp_response)
             count = count + 1
 
+        if reduce and len(chunk_bullets) > 1:
+            log("Summarizing the chunk summaries", file=sys.stderr)
+            file.write("## Overall summary\n\n")
+            for bullet_point in reduce_summaries(chunk_bullets, workers=workers, use_cache=use_cache, executor=executor):
+                write_formatted_bullet(file, bullet_point, max_width, doFormat)
+
+    if journal is not None:
+        if not failed_chunks:
+            journal.finish(count - 1)
+        journal.close()
+    if failed_chunks:
+        retry = " (run again with --resume to retry them)" if journal is not None else ""
+        log(f"{failed_chunks} chunks could not be summarized{retry}", file=sys.stderr)
+    if incremental and journal is not None:
+        log(f"{replayed_chunks} of {count - 1} chunks unchanged since the last run; "
+            f"{count - 1 - replayed_chunks} new or changed chunks summarized, "
+            f"{journal.unused()} chunks of the last run no longer in the input", file=sys.stderr)
+    elif replayed_chunks:
+        log(f"Replayed {replayed_chunks} chunks from {journal.path}", file=sys.stderr)
+    log(f"Parsed {total_stats}", file=sys.stderr)
+    return count - 1, tokens, total_stats, failed_chunks
+
+# Files that batch mode picks up from a directory.
+BATCH_EXTENSIONS = ('.txt', '.pdf')
+
+# Return the input files named by a directory (every .txt and .pdf file in it) or a
+# glob pattern (e.g., 'transcripts/*.txt'), in sorted order.
+def find_batch_inputs(pattern):
+    if os.path.isdir(pattern):
+        paths = [os.path.join(pattern, name) for name in os.listdir(pattern)]
+    else:
+        paths = glob.glob(pattern)
+    return sorted(path for path in paths if path.endswith(BATCH_EXTENSIONS) and os.path.isfile(path))
+
+# The summary of <name>.txt or <name>.pdf goes to <name>.md, as in single file mode.
+def batch_output_file(input_file):
+    return os.path.splitext(input_file)[0] + ".md"
+
+# An output is up to date if it was written after its input was last changed and the
+# run that wrote it wasn't interrupted.
+def is_up_to_date(input_file, output_file):
+    try:
+        if os.path.getmtime(output_file) < os.path.getmtime(input_file):
+            return False
+    except OSError:
+        return False
+    return journal_complete(output_file + JOURNAL_SUFFIX)
+
+# Summarize every file named by pattern (see find_batch_inputs), skipping files whose
+# summary is up to date unless force is set.  Up to `workers` files are processed at
+# a time and all their chunks share one pool of `workers` threads (and the one ollama
+# client), so the ollama server stays busy across file boundaries.  The files and
+# chunks get separate pools so a file never waits on a pool its own thread is in.
+# Files that would be summarized to the same output (e.g., a.txt and a.pdf) are skipped.
+# Prints an aggregate throughput report at the end; returns the number of files that
+# failed, were skipped or have chunks that could not be summarized.
+def process_batch(pattern, chunk_size, overlap, max_width, doFormat, workers=DEFAULT_WORKERS, force=False,
+                  **kwargs):
+    input_files = find_batch_inputs(pattern)
+    inputs_by_output = {}
+    for input_file in input_files:
+        inputs_by_output.setdefault(batch_output_file(input_file), []).append(input_file)
+    clashes = [inputs for inputs in inputs_by_output.values() if len(inputs) > 1]
+    for inputs in clashes:
+        print(f"Skipping {', '.join(inputs)}: they would all be summarized to {batch_output_file(inputs[0])}",
+              file=sys.stderr)
+    todo = [(inputs[0], output_file) for output_file, inputs in inputs_by_output.items()
+            if len(inputs) == 1 and (force or not is_up_to_date(inputs[0], output_file))]
+    skipped = sum(len(inputs) for inputs in clashes)
+    print(f"Batch: {len(input_files)} files, {len(input_files) - len(todo) - skipped} up to date, "
+          f"{skipped} skipped, {len(todo)} to summarize")
+
+    start_time = time.time()
+    done = failed = incomplete = total_chunks = total_tokens = 0
+    total_stats = ParseStats()
+    workers = max(1, workers)
+    with ThreadPoolExecutor(max_workers=workers) as chunk_executor, \
+         ThreadPoolExecutor(max_workers=workers) as file_executor:
+        futures = {file_executor.submit(process_chunks, input_file, output_file, chunk_size, overlap, max_width,
+                                        doFormat, workers, executor=chunk_executor, quiet=True, **kwargs): input_file
+                   for input_file, output_file in todo}
+        for future in as_completed(futures):
+            input_file = futures[future]
+            try:
+                chunks, tokens, stats, failed_chunks = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"[{done + incomplete + failed}/{len(todo)}] {input_file}: failed: {e}", file=sys.stderr)
+                # Don't leave a partial summary that would look up to date next time.
+                try:
+                    os.remove(batch_output_file(input_file))
+                except OSError:
+                    pass
+                continue
+            # A file with chunks that could not be summarized has a summary (with those
+            # chunks marked), but it isn't done: a rerun with --resume retries them.
+            if failed_chunks:
+                incomplete += 1
+            else:
+                done += 1
+            total_chunks += chunks
+            total_tokens += tokens
+            total_stats.add(stats)
+            missing = f", {failed_chunks} could not be summarized" if failed_chunks else ""
+            print(f"[{done + incomplete + failed}/{len(todo)}] {input_file}: {chunks} chunks{missing}, {tokens} tokens",
+                  file=sys.stderr)
+
+    elapsed = max(time.time() - start_time, 1e-9)
+    print(f"Summarized {done} files ({incomplete} incomplete, {failed} failed, {skipped} skipped), "
+          f"{total_chunks} chunks, {total_tokens} tokens in {elapsed:.1f}s")
+    print(f"Throughput: {(done + incomplete) / elapsed:.2f} files/s, {total_chunks / elapsed:.2f} chunks/s, "
+          f"{total_tokens / elapsed:.1f} tokens/s")
+    print(f"Parsed {total_stats}")
+    return failed + incomplete + skipped
+
+# Split the command line options (e.g., --workers=4) out of the arguments.  Options may
+# appear anywhere on the command line; a bare option (e.g., --stream) is set to "True".
+# Returns the positional arguments and a dict of option name to value.
+def parse_options(argv, known_options):
+    args = []
+    options = {}
+    for arg in argv:
+        if not arg.startswith('--'):
+            args.append(arg)
+            continue
+        name, _, value = arg[2:].partition('=')
+        if name not in known_options:
+            print(f"Unknown option: {arg}")
+            sys.exit(1)
+        options[name] = value if value else "True"
+    return args, options
+
 # Specify your input and output files
 if __name__ == "__main__":
-    if len(sys.argv) != 6:
+    set_default_site("osummarize")
+    args, options = parse_options(sys.argv[1:], ["workers", "no-cache", "stream", "reduce", "tokens", "mmap", "json",
+                                                      "batch", "force", "resume", "incremental", "no-warmup"])
+    if len(args) != 5:
         print(f"Usage: {sys.argv[0]} <input_file_prefix> <chunk_size> <formatMode> <stdOut>")
         print("\nParameters:")
         print("  <input_file_prefix>  Base name of the input file. The script uses this prefix to")
@@ -272,17 +603,51 @@ if __name__ == "__main__":
         print("  <stdOut>             Boolean flag ('True' or 'False'). If 'True', the output will")
         print("                       be printed to stdout instead of an output file.")
 
+        print("\nOptions:")
+        print(f"  --workers=<n>        Number of chunks to summarize at the same time (default {DEFAULT_WORKERS}).")
+        print("                       Set this to the number of parallel requests your ollama server")
+        print("                       handles (OLLAMA_NUM_PARALLEL).")
+        print("  --no-cache           Always ask the model instead of reusing cached chunk summaries")
+        print("                       (see LLM_CACHE_DIR and LLM_CACHE_MAX_MB).")
+        print("  --stream             Write each bullet as soon as the model produces it; chunks")
+        print("                       are summarized one at a time (--workers is ignored).")
+        print("  --reduce             Also summarize the chunk summaries (recursively for large")
+        print("                       documents) into an overall summary at the end of the output.")
+        print("  --tokens             <chunk_size> and <overlap> are numbers of tokens instead of")
+        print("                       words; chunks end on sentence and paragraph boundaries.  Counts")
+        print("                       are approximate for llama3 (see LLM_TOKENIZER_FILE).")
+        print("  --mmap               Memory map the input file instead of reading it; use this for")
+        print("                       transcripts that are larger than RAM.")
+        print("  --json               Have the model answer in json (ollama's json format) so the")
+        print("                       response rarely needs repairs; can't be used with --stream.")
+        print("  --batch              <input_file_prefix> is a directory or a quoted glob (e.g.,")
+        print("                       'transcripts/*.txt'); every .txt and .pdf file it names is")
+        print("                       summarized to its own .md file.  Files are summarized at the")
+        print("                       same time, sharing --workers, and <stdOut> must be False.")
+        print("  --force              With --batch, also summarize files whose .md file is newer")
+        print("                       than the input (these are skipped by default).")
+        print("  --resume             Replay the chunks finished by an interrupted run from the")
+        print("                       output's .journal file and only summarize the rest; <stdOut>")
+        print("                       must be False.")
+        print("  --incremental        Split the text at content defined boundaries and only summarize")
+        print("                       the chunks that changed since the last run of the same input;")
+        print("                       the others are replayed from the .journal file.  Chunks may be")
+        print("                       shorter than <chunk_size>; can't be used with --tokens, and")
+        print("                       <stdOut> must be False.")
+        print("  --no-warmup          Don't load the model while the input is being read; by default")
+        print("                       it is loaded up front so the first chunk doesn't wait for it.")
+
         print("\nDescription:")
         print("  This script processes chunks of text from a specified input file and outputs")
         print("  them into a markdown file or stdout. Each chunk of text is processed according")
         print("  to the specified 'chunk_size', and optional formatting can be applied.")
         sys.exit(1)
 
-    input_file_prefix = sys.argv[1]
-    chunk_size_arg = sys.argv[2]
-    overlap_arg = sys.argv[3]
-    doFormat_arg = sys.argv[4]
-    stdoutMode = sys.argv[5]
+    input_file_prefix = args[0]
+    chunk_size_arg = args[1]
+    overlap_arg = args[2]
+    doFormat_arg = args[3]
+    stdoutMode = args[4]
 
     try:
         chunk_size = int(chunk_size_arg)
@@ -294,6 +659,11 @@ if __name__ == "__main__":
     except ValueError as e:
         print(f"The overlap must be an integer: {str(e)}")
         sys.exit(1)
+    try:
+        workers = int(options.get("workers", DEFAULT_WORKERS))
+    except ValueError as e:
+        print(f"The number of workers must be an integer: {str(e)}")
+        sys.exit(1)
 
     if doFormat_arg == "True":
         doFormat = True
@@ -303,12 +673,48 @@ if __name__ == "__main__":
         print("formatMode must be either True or False")
         sys.exit(1)
 
+    use_cache = "no-cache" not in options
+    stream = "stream" in options
+    reduce = "reduce" in options
+    by_tokens = "tokens" in options
+    use_mmap = "mmap" in options
+    structured = "json" in options
+    resume = "resume" in options
+    incremental = "incremental" in options
+    if structured and stream:
+        print("--json can't be used with --stream")
+        sys.exit(1)
+    if incremental and by_tokens:
+        print("--incremental can't be used with --tokens")
+        sys.exit(1)
+    # The journal is kept next to the output file, so there is none when writing to stdout.
+    if (resume or incremental) and stdoutMode == "True":
+        print(f"stdOut must be False with --{'resume' if resume else 'incremental'}")
+        sys.exit(1)
+
+    # Load the model while the input is read and split, so that the first chunk doesn't
+    # pay for it (the load time is reported with the metrics).
+    if "no-warmup" not in options:
+        threading.Thread(target=get_backend().warm_up, daemon=True).start()
+
+    if "batch" in options:
+        if stdoutMode == "True":
+            print("stdOut must be False with --batch")
+            sys.exit(1)
+        print(f"Chunk size: {chunk_size}, overlap: {overlap_size}, max width: 100, format: {doFormat}, workers: {workers}")
+        failed = process_batch(input_file_prefix, chunk_size, overlap_size, max_width=100, doFormat=doFormat,
+                               workers=workers, force="force" in options, use_cache=use_cache, stream=stream,
+                               reduce=reduce, by_tokens=by_tokens, use_mmap=use_mmap, structured=structured,
+                               resume=resume, incremental=incremental)
+        print(get_metrics().summary_table(), file=sys.stderr)
+        sys.exit(1 if failed else 0)
+
     # extract the root of the filename
     extension = input_file_prefix.split('.')[-1]
     input_file_prefix = input_file_prefix.replace('.' + extension, "")
     print(f"Extension: {extension}")
     if extension == "pdf":
-        input_file = sys.argv[1]
+        input_file = args[0]
     else:
         input_file = input_file_prefix + ".txt"
     if input_file_prefix == "clipboard":
@@ -324,5 +730,9 @@ if __name__ == "__main__":
     if stdoutMode == "True":
         output_file = "to_stdout"
     print(f"Input file: {input_file}; output file: {output_file}")
-    print(f"Chunk size: {chunk_size}, overlap: {overlap_size}, max width: 100, format: {doFormat}")
-    process_chunks(input_file, output_file, chunk_size=chunk_size, overlap=overlap_size, max_width=100, doFormat=doFormat)
+    print(f"Chunk size: {chunk_size}, overlap: {overlap_size}, max width: 100, format: {doFormat}, workers: {workers}")
+    process_chunks(input_file, output_file, chunk_size=chunk_size, overlap=overlap_size, max_width=100, doFormat=doFormat, workers=workers,
+                   use_cache=use_cache, stream=stream, reduce=reduce,
+                   by_tokens=by_tokens, use_mmap=use_mmap,
+                   structured=structured, resume=resume, incremental=incremental)
+    print(get_metrics().summary_table(), file=sys.stderr)
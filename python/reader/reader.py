@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 
+import os
+import re
 import sys
+import time
 
 # url = "http://paulgraham.com/worked.html"
 # url = "https://www.cnbc.com/2024/05/11/sweetgreen-chipotle-and-wingstop-arent-seeing-a-consumer-slowdown.html"
@@ -18,14 +21,46 @@ def chopout(text, start_text):
             return text
     return text
 
+# Pages are fetched over a shared connection pool with a timeout and revalidated
+# from an on-disk HTTP cache (see utils/web_fetch.py).
 def url_to_text_simple(url, start_text=""):
-    # pip install requests html2text
-    import requests
-    import html2text
-    response = requests.get(url, headers=None).text
-    response = html2text.html2text(response)
+    # pip install httpx html2text
+    from utils.web_fetch import fetch_url, html_to_text
+    response = html_to_text(fetch_url(url))
     return chopout(response, start_text)
 
+# Fetch many pages at once (concurrently, see fetch_urls) and return the text of each,
+# in the order of urls, or the exception of a page that couldn't be fetched.
+def urls_to_text(urls, start_text=""):
+    from utils.web_fetch import fetch_urls
+    texts = fetch_urls(urls, to_text=True)
+    return [text if isinstance(text, Exception) else chopout(text, start_text) for text in texts]
+
+# Return the name of the file that the text of the n-th url is saved to in batch mode.
+# The number keeps the names unique and in the order of the url file.
+def page_file_name(number, url):
+    slug = re.sub(r'[^A-Za-z0-9]+', '_', re.sub(r'^https?://', '', url)).strip('_')[:80]
+    return f"{number:04d}_{slug}.txt"
+
+# Save the text of every url listed in url_file (one per line; blank lines and lines
+# starting with # are skipped) to its own .txt file in output_dir, ready for
+# osummarize --batch.  Returns the number of pages that couldn't be fetched.
+def save_urls_to_dir(url_file, start_text, output_dir):
+    with open(url_file, 'r') as file:
+        urls = [line.strip() for line in file if line.strip() and not line.startswith('#')]
+    os.makedirs(output_dir, exist_ok=True)
+    start_time = time.time()
+    failed = 0
+    for number, (url, text) in enumerate(zip(urls, urls_to_text(urls, start_text)), 1):
+        if isinstance(text, Exception):
+            failed += 1
+            print(f"{url}: failed: {text}", file=sys.stderr)
+            continue
+        with open(os.path.join(output_dir, page_file_name(number, url)), 'w') as output:
+            output.write(text)
+    print(f"Saved {len(urls) - failed} of {len(urls)} pages to {output_dir} in {time.time() - start_time:.1f}s")
+    return failed
+
 def url_to_text(url, start_text=""):
     # pip install llama-index llama-index-readers-web IPython
     # I uninstalled all this because it was just huge.  Since
@@ -37,18 +72,25 @@ def url_to_text(url, start_text=""):
     return chopout(document_as_dict['text'], start_text)
 
 if __name__ == "__main__":
+    if len(sys.argv) == 5 and sys.argv[1] == "--batch":
+        sys.exit(1 if save_urls_to_dir(sys.argv[2], sys.argv[3], sys.argv[4]) else 0)
     if len(sys.argv) != 3:
         print(f"Usage: {sys.argv[0]} <URL> <start_text>")
+        print(f"       {sys.argv[0]} --batch <url_file> <start_text> <output_dir>")
         print("\nParameters:")
         print("  <URL>         The URL of the web page to fetch and process.")
         print("  <start_text>  A string that marks the starting point in the fetched text.")
         print("                The output will include text from this point onwards.")
         print("                Pass in "" if you don't want to specify a starting point.")
+        print("  --batch       Fetch every URL listed in <url_file> (one per line) at the same")
+        print("                time and save the text of each page to its own file in")
+        print("                <output_dir> (e.g., to summarize them with osummarize --batch).")
 
         print("\nDescription:")
-        print("  This script fetches text from the specified URL using the requests")
-        print("  web reader, and optionally starts output from a user-specified text.")
+        print("  This script fetches text from the specified URL with httpx (see")
+        print("  utils/web_fetch.py), and optionally starts output from a user-specified text.")
         print("  This is useful for extracting a specific section of a web page.")
+        print("  The python/ directory must be on PYTHONPATH so that utils can be imported.")
         sys.exit(1)
     url = sys.argv[1]
     # url = 'https://tradingbotsreviews.com/new/?utm_source=taboola&utm_medium=referral&tblci=GiDL1ILU0OLMk_szq58lewF03J0cuwaKsB8F_tCoQTleviCdyFsog-rL2KiHiLh2MMQE#tblciGiDL1ILU0OLMk_szq58lewF03J0cuwaKsB8F_tCoQTleviCdyFsog-rL2KiHiLh2MMQE'
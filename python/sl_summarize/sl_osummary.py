@@ -3,20 +3,113 @@
 # streamlit run --server.port 8509 --server.headless True --theme.base dark sl_osummary.py
 
 import os
-import requests
+import time
+import uuid
+import hashlib
+import threading
+import httpx
 import streamlit as st
 from streamlit.runtime.uploaded_file_manager import UploadedFile
 import pyperclip
-from typing import Any, List, Tuple, Optional
+from typing import Any, Iterator, List, Tuple, Optional
 
-from utils.chat_utils import call_ollama_api, fixup_line, timestamp_pattern, youtube_timestamp_pattern, highlight_regex_matches, process_chunks, load_text
+from utils.llm_metrics import get_metrics, set_default_site
+from utils.web_fetch import fetch_url
+from utils.job_queue import get_job_queue, Job, CANCELLED, FAILED, QUEUED
+from utils.chat_utils import call_ollama_api, get_backend, set_default_keep_alive, INTERACTIVE_KEEP_ALIVE, timestamp_pattern, youtube_timestamp_pattern, highlight_regex_matches, find_regex_matches, match_window, plan_chunks, iter_chunk_summaries, join_summaries, load_text, pdf_page_count, Chunk, DEFAULT_WORKERS
+
+# While a summary job runs, the page is rerun this often to show its progress.
+POLL_SECONDS = 1.0
+
+# A highlighted summary longer than this many characters is shown a window around the
+# selected match at a time.
+HIGHLIGHT_WINDOW_CHARS = 20000
+
+# Streamlit reruns this whole script on every widget change, so the loaded text, its
+# word count and its chunks are memoized, keyed by the sha256 of the document (the data
+# itself is left out of the key, see the leading underscores) and the parameters.  These
+# bound how many documents and chunk plans are kept in memory.
+MAX_CACHED_DOCUMENTS = 8
+MAX_CACHED_PLANS = 16
+
+def digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def count_words(pages: List[str]) -> int:
+    return sum(len(page.split(' ')) for page in pages)
+
+@st.cache_data(max_entries=MAX_CACHED_DOCUMENTS, show_spinner=False)
+def cached_pdf_page_count(data_digest: str, _data: bytes) -> int:
+    return pdf_page_count(_data)
+
+# Return the text of a file (of pages page_start to page_end of a pdf) as a list of
+# pages, its word count and the digest of the text.  A file that can't be read raises
+# (and, unlike a result, the error isn't cached).
+@st.cache_data(max_entries=MAX_CACHED_DOCUMENTS, show_spinner="Reading the file...")
+def cached_file_text(data_digest: str, _file: UploadedFile, page_start: Optional[int] = None,
+                     page_end: Optional[int] = None) -> Tuple[List[str], int, str]:
+    _file.seek(0)
+    pages, _ = load_text(_file, page_start, page_end)
+    return pages, count_words(pages), digest(' '.join(pages).encode('utf-8'))
+
+# Return the chunks that a summary of the text (with digest text_digest) would summarize.
+# Chunks are views of the text, so they are kept as they are rather than copied.
+@st.cache_resource(max_entries=MAX_CACHED_PLANS, show_spinner="Splitting the text into chunks...")
+def cached_chunk_plan(text_digest: str, _text: str, chunk_size: int, overlap: int, by_tokens: bool,
+                      incremental: bool) -> List[Chunk]:
+    return plan_chunks(_text, chunk_size, overlap, by_tokens, incremental)
+
+# Scraped pages are kept for this long before a rerun fetches (revalidates) them again.
+SCRAPE_TTL_SECONDS = 600
+
+# Return the page at url; the headers (which may hold an API key) are left out of the key.
+@st.cache_data(max_entries=MAX_CACHED_DOCUMENTS, ttl=SCRAPE_TTL_SECONDS, show_spinner="Fetching the page...")
+def cached_scrape(url: str, _headers: dict) -> str:
+    return fetch_url(url, _headers)
+
+# Set the text to summarize (a list of pages) and what is known about it.
+# The pages are joined into the text that is chunked only when the text changes, not on
+# every rerun.
+def set_text(pages: List[str], word_size: int, text_digest: str) -> None:
+    if text_digest != st.session_state['text_digest']:
+        st.session_state['full_text'] = ' '.join(pages)
+    st.session_state['text'] = pages
+    st.session_state['word_size'] = word_size
+    st.session_state['text_digest'] = text_digest
+
+# Return the function of a background job (see JobQueue) that summarizes the chunks, as
+# process_chunks does, on the job queue's shared pool.
+def summary_job(chunks: List[Chunk], workers: int, use_cache: bool, reduce: bool, structured: bool):
+    def run(job: Job) -> Iterator[str]:
+        job.total = len(chunks) + (1 if reduce and len(chunks) > 1 else 0)
+        queue = get_job_queue()
+        # The job keeps its chunk calls to its share of the shared pool, so the other
+        # running jobs get their turns on the server.
+        return iter_chunk_summaries(chunks, min(workers, queue.chunk_share()), use_cache, reduce, structured,
+                                    queue.executor)
+    return run
 
 # Streamlit UI
 st.set_page_config(page_title="Summary Co-Pilot", layout="wide")
+set_default_site("streamlit")
+set_default_keep_alive(INTERACTIVE_KEEP_ALIVE)
+
+# Load the model while the user picks a document, once per browser session.
+if 'warmed_up' not in st.session_state:
+    st.session_state['warmed_up'] = True
+    threading.Thread(target=get_backend().warm_up, daemon=True).start()
 
 if 'summary' not in st.session_state:
     st.session_state['summary'] = ""
 
+# Summaries run as background jobs, shared fairly between the browser tabs (each tab is
+# its own session and owner); job_id is this tab's current job.
+if 'owner' not in st.session_state:
+    st.session_state['owner'] = uuid.uuid4().hex
+
+if 'job_id' not in st.session_state:
+    st.session_state['job_id'] = None
+
 if 'num_pages' not in st.session_state:
     st.session_state['num_pages'] = None
 
@@ -32,6 +125,17 @@ if 'page_end' not in st.session_state:
 if 'word_size' not in st.session_state:
     st.session_state['word_size'] = 0
 
+if 'text_digest' not in st.session_state:
+    st.session_state['text_digest'] = ''
+
+if 'full_text' not in st.session_state:
+    st.session_state['full_text'] = ''
+
+# The clipboard is read when it is picked as the input (or on "Paste again"), not on
+# every rerun.
+if 'clipboard_read' not in st.session_state:
+    st.session_state['clipboard_read'] = False
+
 # Track the chunksize and overlap values so that we can be dynamic since
 # text sizes change and we want to give the user reasonable defaults if
 # we can figure them out for them.
@@ -54,30 +158,38 @@ with st.sidebar:
     if input_type == "File":
         uploaded_file: UploadedFile|None = st.file_uploader(f"Choose a file", key='file_uploader')
         if uploaded_file is not None:
-            if uploaded_file.name.endswith('.pdf'):
-                pages_text, num_pages = load_text(uploaded_file)
-                st.session_state['text'] = pages_text
-                st.session_state['num_pages'] = num_pages
-                if st.session_state['page_end'] is None or st.session_state['page_end'] > num_pages:
-                    st.session_state['page_end'] = num_pages
-                if num_pages is not None:
+            file_digest = digest(uploaded_file.getvalue())
+            try:
+                if uploaded_file.name.endswith('.pdf'):
+                    # Pick the page range first so that only the selected pages are extracted;
+                    # extracted pages are cached so changing the range doesn't redo them.
+                    num_pages = cached_pdf_page_count(file_digest, uploaded_file.getvalue())
+                    st.session_state['num_pages'] = num_pages
+                    if st.session_state['page_start'] is None:
+                        st.session_state['page_start'] = 1
+                    if st.session_state['page_end'] is None or st.session_state['page_end'] > num_pages:
+                        st.session_state['page_end'] = num_pages
                     st.session_state['page_start'] = st.sidebar.number_input("Page Start", min_value=1, max_value=num_pages, value=st.session_state['page_start'], key='page_start_num')
                     st.session_state['page_end'] = st.sidebar.number_input("Page End", min_value=1, max_value=num_pages, value=st.session_state['page_end'], key='page_end_num')
-                # Find the number of words in the list of strings (pages_text)
-                st.session_state['word_size'] = sum([len(page.split(' ')) for page in pages_text])
-            else:
-                text, _ = load_text(uploaded_file)
-                st.session_state['text'] = text
-                st.session_state['word_size'] = sum([len(page.split(' ')) for page in text])
-    elif input_type == "Clipboard":
-        clipboard_text: str = pyperclip.paste()
-        text = clipboard_text
-        st.session_state['text'] = [text]
+                    set_text(*cached_file_text(file_digest, uploaded_file, st.session_state['page_start'], st.session_state['page_end']))
+                else:
+                    set_text(*cached_file_text(file_digest, uploaded_file))
+            except Exception as e:
+                st.error(f"Error loading file: {e}")
+    if input_type == "Clipboard":
+        paste_again: bool = st.button("Paste again")
+        if paste_again or not st.session_state['clipboard_read']:
+            clipboard_text: str = pyperclip.paste()
+            set_text([clipboard_text], count_words([clipboard_text]), digest(clipboard_text.encode('utf-8')))
+            st.session_state['clipboard_read'] = True
+        text = st.session_state['text'][0] if st.session_state['text'] else ""
         st.session_state['page_start'] = None
         st.session_state['page_end'] = None
-        st.session_state['word_size'] = len(clipboard_text.split(' '))
+    else:
+        st.session_state['clipboard_read'] = False
+
+    if input_type == "Scrape URL to clipboard":
 
-    elif input_type == "Scrape URL to clipboard":
         # Checkbox to choose whether to prepend Jina.ai URL
         # Scrape the url with or without jina and just render it as markdown
         # and also, add it to the clipboard so we can summarize.
@@ -91,19 +203,16 @@ with st.sidebar:
                 full_url = url
                 headers = {}
             try:
-                response = requests.get(full_url, headers=headers)
-                response.raise_for_status()
-                scraped_text = response.text
+                scraped_text = cached_scrape(full_url, headers)
                 pyperclip.copy(scraped_text)
-                st.session_state['text'] = [scraped_text]
+                set_text([scraped_text], count_words([scraped_text]), digest(scraped_text.encode('utf-8')))
                 st.session_state['page_start'] = None
                 st.session_state['page_end'] = None
-                st.session_state['word_size'] = len(scraped_text.split(' '))
 
                 # Add the scraped text so it can be saved (not tested)
                 st.session_state['summary'] = scraped_text
                 text = scraped_text
-            except requests.exceptions.RequestException as e:
+            except httpx.HTTPError as e:
                 st.error(f"Error fetching the URL: {e}")
 
     if st.session_state['word_size'] < st.session_state['chunk_size_value']:
@@ -120,25 +229,54 @@ with st.sidebar:
 
     #chunk_size_min = min(st.session_state['word_size'], 100)
     #chunk_size_max = max(st.session_state['word_size'], 1000)
+    # Token chunks are cut on sentence/paragraph boundaries and pack the model's context
+    # window more tightly than word chunks.
+    chunk_unit: str | None = st.radio("Chunk size unit:", ("Words", "Tokens"), horizontal=True)
+    by_tokens: bool = chunk_unit == "Tokens"
+
     chunk_size: int = st.slider("Chunk Size", min_value=0, max_value=1000, value=st.session_state['chunk_size_value'])
 
     overlap: int = st.slider("Overlap", min_value=0, max_value=chunk_size-1, value=st.session_state['overlap_value'])
 
+    # Number of chunks summarized at the same time; match this to the ollama server's
+    # OLLAMA_NUM_PARALLEL setting.
+    workers: int = st.slider("Workers", min_value=1, max_value=8, value=DEFAULT_WORKERS)
+
+    # Reuse cached chunk summaries so that regenerating an unchanged summary is instant.
+    use_cache: bool = st.checkbox("Use cached summaries", value=True)
+
+    # Cut chunks where the text says so instead of every chunk_size words, so that after
+    # an edit only the chunks around it are summarized again (word chunks, needs the cache).
+    incremental: bool = st.checkbox("Keep chunks stable across edits", value=False,
+                                     disabled=by_tokens or not use_cache)
+
+    # Summarize the chunk summaries into an overall summary (useful for long documents).
+    reduce: bool = st.checkbox("Add overall summary", value=False)
+
+    # Ask the model for json output so bullets rarely need to be repaired.
+    structured: bool = st.checkbox("Structured (json) output", value=False)
+
     # Search dialog for regex pattern
     regex_pattern: str = st.sidebar.text_input("Enter regex pattern to highlight")
 
-    if st.button("Generate Summary"):
-        if st.session_state['text']:
-            st.session_state['summary'] = "Processing..."
-            if input_type == "File" and uploaded_file is not None and uploaded_file.name.endswith('.pdf'):
-                page_start: int = st.session_state['page_start']
-                page_end: int = st.session_state['page_end']
-                selected_pages_text: str = ' '.join(st.session_state['text'][page_start-1:page_end])
-                st.session_state['summary'] = process_chunks(selected_pages_text, chunk_size, overlap)
-            else:
-                st.session_state['summary'] = process_chunks(' '.join(st.session_state['text']), chunk_size, overlap)
+    # For a pdf, st.session_state['text'] only holds the selected pages.
+    chunks: List[Chunk] = []
+    if st.session_state['text']:
+        chunks = cached_chunk_plan(st.session_state['text_digest'], st.session_state['full_text'],
+                                   chunk_size, overlap, by_tokens, incremental)
+        st.text(f"Chunks: {len(chunks)}")
+
+    job_queue = get_job_queue()
+    job: Optional[Job] = job_queue.get(st.session_state['job_id'])
+    if st.button("Generate Summary", disabled=job is not None and job.active()):
+        if chunks:
+            job = job_queue.submit(st.session_state['owner'], f"{st.session_state['word_size']} words",
+                                   summary_job(chunks, workers, use_cache, reduce, structured))
+            st.session_state['job_id'] = job.id
         else:
             st.error("Please provide text to summarize.")
+    if job is not None and job.active() and st.button("Cancel Summary"):
+        job_queue.cancel(job.id)
 
     save_summary: str = st.text_input("Save summary as (filename):")
     if st.button("Save Summary", disabled=not st.session_state['summary']):
@@ -149,6 +287,12 @@ with st.sidebar:
         else:
             st.error("Please provide a filename to save the summary.")
 
+    # Token counts and timings of the LLM calls made by this server so far.
+    with st.expander("LLM call stats"):
+        st.text(get_metrics().summary_table())
+        running, queued = job_queue.counts()
+        st.text(f"Summary jobs: {running} running, {queued} queued")
+
 tmp_start: Optional[int] = st.session_state['page_start']
 tmp_end: Optional[int] = st.session_state['page_end']
 tmp_display: str = f"{tmp_start} - {tmp_end}"
@@ -158,8 +302,46 @@ tmp_display += f" ({st.session_state['word_size']} words)"
 
 st.markdown(f"#### Summary: {tmp_display} chunkSize={chunk_size}/Overlap={overlap}")
 
-if regex_pattern:
-    highlighted_summary: str = highlight_regex_matches(st.session_state['summary'], regex_pattern)
-    st.markdown(highlighted_summary, unsafe_allow_html=True)
+# Show the bullets of the chunks done so far while the job runs; once it is over, its
+# result becomes the summary (which can then be saved) and the job is forgotten.
+if job is not None:
+    done, total = job.progress()
+    st.session_state['summary'] = join_summaries(job.parts)
+    if job.status == QUEUED:
+        running, _ = job_queue.counts()
+        st.info(f"Waiting for {running} running and {job_queue.position(job)} queued summary jobs")
+    elif job.active():
+        st.progress(min(done, total or done) / max(1, total or done),
+                    text=f"Summarized {done} of {total if total is not None else '?'} chunks")
+    else:
+        if job.status == FAILED:
+            st.error(f"The summary failed: {job.error}")
+        elif job.status == CANCELLED:
+            st.warning(f"The summary was cancelled after {done} chunks")
+        st.session_state['job_id'] = None
+
+summary: str = st.session_state['summary']
+matches = find_regex_matches(summary, regex_pattern) if regex_pattern else None
+if matches is None or matches.error or not matches.spans:
+    if matches is not None:
+        if matches.error:
+            st.error(matches.error)
+        else:
+            st.caption("No matches")
+    st.markdown(summary)
+elif len(summary) <= HIGHLIGHT_WINDOW_CHARS:
+    st.caption(f"{len(matches.spans)} matches")
+    st.markdown(highlight_regex_matches(summary, regex_pattern), unsafe_allow_html=True)
 else:
-    st.markdown(st.session_state['summary'])
+    # Only the part of a long summary around the selected match is marked up and shown.
+    # The key starts a new selector when the matches change, so it never points past them.
+    match_number: int = st.number_input(f"Match (of {len(matches.spans)})", min_value=1,
+                                        max_value=len(matches.spans), value=1,
+                                        key=f"match-{regex_pattern}-{len(matches.spans)}")
+    window_start, window_end = match_window(summary, matches.spans[match_number - 1], HIGHLIGHT_WINDOW_CHARS)
+    st.caption(f"Showing characters {window_start} to {window_end} of {len(summary)}")
+    st.markdown(highlight_regex_matches(summary, regex_pattern, window_start, window_end), unsafe_allow_html=True)
+
+if job is not None and job.active():
+    time.sleep(POLL_SECONDS)
+    st.rerun()
@@ -0,0 +1,10 @@
+import os
+import sys
+
+# The tests import the modules the way the programs do (utils.chat_utils, ...), with
+# python/ on the path (see PYTHONPATH in the README), the mock server the way the
+# benchmark does, and osummarize the way mypy finds it (see mypy.ini).
+PYTHON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (os.path.join(PYTHON_DIR, 'benchmark'), os.path.join(PYTHON_DIR, 'osummarize'), PYTHON_DIR):
+    if path not in sys.path:
+        sys.path.insert(0, path)
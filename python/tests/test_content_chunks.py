@@ -0,0 +1,32 @@
+from text_samples import make_text, split_randomly
+from utils.chat_utils import ContentChunker, iter_chunks, split_into_content_chunks
+
+
+def test_streamed_chunks_match_one_piece():
+    text = make_text(2000)
+    streamed = [str(chunk) for chunk in iter_chunks(split_randomly(text), ContentChunker(100, 10))]
+    assert streamed == [str(chunk) for chunk in split_into_content_chunks(text, 100, 10)]
+
+
+def test_content_chunks():
+    text = make_text(3000)
+    words = text.split()
+    chunks = [str(chunk).split() for chunk in split_into_content_chunks(text, 100, 10)]
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    # Each chunk starts with the last overlap words of the previous one, and together
+    # they cover the text.
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert chunk[:10] == previous[-10:]
+    assert [word for chunk in chunks[:1] + [chunk[10:] for chunk in chunks[1:]] for word in chunk] == words
+
+
+def test_content_chunks_survive_an_edit():
+    text = make_text(5000)
+    before = {str(chunk) for chunk in split_into_content_chunks(text, 100, 10)}
+    # Change one word in the middle of the text.
+    middle = text.index(' ', len(text) // 2)
+    edited = text[:middle] + ' edited' + text[middle:]
+    after = [str(chunk) for chunk in split_into_content_chunks(edited, 100, 10)]
+    changed = [chunk for chunk in after if chunk not in before]
+    assert 1 <= len(changed) <= 3
+    assert any('edited' in chunk for chunk in changed)
@@ -0,0 +1,41 @@
+import threading
+
+from utils.chat_utils import ordered_map
+from utils.job_queue import JobQueue
+
+
+def test_jobs_share_the_chunk_pool():
+    queue = JobQueue(slots=2, chunk_workers=4)
+    release = threading.Event()
+    second_started = threading.Event()
+    first_started = threading.Semaphore(0)
+
+    def first(item):
+        first_started.release()
+        release.wait(5)
+        return item
+
+    def second(item):
+        second_started.set()
+        return item
+
+    results = {}
+
+    def run(name, func, items):
+        results[name] = list(ordered_map(func, items, queue.chunk_share(), queue.executor))
+
+    runners = [threading.Thread(target=run, args=("first", first, range(20))),
+               threading.Thread(target=run, args=("second", second, range(3)))]
+    try:
+        runners[0].start()
+        for _ in range(queue.chunk_share()):
+            assert first_started.acquire(timeout=2)
+        runners[1].start()
+        # The first job's calls all block; with only its share of the pool submitted,
+        # the second job's calls still get a thread.
+        assert second_started.wait(2)
+    finally:
+        release.set()
+        for runner in runners:
+            runner.join(5)
+    assert results == {"first": list(range(20)), "second": [0, 1, 2]}
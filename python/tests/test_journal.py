@@ -0,0 +1,92 @@
+import json
+import os
+
+from osummarize import ChunkJournal, journal_complete
+
+PROMPT = "Summarize this."
+
+
+def write_journal(path, chunks, done=True, **kwargs):
+    journal = ChunkJournal(path, PROMPT, "model", **kwargs)
+    for index, chunk in enumerate(chunks):
+        journal.record(index, chunk, [f"* {chunk}"])
+    if done:
+        journal.finish(len(chunks))
+    journal.close()
+
+
+def test_resume_replays_finished_chunks(tmp_path):
+    path = str(tmp_path / "a.md.journal")
+    write_journal(path, ["one", "two"], done=False)
+    assert not journal_complete(path)
+
+    journal = ChunkJournal(path, PROMPT, "model", resume=True)
+    assert journal.lookup("one") == ["* one"]
+    assert journal.lookup("three") is None
+    # Recording a replayed chunk again doesn't repeat it.
+    journal.record(0, "one", ["* one"])
+    journal.record(2, "three", ["* three"])
+    journal.finish(3)
+    journal.close()
+    lines = open(path).read().splitlines()
+    assert len(lines) == 5
+    assert journal_complete(path)
+
+
+def test_resume_after_a_truncated_line(tmp_path):
+    path = str(tmp_path / "a.md.journal")
+    write_journal(path, ["one", "two"], done=False)
+    # A crash in the middle of writing an entry.
+    with open(path, 'a') as file:
+        file.write('{"index": 2, "hash": "ab')
+
+    journal = ChunkJournal(path, PROMPT, "model", resume=True)
+    assert journal.lookup("two") == ["* two"]
+    journal.record(2, "three", ["* three"])
+    journal.close()
+    # The cut off line is ended so that the entry after it can still be read.
+    assert ChunkJournal(path, PROMPT, "model", resume=True).lookup("three") == ["* three"]
+
+
+def test_journal_of_another_prompt_or_model_is_ignored(tmp_path):
+    path = str(tmp_path / "a.md.journal")
+    write_journal(path, ["one"])
+    assert ChunkJournal(path, "Another prompt.", "model", resume=True).lookup("one") is None
+    assert ChunkJournal(path, PROMPT, "another model", resume=True).lookup("one") is None
+
+
+def test_incremental_run_replaces_the_journal_when_done(tmp_path):
+    path = str(tmp_path / "a.md.journal")
+    write_journal(path, ["one", "two", "three"])
+
+    journal = ChunkJournal(path, PROMPT, "model", incremental=True)
+    assert journal.lookup("one") == ["* one"]
+    journal.record(0, "one", ["* one"])
+    journal.record(1, "two edited", ["* two edited"])
+    # Until the run is over the old journal is left as it was.
+    assert json.loads(open(path).read().splitlines()[-1]) == {"done": 3}
+    assert not journal_complete(path)
+    journal.finish(2)
+    journal.close()
+
+    assert not os.path.exists(path + ".new")
+    assert journal_complete(path)
+    assert journal.unused() == 2
+    replayed = ChunkJournal(path, PROMPT, "model", resume=True)
+    assert replayed.lookup("two edited") == ["* two edited"]
+    # Chunks that are no longer in the input are gone from the new journal.
+    assert replayed.lookup("three") is None
+
+
+def test_interrupted_incremental_run_keeps_both_journals(tmp_path):
+    path = str(tmp_path / "a.md.journal")
+    write_journal(path, ["one", "two"])
+
+    # A run that dies after its first new chunk (close is never called).
+    journal = ChunkJournal(path, PROMPT, "model", incremental=True)
+    journal.record(0, "one edited", ["* one edited"])
+    journal.file.close()
+
+    journal = ChunkJournal(path, PROMPT, "model", incremental=True)
+    assert journal.lookup("one edited") == ["* one edited"]
+    assert journal.lookup("two") == ["* two"]
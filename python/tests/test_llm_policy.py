@@ -0,0 +1,76 @@
+import heapq
+
+import pytest
+
+from utils import llm_policy
+from utils.llm_policy import AdaptiveLimiter, CircuitBreaker
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(llm_policy.time, 'monotonic', fake)
+    return fake
+
+
+# Make `calls` calls that each take `latency` seconds, keeping as many in flight as the
+# limiter allows (as the worker threads do), and return the limit at the end.
+def run_calls(limiter, clock, latency, calls):
+    finishing = []
+    started = 0
+    while started < calls or finishing:
+        while started < calls and limiter.in_flight < max(limiter.min_limit, int(limiter.limit)):
+            limiter.acquire()
+            heapq.heappush(finishing, clock.now + latency)
+            started += 1
+        clock.now = heapq.heappop(finishing)
+        limiter.release(latency)
+    return limiter.limit
+
+
+def test_limiter_recovers_after_latency_step(clock):
+    limiter = AdaptiveLimiter(32)
+    assert run_calls(limiter, clock, 0.3, 200) == 32
+    # Ten times slower calls look like queuing at first...
+    run_calls(limiter, clock, 3.0, 20)
+    assert limiter.limit < 32
+    # ...but become the new baseline, and the limit grows back.
+    assert run_calls(limiter, clock, 3.0, 2000) >= 16
+    # Faster calls again are never a reason to lower the limit.
+    low = limiter.limit
+    assert run_calls(limiter, clock, 0.3, 500) >= low
+
+
+def test_limiter_halves_on_overload(clock):
+    limiter = AdaptiveLimiter(32)
+    run_calls(limiter, clock, 0.5, 100)
+    for _ in range(32):
+        limiter.acquire()
+    clock.now += 1.0
+    limiter.release(None, overloaded=True)
+    assert limiter.limit == 16
+    # The other calls of the same burst don't halve it again.
+    limiter.release(None, overloaded=True)
+    assert limiter.limit == 16
+
+
+def test_breaker_opens_and_lets_a_trial_through(clock):
+    breaker = CircuitBreaker(failures=2, reset_seconds=10)
+    breaker.record(False, ValueError("down"))
+    assert breaker.allow()
+    breaker.record(False, ValueError("down"))
+    assert not breaker.allow()
+    assert breaker.retry_in() == 10
+    clock.now += 10
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record(True)
+    assert breaker.allow()
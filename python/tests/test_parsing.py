@@ -0,0 +1,65 @@
+import pytest
+
+from mock_ollama import MALFORMATIONS, make_response
+from utils.chat_utils import parse_bullets, parse_structured_bullets, parse_summary
+
+BULLETS = [f"Point {i} is about thing {i}" for i in range(1, 6)]
+EXPECTED = ['* ' + bullet for bullet in BULLETS]
+
+
+def test_clean_response():
+    bullets, stats = parse_bullets(make_response(BULLETS, False, None, 0.5))
+    assert bullets == EXPECTED
+    assert (stats.entries, stats.clean, stats.repaired, stats.dropped) == (5, 5, 0, 0)
+
+
+# The ways the mock server (and the benchmark) damage a response, with the bullets that
+# are still recovered.  The damage is to the third entry (position 0.5).
+DAMAGED = [
+    ('unescaped_quote', EXPECTED[:2] + ['* Point 3 is "quoted" about thing 3'] + EXPECTED[3:], 1),
+    ('missing_brace', EXPECTED, 1),
+    ('truncated', EXPECTED[:2] + ['* Point 3'], 1),
+    ('prose', EXPECTED, 0),
+    # An entry with single quotes has no "key" to find; the others are still read.
+    ('single_quotes', EXPECTED[:2] + EXPECTED[3:], 0),
+]
+
+
+@pytest.mark.parametrize("damage, expected, repaired", DAMAGED)
+def test_damaged_response(damage, expected, repaired):
+    bullets, stats = parse_bullets(make_response(BULLETS, False, damage, 0.5))
+    assert bullets == expected
+    assert stats.repaired == repaired
+    assert stats.dropped == 0
+
+
+def test_every_malformation_is_covered():
+    assert {damage for damage, _, _ in DAMAGED} == set(MALFORMATIONS)
+
+
+def test_entries_on_one_line():
+    bullets, _ = parse_bullets('[{"key": "one"}, {"key": "two"}]')
+    assert bullets == ['* one', '* two']
+
+
+def test_empty_entry_is_dropped():
+    bullets, stats = parse_bullets('[\n{"key": ""}\n{"key": "kept"}\n]')
+    assert bullets == ['* kept']
+    assert stats.dropped == 1
+
+
+def test_structured_response():
+    assert parse_structured_bullets(make_response(BULLETS, True, None, 0.5)) == EXPECTED
+    assert parse_structured_bullets('["one", " ", "two"]') == ['* one', '* two']
+    assert parse_structured_bullets('{"bullets": [1, 2]}') is None
+    assert parse_structured_bullets('not json') is None
+
+
+def test_structured_response_falls_back_to_the_tolerant_parser():
+    bullets, stats = parse_summary(make_response(BULLETS, True, 'truncated', 0.5), structured=True)
+    assert bullets[:2] == EXPECTED[:2]
+    assert stats.fallbacks == 1
+
+    bullets, stats = parse_summary(make_response(BULLETS, True, None, 0.5), structured=True)
+    assert bullets == EXPECTED
+    assert (stats.clean, stats.fallbacks) == (5, 0)
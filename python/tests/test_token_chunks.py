@@ -0,0 +1,39 @@
+import pytest
+
+from text_samples import WORDS, make_text, split_randomly
+from utils import chat_utils
+from utils.chat_utils import TokenChunker, iter_chunks, split_into_token_chunks
+
+
+@pytest.fixture(autouse=True)
+def estimated_tokens(monkeypatch):
+    # Count tokens with the estimator, so the tests neither need nor load a tokenizer.
+    monkeypatch.setattr(chat_utils, '_tokenizer', None)
+    monkeypatch.setattr(chat_utils, '_tokenizer_loaded', True)
+
+
+def test_streamed_chunks_match_one_piece():
+    text = make_text(2000)
+    streamed = [str(chunk) for chunk in iter_chunks(split_randomly(text), TokenChunker(150, 20))]
+    assert streamed == [str(chunk) for chunk in split_into_token_chunks(text, 150, 20)]
+
+
+def test_token_chunks():
+    text = make_text(3000)
+    chunks = split_into_token_chunks(text, 150, 20)
+    for number, chunk in enumerate(chunks):
+        assert chunk.tokens <= 150
+        # Chunks are made of whole sentences.
+        assert str(chunk).endswith('.')
+        if number:
+            assert str(chunk)[0].isupper()
+    # The chunks cover the whole text.
+    assert str(chunks[0]) == text[:len(str(chunks[0]))]
+    assert text.endswith(str(chunks[-1]))
+
+
+def test_token_chunks_of_text_without_sentences():
+    text = ' '.join(WORDS * 200)
+    chunks = split_into_token_chunks(text, 100, 10)
+    assert all(chunk.tokens <= 100 for chunk in chunks)
+    assert ' '.join(str(chunk) for chunk in chunks).split()[-1] == WORDS[-1]
@@ -0,0 +1,22 @@
+import base64
+
+import pytest
+
+from utils.chat_utils import load_tokenizer_file
+
+
+# A tiny encoding: every byte, plus the merges "he" and "hel".
+def write_encoding(path):
+    ranks = [bytes([i]) for i in range(256)] + [b'he', b'hel']
+    path.write_text(''.join(f"{base64.b64encode(token).decode()} {rank}\n" for rank, token in enumerate(ranks)))
+    return str(path)
+
+
+def test_load_tokenizer_file(tmp_path):
+    encoding = load_tokenizer_file(write_encoding(tmp_path / "tiny.tiktoken"), expected_sha256=None)
+    assert encoding.encode("hello") == [257, ord('l'), ord('o')]
+
+
+def test_load_tokenizer_file_checks_the_hash(tmp_path):
+    with pytest.raises(ValueError):
+        load_tokenizer_file(write_encoding(tmp_path / "tiny.tiktoken"))
@@ -0,0 +1,25 @@
+from text_samples import make_text, split_randomly
+from utils.chat_utils import WordChunker, iter_chunks, split_into_chunks
+
+
+def test_streamed_chunks_match_one_piece():
+    text = make_text(2000)
+    streamed = [str(chunk) for chunk in iter_chunks(split_randomly(text), WordChunker(100, 10))]
+    assert streamed == [str(chunk) for chunk in split_into_chunks(text, 100, 10)]
+
+
+def test_word_chunks():
+    text = make_text(1000)
+    words = text.split()
+    chunks = [str(chunk).split() for chunk in split_into_chunks(text, 100, 10)]
+    # Every chunk but the last has chunk_size words and starts overlap words before the
+    # end of the previous one; the last one runs to the end of the text.
+    for number, chunk in enumerate(chunks[:-1]):
+        assert chunk == words[number * 90:number * 90 + 100]
+    assert chunks[-1] == words[(len(chunks) - 1) * 90:]
+    assert 0 < len(chunks[-1]) <= 110
+
+
+def test_word_chunks_of_short_text():
+    assert [str(chunk) for chunk in split_into_chunks("just a few words", 100, 10)] == ["just a few words"]
+    assert split_into_chunks("   ", 100, 10) == []
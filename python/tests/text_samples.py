@@ -0,0 +1,26 @@
+import random
+
+WORDS = "the of and model summary chunk token journal page cache server limit".split()
+
+
+# Text of about `words` words in sentences of 3 to 15 words and paragraphs of a few sentences.
+def make_text(words, seed=0):
+    rng = random.Random(seed)
+    paragraphs = []
+    count = 0
+    while count < words:
+        sentences = []
+        for _ in range(rng.randint(1, 5)):
+            length = rng.randint(3, 15)
+            sentences.append(' '.join(rng.choice(WORDS) for _ in range(length)).capitalize() + '.')
+            count += length
+        paragraphs.append(' '.join(sentences))
+    return '\n\n'.join(paragraphs)
+
+
+# Cut text into pieces at random places (inside words, between the two newlines of a
+# paragraph break, ...), the way iter_text and iter_pdf_pages feed it to a chunker.
+def split_randomly(text, seed=0):
+    rng = random.Random(seed)
+    cuts = sorted(rng.sample(range(1, len(text)), 40))
+    return [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
@@ -1,7 +1,22 @@
 import re
+import io
 import os
+import sys
 import json
-from typing import List, Dict, Tuple, Optional
+import time
+import zlib
+import hashlib
+import bisect
+import functools
+import threading
+import itertools
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar, Union
+from utils.llm_cache import make_key, get_default_cache, cache_disabled
+from utils.llm_metrics import get_metrics, NANOSECONDS
+from utils.llm_policy import LLMCallError, get_call_policy
 
 # Constants
 SUMMARY_PROMPT = """
@@ -17,120 +32,1051 @@ be on separate lines. For example, the output will look like:
 ]
 The key and bullet point should always be on a single line.
 """
+
+# Used with ollama's json output mode (format="json"), which guarantees syntactically
+# valid json; the bullets keep the {"key": ...} form so that a response that doesn't
+# match the expected shape can still go through the tolerant parser.
+JSON_SUMMARY_PROMPT = """
+You are a summarization machine. I will give you text, you will summarize the text as
+a list of bullet points where each bullet point identifies any important points.
+Answer with a json object with a single key "bullets" whose value is an array of maps
+with single key/value pairs where for each bullet the key is always "key". For example:
+
+{"bullets": [{"key": "<the bullet point>"}, {"key": "<the bullet point>"}]}
+"""
+
+# Used to combine the bullets of several chunks into higher level bullets.
+REDUCE_PROMPT = """
+You are a summarization machine. I will give you a list of bullet points that summarize
+consecutive parts of a larger document; you will combine them into a shorter list of
+bullet points that identifies the most important points of the whole.
+The output should be in the form of a json array of maps with single key/value pairs
+where for each bullet the key is always "key"; the beginning and ending brackets should
+be on separate lines. For example, the output will look like:
+
+[
+{"key": "<the bullet point>"}
+{"key": "<the bullet point>"}
+]
+The key and bullet point should always be on a single line.
+"""
+
 timestamp_pattern = r'\[(\d{2}:)?\d{2}:\d{2}\.\d{3} --> (\d{2}:)?\d{2}:\d{2}\.\d{3}\]'
 
 # The youtube transcript timestamps look like (27:16) or (1:27:16)
 youtube_timestamp_pattern = r'\((\d{1,2}:)?\d{2}:\d{2}\)'
 
+timestamp_re = re.compile(timestamp_pattern)
+youtube_timestamp_re = re.compile(youtube_timestamp_pattern)
+
+# Number of chunks summarized at the same time.  Match this to the number of requests
+# the ollama server handles in parallel (OLLAMA_NUM_PARALLEL); going beyond that only
+# queues requests on the server.
+DEFAULT_WORKERS = 1
+
+# The ollama server to use and how long (in seconds) to wait for it to answer.
+# OLLAMA_HOST is the same variable the ollama cli uses.
+DEFAULT_OLLAMA_HOST = 'http://localhost:11434'
+DEFAULT_OLLAMA_TIMEOUT = 300.0
+
+# Model options sent with every ollama request.
+OLLAMA_OPTIONS = {
+    "temperature": 0.7
+}
+
+# Connections kept open per ollama host; this should be at least the number of workers.
+OLLAMA_MAX_CONNECTIONS = 32
+
+# How long ollama keeps the model loaded after a request: a duration like "30m" or a
+# number of seconds ("-1" keeps it loaded, "0" unloads it at once).  LLM_KEEP_ALIVE
+# overrides the program's default (see set_default_keep_alive); with neither, the
+# server's OLLAMA_KEEP_ALIVE (5 minutes unless set) applies.  Interactive programs keep
+# the model loaded for INTERACTIVE_KEEP_ALIVE so a reply after a pause isn't slowed
+# down by loading it again.
+INTERACTIVE_KEEP_ALIVE = "30m"
+
+# Failed ollama requests return (or, when streaming, yield) a line starting with this
+# instead of a summary; OPENAI_ERROR_PREFIX is the same for OpenAI compatible servers.
+OLLAMA_ERROR_PREFIX = "Error in ollama server"
+OPENAI_ERROR_PREFIX = "Error in OpenAI API"
+
+# The backend (LLM_BACKEND: "ollama" or "openai") and model (LLM_MODEL) used for
+# summaries, and the most tokens a summary may use.
+DEFAULT_BACKEND = "ollama"
+DEFAULT_OLLAMA_MODEL = "llama3:8b"
+DEFAULT_OPENAI_MODEL = "gpt-3.5-turbo"
+SUMMARY_MAX_TOKENS = 500
+OPENAI_TEMPERATURE = 0.5
+
+# When OLLAMA_HOSTS lists several ollama servers (comma separated), a server whose
+# request fails is skipped for HOST_RETRY_SECONDS, doubled for every consecutive failure
+# up to HOST_MAX_RETRY_SECONDS.  Servers are checked with a request that must answer
+# within HEALTH_CHECK_TIMEOUT seconds before they are first used.
+HOST_RETRY_SECONDS = 5.0
+HOST_MAX_RETRY_SECONDS = 120.0
+HEALTH_CHECK_TIMEOUT = 5.0
+
+# Limit on the number of words of bullets summarized together when reducing chunk
+# summaries; a batch plus the prompt must fit in the model's context window.  The
+# number of reduce levels is capped in case the model doesn't shorten its input.
+DEFAULT_REDUCE_WORDS = 2000
+MAX_REDUCE_LEVELS = 5
+
+T = TypeVar('T')
+R = TypeVar('R')
+
 
 # Function to load text from a file or pdf
-# Returns a list of strings (text) and the number of pages (num_pages)
+# Returns a list of strings (text) and the number of pages (num_pages).  For a pdf, only
+# the pages from page_start to page_end (1-based, inclusive) are extracted.  A file that
+# can't be read raises; the caller decides how to report it.
 def load_text(file, page_start=None, page_end=None):
+    if file.name.endswith('.pdf'):
+        data = file.getvalue() if hasattr(file, 'getvalue') else file.read()
+        # Hash and parse the pdf once for both the page count and the pages.
+        digest = hashlib.sha256(data).hexdigest()
+        cache = _pdf_cache(True)
+        num_pages, reader = _pdf_page_count(data, digest, cache)
+        pages_text = list(_iter_pdf_pages(data, digest, cache, num_pages, reader, page_start, page_end))
+        return pages_text, num_pages
+
+    return [file.read().decode('utf-8')], None
+
+# Pdf pages are extracted by a pool of processes (PyPDF2 is pure python so threads don't
+# help); each task extracts this many consecutive pages.
+PDF_PAGES_PER_TASK = 8
+
+# Each pool process parses the pdf once, when it starts.
+_pdf_reader: Any = None
+
+def _init_pdf_worker(data: bytes) -> None:
+    global _pdf_reader
+    import PyPDF2
+    _pdf_reader = PyPDF2.PdfReader(io.BytesIO(data))
+
+def _extract_pdf_pages(page_numbers: List[int]) -> List[str]:
+    return [_pdf_reader.pages[page_num].extract_text() for page_num in page_numbers]
+
+def process_pool(workers: int, **kwargs) -> ProcessPoolExecutor:
+    """
+    Return a pool of `workers` processes.  They are spawned rather than forked: a fork
+    of a process with other threads (e.g., the streamlit server, or a thread pool of
+    ours) can inherit locks that are held and then never released.
+    """
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), **kwargs)
+
+# Return the disk cache for pdf pages, or None if it is off.
+def _pdf_cache(use_cache: bool):
+    return get_default_cache() if use_cache and not cache_disabled() else None
+
+# Return the number of pages of the pdf with the given digest and the reader that had to
+# parse it to find out (None if the count was cached).
+def _pdf_page_count(data: bytes, digest: str, cache) -> Tuple[int, Any]:
+    key = make_key("pdf-pages", digest)
+    count = cache.get(key) if cache is not None else None
+    if count is not None:
+        return int(count), None
+    import PyPDF2
+    reader = PyPDF2.PdfReader(io.BytesIO(data))
+    if cache is not None:
+        cache.put(key, str(len(reader.pages)))
+    return len(reader.pages), reader
+
+def pdf_page_count(data: bytes, use_cache: bool = True) -> int:
+    """Return the number of pages of a pdf; cached on disk like its pages (see iter_pdf_pages)."""
+    return _pdf_page_count(data, hashlib.sha256(data).hexdigest(), _pdf_cache(use_cache))[0]
+
+def iter_pdf_pages(data: bytes, page_start: Optional[int] = None, page_end: Optional[int] = None,
+                   workers: Optional[int] = None, use_cache: bool = True) -> Iterator[str]:
+    """
+    Yield the text of pages page_start to page_end (1-based, inclusive) of the pdf in
+    data, in page order.
+
+    Page text (and the page count) is cached on disk keyed by the hash of the pdf and
+    the page number, so pages that were extracted before (e.g., on a previous Streamlit
+    rerun) are not extracted again, and a pdf whose pages are all cached isn't even
+    parsed.  Pages that are not cached are extracted by a pool of `workers` processes
+    (default: one per cpu, see process_pool), a batch of pages at a time so memory use
+    does not grow with the size of the pdf; a few pages are extracted in this process.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    cache = _pdf_cache(use_cache)
+    num_pages, reader = _pdf_page_count(data, digest, cache)
+    yield from _iter_pdf_pages(data, digest, cache, num_pages, reader, page_start, page_end, workers)
+
+# iter_pdf_pages for a pdf whose digest and page count are already known; reader is the
+# PdfReader that parsed it, if any.
+def _iter_pdf_pages(data: bytes, digest: str, cache, num_pages: int, reader: Any,
+                    page_start: Optional[int] = None, page_end: Optional[int] = None,
+                    workers: Optional[int] = None) -> Iterator[str]:
     import PyPDF2
+
+    if page_start is None:
+        page_start = 1
+    if page_end is None or page_end > num_pages:
+        page_end = num_pages
+    workers = workers or os.cpu_count() or 1
+
+    pool = None
+    batch_size = workers * PDF_PAGES_PER_TASK
     try:
-        if file.name.endswith('.pdf'):
-            pdf_reader = PyPDF2.PdfReader(file)
-            pages_text = []
-            num_pages = len(pdf_reader.pages)
-            if page_start is None:
-                page_start = 1
-            if page_end is None or page_end > num_pages:
-                page_end = num_pages
-            for page_num in range(page_start - 1, page_end):
-                page = pdf_reader.pages[page_num]
-                pages_text.append(page.extract_text())
-            return pages_text, num_pages
-
-        return [file.read().decode('utf-8')], None
-    except Exception as e:
-        st.error(f"Error loading file: {str(e)}")
-        return None, None
-
-# Function to split text into chunks
-def split_into_chunks(text, chunk_size, overlap):
-    words = text.split()
-    chunks = []
-    start = 0
-    while start < len(words):
-        end = start + chunk_size
-        chunk = words[start:end]
-        chunks.append(' '.join(chunk))
-        start = end - overlap
-
-    if len(chunks) > 1 and len(chunks[-1].split()) < overlap:
-        chunks[-2] += ' ' + chunks[-1]
-        chunks.pop()
-    return chunks
+        for batch_start in range(page_start - 1, page_end, batch_size):
+            page_numbers = range(batch_start, min(batch_start + batch_size, page_end))
+            texts: Dict[int, str] = {}
+            if cache is not None:
+                for page_num in page_numbers:
+                    text = cache.get(make_key("pdf-page", digest, page_num))
+                    if text is not None:
+                        texts[page_num] = text
+            missing = [page_num for page_num in page_numbers if page_num not in texts]
 
-# Function to process chunks and generate summaries
-def process_chunks(text, chunk_size, overlap):
-    chunks = split_into_chunks(text, chunk_size, overlap)
-    responses = []
+            if not missing:
+                extracted = []
+            elif len(missing) <= PDF_PAGES_PER_TASK or workers <= 1:
+                # Not worth starting processes for a few pages.
+                if reader is None:
+                    reader = PyPDF2.PdfReader(io.BytesIO(data))
+                extracted = [reader.pages[page_num].extract_text() for page_num in missing]
+            else:
+                if pool is None:
+                    pool = process_pool(workers, initializer=_init_pdf_worker, initargs=(data,))
+                tasks = [missing[i:i + PDF_PAGES_PER_TASK] for i in range(0, len(missing), PDF_PAGES_PER_TASK)]
+                extracted = [text for task_texts in pool.map(_extract_pdf_pages, tasks) for text in task_texts]
+
+            for page_num, text in zip(missing, extracted):
+                texts[page_num] = text
+                if cache is not None:
+                    cache.put(make_key("pdf-page", digest, page_num), text)
+            for page_num in page_numbers:
+                yield texts[page_num]
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+class Chunk:
+    """
+    A chunk of text given by its (start, end) character offsets into the source text.
+    The chunk's text is only copied out of the source when it is needed (e.g., when it
+    is sent to the model), and the offsets let callers search the source directly.
+    tokens is the chunk's token count when it is known (0 otherwise).
+    """
+    __slots__ = ('source', 'start', 'end', 'tokens')
+
+    def __init__(self, source: str, start: int, end: int, tokens: int = 0) -> None:
+        self.source = source
+        self.start = start
+        self.end = end
+        self.tokens = tokens
+
+    @property
+    def text(self) -> str:
+        return self.source[self.start:self.end]
+
+    def search(self, pattern: 're.Pattern[str]') -> Optional['re.Match[str]']:
+        """Search for a compiled pattern within the chunk without copying its text."""
+        return pattern.search(self.source, self.start, self.end)
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+    def __str__(self) -> str:
+        return self.text
+
+    def __repr__(self) -> str:
+        return f"Chunk({self.start}, {self.end}, tokens={self.tokens})"
+
+# Token counts come from OpenAI's cl100k_base encoding, which is close to but not the
+# same as llama3's tokenizer, so for ollama models they are approximate.  The encoding is
+# read from a local copy of its file (LLM_TOKENIZER_FILE, by default
+# ~/.cache/tiktoken/cl100k_base.tiktoken, see the README) that must match
+# TOKENIZER_SHA256; it is never downloaded.  Without it, counts are estimated at
+# CHARS_PER_TOKEN characters per token.
+TOKENIZER_ENCODING = "cl100k_base"
+TOKENIZER_SHA256 = "223921b76ee99bde995b7ff738513eef100fb51d18c93597a113bcffe865b2a7"
+DEFAULT_TOKENIZER_FILE = os.path.join(os.path.expanduser("~"), ".cache", "tiktoken", "cl100k_base.tiktoken")
+CHARS_PER_TOKEN = 4
+
+# The rest of the cl100k_base definition (as in tiktoken_ext.openai_public).
+CL100K_PATTERN = r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]++[\r\n]*|\s*[\r\n]|\s+(?!\S)|\s+"""
+CL100K_SPECIAL_TOKENS = {
+    "<|endoftext|>": 100257,
+    "<|fim_prefix|>": 100258,
+    "<|fim_middle|>": 100259,
+    "<|fim_suffix|>": 100260,
+    "<|endofprompt|>": 100276,
+}
+
+_tokenizer: Any = None
+_tokenizer_loaded = False
+_tokenizer_lock = threading.Lock()
+
+def load_tokenizer_file(path: str, expected_sha256: Optional[str] = TOKENIZER_SHA256) -> Any:
+    """
+    Return the tiktoken encoding in a .tiktoken file (one "<base64 token> <rank>" per
+    line).  Raises ValueError if the file isn't the expected one.
+    """
+    import base64
+    import tiktoken
+    with open(path, 'rb') as file:
+        data = file.read()
+    if expected_sha256 is not None and hashlib.sha256(data).hexdigest() != expected_sha256:
+        raise ValueError(f"{path} is not the {TOKENIZER_ENCODING} encoding (sha256 mismatch)")
+    ranks = {base64.b64decode(token): int(rank) for token, rank in (line.split() for line in data.splitlines() if line)}
+    return tiktoken.Encoding(name=TOKENIZER_ENCODING, pat_str=CL100K_PATTERN, mergeable_ranks=ranks,
+                             special_tokens=CL100K_SPECIAL_TOKENS)
+
+def get_tokenizer() -> Any:
+    """
+    Return the cl100k_base tiktoken encoding, or None if tiktoken or the encoding file
+    isn't available (counts are estimated then).  Either way counts are approximate
+    for models other than OpenAI's (e.g., llama3 has its own tokenizer); they are good
+    enough to size chunks with some headroom.
+    """
+    global _tokenizer, _tokenizer_loaded
+    with _tokenizer_lock:
+        if not _tokenizer_loaded:
+            _tokenizer_loaded = True
+            path = os.getenv("LLM_TOKENIZER_FILE") or DEFAULT_TOKENIZER_FILE
+            try:
+                _tokenizer = load_tokenizer_file(path)
+            except Exception as e:
+                print(f"Using estimated token counts ({CHARS_PER_TOKEN} chars per token); could not load tokenizer: {e}", file=sys.stderr)
+                _tokenizer = None
+        return _tokenizer
+
+def count_tokens(text: str) -> int:
+    tokenizer = get_tokenizer()
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, disallowed_special=()))
+    return estimate_tokens(text)
+
+# A cheap estimate for reports, where loading and running the tokenizer isn't worth it.
+def estimate_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+_word_re = re.compile(r'\S+')
+
+# A sentence ends with ., ! or ? followed by whitespace; paragraphs are separated by blank lines.
+_sentence_boundary_re = re.compile(r'(?<=[.!?])\s+|\n\s*\n')
+_paragraph_re = re.compile(r'\n\s*\n')
+
+class TextBuffer:
+    """
+    The not yet chunked tail of a stream of text.  Positions are offsets into the
+    whole stream; text before the oldest position still needed is dropped by trim()
+    so the buffer stays about one chunk plus one piece in size no matter how long
+    the stream is.
+    """
+    def __init__(self) -> None:
+        self.text = ''
+        self.base = 0
+
+    def append(self, piece: str) -> None:
+        self.text += piece
+
+    @property
+    def end(self) -> int:
+        return self.base + len(self.text)
+
+    def chunk(self, start: int, end: int, tokens: int = 0) -> Chunk:
+        return Chunk(self.text, start - self.base, end - self.base, tokens)
+
+    def slice(self, start: int, end: int) -> str:
+        return self.text[start - self.base:end - self.base]
+
+    def trim(self, keep_from: int) -> None:
+        if keep_from > self.base:
+            self.text = self.text[keep_from - self.base:]
+            self.base = keep_from
+
+class WordChunker:
+    """
+    Split text, fed to it piece by piece, into chunks of chunk_size words where each
+    chunk overlaps the previous one by overlap words.  Only the word offsets of the
+    current chunk are kept.  The last chunk always runs to the end of the text, so
+    there is never a dangling last chunk with only a few words in it.
+    """
+    def __init__(self, chunk_size: int, overlap: int) -> None:
+        self.chunk_size = max(1, chunk_size)
+        self.step = max(1, chunk_size - overlap)
+        self.buffer = TextBuffer()
+        self.window: Deque[Tuple[int, int]] = deque()
+        self.scanned = 0
+
+    def feed(self, piece: str) -> List[Chunk]:
+        self.buffer.append(piece)
+        return self._scan(final=False)
+
+    def finish(self) -> List[Chunk]:
+        chunks = self._scan(final=True)
+        if self.window:
+            chunks.append(self.buffer.chunk(self.window[0][0], self.window[-1][1]))
+            self.window.clear()
+        return chunks
+
+    def _scan(self, final: bool) -> List[Chunk]:
+        chunks = []
+        buffer = self.buffer
+        for match in _word_re.finditer(buffer.text, self.scanned - buffer.base):
+            # A word that touches the end of the buffer may continue in the next piece.
+            if not final and match.end() == len(buffer.text):
+                break
+            self.window.append((buffer.base + match.start(), buffer.base + match.end()))
+            self.scanned = buffer.base + match.end()
+            # A word past the end of the chunk means this is not the last chunk.
+            if len(self.window) > self.chunk_size:
+                chunks.append(buffer.chunk(self.window[0][0], self.window[self.chunk_size - 1][1]))
+                for _ in range(self.step):
+                    self.window.popleft()
+        buffer.trim(self.window[0][0] if self.window else self.scanned)
+        return chunks
+
+# A unit is a (start, end, tokens, starts_paragraph) span of the text.
+Unit = Tuple[int, int, int, bool]
+
+class TokenChunker:
+    """
+    Split text, fed to it piece by piece, into chunks of at most max_tokens tokens;
+    each chunk's token count is in its tokens attribute.
+
+    Chunks are built from whole sentences; once a chunk is at least three quarters
+    full it is ended at the next paragraph boundary rather than in the middle of a
+    paragraph.  Each chunk starts with the trailing sentences of the previous chunk
+    that fit in overlap_tokens.  The token count of a chunk is the sum of its
+    sentences' counts, which is within a token or two per sentence of the count
+    for the chunk's text.
+    """
+    def __init__(self, max_tokens: int, overlap_tokens: int) -> None:
+        self.max_tokens = max(1, max_tokens)
+        self.overlap_tokens = overlap_tokens
+        # Long runs of text without sentence ends are cut into pieces no bigger than
+        # the overlap so that the overlap can still be made of whole pieces.
+        self.piece_tokens = max(1, min(max_tokens // 4, overlap_tokens) if overlap_tokens > 0 else max_tokens // 4)
+        self.buffer = TextBuffer()
+        self.scanned = 0
+        self.starts_paragraph = True
+        self.current: List[Unit] = []
+        self.current_tokens = 0
+        self.new_units = 0
+        # The last (start, end, tokens) chunk is held back so that a small final chunk
+        # can be folded into it.
+        self.held: Optional[Tuple[int, int, int]] = None
+
+    def feed(self, piece: str) -> List[Chunk]:
+        self.buffer.append(piece)
+        return self._scan(final=False)
+
+    def finish(self) -> List[Chunk]:
+        chunks = self._scan(final=True)
+        if self.new_units:
+            tail_tokens = sum(unit[2] for unit in self.current[-self.new_units:])
+            held = self.held
+            if held is not None and tail_tokens < self.overlap_tokens and held[2] + tail_tokens <= self.max_tokens:
+                self.held = (held[0], self.current[-1][1], held[2] + tail_tokens)
+            else:
+                self._hold(chunks, (self.current[0][0], self.current[-1][1], self.current_tokens))
+        if self.held is not None:
+            chunks.append(self.buffer.chunk(self.held[0], self.held[1], self.held[2]))
+            self.held = None
+        return chunks
+
+    def _scan(self, final: bool) -> List[Chunk]:
+        chunks: List[Chunk] = []
+        buffer = self.buffer
+        for boundary in _sentence_boundary_re.finditer(buffer.text, self.scanned - buffer.base):
+            # Whitespace that touches the end of the buffer may continue in the next
+            # piece (and turn out to be a paragraph break).
+            if not final and boundary.end() == len(buffer.text):
+                break
+            for unit in self._sentence_units(self.scanned, buffer.base + boundary.start()):
+                self._add_unit(chunks, unit)
+            if _paragraph_re.search(boundary.group()):
+                self.starts_paragraph = True
+            self.scanned = buffer.base + boundary.end()
+        if final:
+            for unit in self._sentence_units(self.scanned, buffer.end):
+                self._add_unit(chunks, unit)
+            self.scanned = buffer.end
+
+        keep_from = self.scanned
+        if self.current:
+            keep_from = min(keep_from, self.current[0][0])
+        if self.held is not None:
+            keep_from = min(keep_from, self.held[0])
+        buffer.trim(keep_from)
+        return chunks
+
+    # Return the units for the sentence between start and end (stream offsets).  A
+    # sentence longer than max_tokens is split on words into pieces of about
+    # piece_tokens tokens.
+    def _sentence_units(self, start: int, end: int) -> List[Unit]:
+        text = self.buffer.text
+        base = self.buffer.base
+        first_word = _word_re.search(text, start - base, end - base)
+        if first_word is None:
+            return []
+        start = base + first_word.start()
+        while text[end - base - 1].isspace():
+            end -= 1
+        starts_paragraph = self.starts_paragraph
+        self.starts_paragraph = False
+
+        tokens = count_tokens(self.buffer.slice(start, end))
+        if tokens <= self.max_tokens:
+            return [(start, end, tokens, starts_paragraph)]
+
+        # Sentence too long for one chunk (e.g., a transcript without punctuation).
+        units: List[Unit] = []
+        words = [(base + match.start(), base + match.end()) for match in _word_re.finditer(text, start - base, end - base)]
+        step = max(1, len(words) * self.piece_tokens // tokens)
+        i = 0
+        while i < len(words):
+            piece_start = words[i][0]
+            piece_end = words[min(i + step, len(words)) - 1][1]
+            piece_count = count_tokens(self.buffer.slice(piece_start, piece_end))
+            if piece_count > self.max_tokens and step > 1:
+                step = step // 2
+                continue
+            units.append((piece_start, piece_end, piece_count, starts_paragraph and i == 0))
+            i += step
+        return units
+
+    def _add_unit(self, chunks: List[Chunk], unit: Unit) -> None:
+        tokens = unit[2]
+        full = self.current_tokens + tokens > self.max_tokens
+        at_paragraph = unit[3] and self.current_tokens >= self.max_tokens * 3 // 4
+        if self.new_units and (full or at_paragraph):
+            self._hold(chunks, (self.current[0][0], self.current[-1][1], self.current_tokens))
+            # Carry the trailing sentences that fit in the overlap into the next chunk.
+            overlap: List[Unit] = []
+            overlap_total = 0
+            for previous in reversed(self.current):
+                if overlap_total + previous[2] > self.overlap_tokens or overlap_total + previous[2] + tokens > self.max_tokens:
+                    break
+                overlap.insert(0, previous)
+                overlap_total += previous[2]
+            self.current = overlap
+            self.current_tokens = overlap_total
+            self.new_units = 0
+        self.current.append(unit)
+        self.current_tokens += tokens
+        self.new_units += 1
+
+    # Hold back a finished chunk and release the previously held one.
+    def _hold(self, chunks: List[Chunk], span: Tuple[int, int, int]) -> None:
+        if self.held is not None:
+            chunks.append(self.buffer.chunk(self.held[0], self.held[1], self.held[2]))
+        self.held = span
+
+# Content defined chunk boundaries (see ContentChunker): a chunk ends at the word, among
+# those that would leave it with at least BOUNDARY_MIN_FILL of the words it has room
+# for, whose last BOUNDARY_WORDS words (itself included) hash to the lowest value,
+# preferring words that end a sentence.
+BOUNDARY_WORDS = 4
+BOUNDARY_MIN_FILL = 0.5
+
+_sentence_end_re = re.compile(r'[.!?]["\')\]]*$')
+
+class ContentChunker:
+    """
+    Split text, fed to it piece by piece, into chunks of at most chunk_size words that
+    overlap by overlap words, like WordChunker, but end the chunks where the text says
+    so rather than at fixed word offsets.  An edit then only changes the chunk it is in
+    (and sometimes the next one or two) instead of shifting every later chunk, so the
+    other chunks keep their text and their cached or journaled summaries.
+
+    Once a chunk is full, it is ended at the sentence end (or, in text without any,
+    the word) with the lowest hash among those that leave it at least BOUNDARY_MIN_FILL
+    full; the words after it start the next chunk.  The hash only depends on the words around a
+    boundary, so after an edit the chunks soon pick the same boundaries as before.  As
+    with WordChunker, a short last chunk is folded into the one before it when they fit
+    in chunk_size words together.
+    """
+    def __init__(self, chunk_size: int, overlap: int) -> None:
+        self.chunk_size = max(1, chunk_size)
+        self.overlap = max(0, min(overlap, self.chunk_size - 1))
+        self.buffer = TextBuffer()
+        # (start, end, rank) of each word of the current chunk, the first `carried` of
+        # which are the overlap with the previous chunk.  The word with the lowest rank
+        # is the best place to end a chunk.
+        self.window: List[Tuple[int, int, int]] = []
+        self.carried = 0
+        self.recent: Deque[str] = deque(maxlen=BOUNDARY_WORDS)
+        self.scanned = 0
+        # The last (start, end, words) chunk is held back so that a short last chunk
+        # can be folded into it.
+        self.held: Optional[Tuple[int, int, int]] = None
+
+    def feed(self, piece: str) -> List[Chunk]:
+        self.buffer.append(piece)
+        return self._scan(final=False)
+
+    def finish(self) -> List[Chunk]:
+        chunks = self._scan(final=True)
+        if len(self.window) > self.carried:
+            held = self.held
+            tail_words = len(self.window) - self.carried
+            if held is not None and tail_words < self._min_new() and held[2] + tail_words <= self.chunk_size:
+                self.held = (held[0], self.window[-1][1], held[2] + tail_words)
+            else:
+                self._hold(chunks, (self.window[0][0], self.window[-1][1], len(self.window)))
+        if self.held is not None:
+            chunks.append(self.buffer.chunk(self.held[0], self.held[1]))
+            self.held = None
+        self.window = []
+        return chunks
+
+    def _scan(self, final: bool) -> List[Chunk]:
+        chunks: List[Chunk] = []
+        buffer = self.buffer
+        for match in _word_re.finditer(buffer.text, self.scanned - buffer.base):
+            # A word that touches the end of the buffer may continue in the next piece.
+            if not final and match.end() == len(buffer.text):
+                break
+            word = match.group()
+            self.recent.append(word)
+            self.scanned = buffer.base + match.end()
+            self.window.append((buffer.base + match.start(), self.scanned, self._rank(word)))
+            if len(self.window) >= self.chunk_size:
+                self._cut(chunks)
+        keep_from = self.window[0][0] if self.window else self.scanned
+        if self.held is not None:
+            keep_from = min(keep_from, self.held[0])
+        buffer.trim(keep_from)
+        return chunks
+
+    def _rank(self, word: str) -> int:
+        # crc32 rather than hash() so that the boundaries are the same in every run.
+        digest = zlib.crc32(' '.join(self.recent).encode('utf-8'))
+        return digest if _sentence_end_re.search(word) else digest + (1 << 32)
+
+    # The fewest new words (after the overlap) the current chunk may end with.
+    def _min_new(self) -> int:
+        return max(1, int((self.chunk_size - self.carried) * BOUNDARY_MIN_FILL))
+
+    # End the full current chunk at its best boundary.
+    def _cut(self, chunks: List[Chunk]) -> None:
+        first = self.carried + self._min_new() - 1
+        words = min(range(first, len(self.window)), key=lambda i: self.window[i][2]) + 1
+        self._hold(chunks, (self.window[0][0], self.window[words - 1][1], words))
+        self.carried = min(self.overlap, words)
+        self.window = self.window[words - self.carried:]
+
+    # Hold back a finished chunk and release the previously held one.
+    def _hold(self, chunks: List[Chunk], span: Tuple[int, int, int]) -> None:
+        if self.held is not None:
+            chunks.append(self.buffer.chunk(self.held[0], self.held[1]))
+        self.held = span
+
+Chunker = Union[WordChunker, TokenChunker, ContentChunker]
+
+def iter_chunks(pieces: Iterable[str], chunker: Chunker) -> Iterator[Chunk]:
+    """
+    Feed pieces of text (e.g., blocks of a file or the pages of a pdf) to a chunker and
+    yield each chunk as soon as it is complete, so chunks of a large input can be
+    summarized before the whole input has been read.
+    """
+    for piece in pieces:
+        yield from chunker.feed(piece)
+    yield from chunker.finish()
+
+# Function to split text into chunks of chunk_size words that overlap by overlap words.
+# Counting words stays the default; token budgets are opt-in (see split_into_token_chunks).
+def split_into_chunks(text: str, chunk_size: int, overlap: int) -> List[Chunk]:
+    return list(iter_chunks([text], WordChunker(chunk_size, overlap)))
+
+# Function to split text into chunks of at most max_tokens tokens (see TokenChunker).
+def split_into_token_chunks(text: str, max_tokens: int, overlap_tokens: int) -> List[Chunk]:
+    return list(iter_chunks([text], TokenChunker(max_tokens, overlap_tokens)))
+
+# Function to split text into chunks of at most chunk_size words whose boundaries stay
+# put when the text is edited elsewhere (see ContentChunker).
+def split_into_content_chunks(text: str, chunk_size: int, overlap: int) -> List[Chunk]:
+    return list(iter_chunks([text], ContentChunker(chunk_size, overlap)))
+
+def ordered_map(func: Callable[[T], R], items: Iterable[T], workers: int = DEFAULT_WORKERS,
+                executor: Optional[ThreadPoolExecutor] = None) -> Iterator[R]:
+    """
+    Yield func(item) for each item, in the same order as items, running up to
+    `workers` calls at once.  At most 2 * workers items are submitted ahead of the
+    one being consumed, so the caller can start using results before all items
+    have been read and the pool stays busy while the caller handles a result.
+    If executor is given, the calls run on it instead of on a pool of our own, so
+    several callers can share one pool (e.g. to summarize many files at once).  The
+    shared pool serves its calls first come first served, so each caller then only
+    keeps `workers` calls submitted: callers that keep their workers to their share
+    of the pool (see JobQueue.chunk_share) take turns on it chunk by chunk.
+    """
+    if executor is not None:
+        yield from _ordered_submit(func, items, workers, executor)
+        return
+
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        yield from _ordered_submit(func, items, 2 * workers, pool)
+
+def _ordered_submit(func: Callable[[T], R], items: Iterable[T], window: int, executor: ThreadPoolExecutor) -> Iterator[R]:
+    pending: Deque[Future] = deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= max(1, window):
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # If the caller stops early (e.g., a cancelled job), don't leave the calls it
+        # won't use queued on a shared executor.
+        for future in pending:
+            future.cancel()
+
+def summarize_chunks(chunks: Iterable[Union[str, Chunk]], summary_prompt: str, workers: int = DEFAULT_WORKERS,
+                     use_cache: bool = True, format: str = '',
+                     executor: Optional[ThreadPoolExecutor] = None) -> Iterator[Union[str, LLMCallError]]:
+    """
+    Summarize each chunk with the LLM and yield the raw responses in chunk order; a
+    chunk that could not be summarized (after the retries of the call policy) yields
+    its LLMCallError instead, so one failure doesn't lose the other chunks.
+    With workers > 1, chunks are sent to the ollama server concurrently.
+    A Chunk's text is only copied out of its source when it is sent.
+    """
+    def summarize(chunk: Union[str, Chunk]) -> Union[str, LLMCallError]:
+        try:
+            return call_ollama_api(str(chunk), summary_prompt, use_cache, format)
+        except LLMCallError as e:
+            return e
+
+    return ordered_map(summarize, chunks, workers, executor)
+
+# The summaries of the chunks are separated by a horizontal rule.
+CHUNK_SEPARATOR = "\n\n\n***"
+
+def join_summaries(parts: Iterable[str]) -> str:
+    return '\n\n'.join(parts)
+
+# Return the chunks that process_chunks will summarize (see there for the parameters).
+def plan_chunks(text, chunk_size, overlap, by_tokens=False, incremental=False) -> List[Chunk]:
+    if by_tokens:
+        return split_into_token_chunks(text, chunk_size, overlap)
+    if incremental:
+        return split_into_content_chunks(text, chunk_size, overlap)
+    return split_into_chunks(text, chunk_size, overlap)
+
+# Yield the summary of each chunk, in chunk order, as the markdown process_chunks puts in
+# its output (ending with the "***" that separates chunks), then the overall summary if
+# reduce is True.  The chunks (and the reduce batches) are summarized on executor if it
+# is given.
+def iter_chunk_summaries(chunks, workers=DEFAULT_WORKERS, use_cache=True, reduce=False, structured=False,
+                         executor=None) -> Iterator[str]:
+    chunk_bullets = []
 
-    for chunk in chunks:
-        raw_response = call_ollama_api(chunk, SUMMARY_PROMPT)
+    if structured:
+        raw_responses = summarize_chunks(chunks, JSON_SUMMARY_PROMPT, workers, use_cache, format='json', executor=executor)
+    else:
+        raw_responses = summarize_chunks(chunks, SUMMARY_PROMPT, workers, use_cache, executor=executor)
+    for number, (chunk, raw_response) in enumerate(zip(chunks, raw_responses), 1):
+
+        if isinstance(raw_response, LLMCallError):
+            print(f"Chunk {number} failed: {raw_response}")
+            yield failed_chunk_note(number, raw_response) + CHUNK_SEPARATOR
+            continue
 
         tmp_response = []
 
         # If this chunk has a timestamp on it (e.g., like a whisper timestamp),
         # let's print it to help guide the user to the original text.
-        match = re.search(timestamp_pattern, chunk)
+        match = chunk.search(timestamp_re)
         if match:
             tmp_response.append(match.group())
 
         # If this chunk has a youtube timestamp on it, let's print it to help
         # guide the user to the original text.
-        match = re.search(youtube_timestamp_pattern, chunk)
+        match = chunk.search(youtube_timestamp_re)
         if match:
             tmp_response.append(match.group())
 
-        errors_found = 0
-        for line in raw_response.split('\n'):
-            if '"key":' in line:
-
-                line = fixup_line(line)
-
-                try:
-                    data = json.loads(line)
-                except json.JSONDecodeError:
-                    # If we can't parse the line as JSON, just append it as is
-                    # to avoid losing data; we'll strip the key part to make it
-                    # look like an almost legitimate bullet point.
-                    bullet_point = '* ' + line.split('"key":')[1].strip()
-                    tmp_response.append(bullet_point)
-                    errors_found += 1
-                    continue
-                bullet_point = '* ' + data['key']
-                tmp_response.append(bullet_point)
-
-        print(f"Errors found: {errors_found}")
-        responses.append('\n'.join(tmp_response))
-        responses.append("\n***")
-
-    return '\n\n'.join(responses)
-
-# Function to fix up lines for JSON parsing
-def fixup_line(line):
-    line = re.sub(r'\{\s*\{+', '{', line)
-    line = re.sub(r'\}\s*\}+', '}', line)
-    line = line.replace('""}]', '"}')
-    line = line.replace('}]', '}')
-    line = line.replace('},', '')
-    if not line.startswith('{'):
-        line = '{' + line
-    if not line.endswith('}'):
-        line = line + '}'
-    line = line.replace('""}', '"}')
-    line = line.replace('}, }', '}')
-    if line.endswith(']'):
-        line = line[:-1]
-    line = line.replace('"} }', '"}')
-    return line
+        bullets, stats = parse_summary(raw_response, structured)
+        tmp_response.extend(bullets)
+        chunk_bullets.append(bullets)
+
+        print(f"Parsed {stats}")
+        yield '\n'.join(tmp_response) + CHUNK_SEPARATOR
+
+    if reduce and len(chunk_bullets) > 1:
+        overall = reduce_summaries(chunk_bullets, workers=workers, use_cache=use_cache, executor=executor)
+        yield "## Overall summary\n\n" + '\n'.join(overall)
+
+# Function to process chunks and generate summaries
+# If reduce is True, the per-chunk bullets are also combined into an overall summary
+# that is appended after the chunk summaries.
+# If by_tokens is True, chunk_size and overlap are numbers of tokens instead of words.
+# If structured is True, the model is asked for json output (see parse_structured_bullets).
+# If incremental is True, chunks end at content defined boundaries (see ContentChunker), so
+# after an edit to the text only the chunks around the edit miss the summary cache.
+def process_chunks(text, chunk_size, overlap, workers=DEFAULT_WORKERS, use_cache=True, reduce=False, by_tokens=False,
+                   structured=False, incremental=False):
+    chunks = plan_chunks(text, chunk_size, overlap, by_tokens, incremental)
+    return join_summaries(iter_chunk_summaries(chunks, workers, use_cache, reduce, structured))
+
+class ParseStats:
+    """
+    How the "key" entries of LLM responses were parsed: entries that were well formed
+    json (clean), entries that needed repairs to recover the bullet (repaired) and
+    entries with nothing to recover (dropped).  fallbacks counts json mode responses
+    that didn't have the expected shape and went through the tolerant parser.
+    """
+    __slots__ = ('entries', 'clean', 'repaired', 'dropped', 'fallbacks')
+
+    def __init__(self) -> None:
+        self.entries = 0
+        self.clean = 0
+        self.repaired = 0
+        self.dropped = 0
+        self.fallbacks = 0
+
+    def add(self, other: 'ParseStats') -> None:
+        self.entries += other.entries
+        self.clean += other.clean
+        self.repaired += other.repaired
+        self.dropped += other.dropped
+        self.fallbacks += other.fallbacks
+
+    def __str__(self) -> str:
+        text = f"{self.entries} bullets: {self.clean} clean, {self.repaired} repaired, {self.dropped} dropped"
+        if self.fallbacks:
+            text += f" ({self.fallbacks} json responses needed repair)"
+        return text
+
+_key_re = re.compile(r'"key"\s*:\s*')
+_escaped_quote_re = re.compile(r'(?<!\\)"')
+# What may follow the closing quote of a well formed entry: the closing brace and an
+# optional comma (more entries follow) or closing bracket (last entry).
+_clean_tail_re = re.compile(r'\s*\}\s*[,\]]?\s*$')
+# Characters the model puts around (or instead of) the braces of an entry.
+_entry_junk = ' \t\r,{}[]'
+
+def parse_bullets(raw_response: str) -> Tuple[List[str], ParseStats]:
+    """
+    Pull the "key" values out of an LLM response in one scan and return them as
+    bullet points ("* ...") along with parse statistics.
+
+    The model is asked for a json array of {"key": "..."} maps, one per line, but
+    often adds or drops braces, brackets, commas and quotes.  Rather than fixing up
+    each line until json.loads accepts it, each value is read directly: it runs from
+    after '"key":' to the end of the line (or the next '"key"' when the model put
+    several entries on one line), minus the surrounding braces, brackets, commas and
+    quotes.  Well formed values are decoded as json strings; quotes inside a value
+    that the model forgot to escape are kept as part of the bullet.
+    """
+    bullets = []
+    stats = ParseStats()
+    matches = list(_key_re.finditer(raw_response))
+    for i, match in enumerate(matches):
+        start = match.end()
+        end = raw_response.find('\n', start)
+        if end < 0:
+            end = len(raw_response)
+        if i + 1 < len(matches) and matches[i + 1].start() < end:
+            end = matches[i + 1].start()
+
+        stats.entries += 1
+        bullet, clean = parse_value(raw_response, start, end)
+        if not bullet:
+            stats.dropped += 1
+            continue
+        if clean:
+            stats.clean += 1
+        else:
+            stats.repaired += 1
+        bullets.append('* ' + bullet)
+    return bullets, stats
+
+def parse_structured_bullets(raw_response: str) -> Optional[List[str]]:
+    """
+    Return the bullets ("* ...") of a json mode response, or None if the response is
+    not of the form {"bullets": [{"key": "..."}, ...]}.  A plain array of strings or
+    of {"key": ...} maps (with or without the "bullets" wrapper) is accepted too.
+    """
+    try:
+        data = json.loads(raw_response)
+    except json.JSONDecodeError:
+        return None
+    if isinstance(data, dict):
+        data = data.get("bullets")
+    if not isinstance(data, list):
+        return None
+    bullets = []
+    for item in data:
+        if isinstance(item, dict):
+            item = item.get("key")
+        if not isinstance(item, str):
+            return None
+        if item.strip():
+            bullets.append('* ' + item.strip())
+    return bullets
+
+def parse_summary(raw_response: str, structured: bool = False) -> Tuple[List[str], ParseStats]:
+    """
+    Parse a summary response.  A json mode (structured) response is validated and
+    used directly; only when that fails does it go through the tolerant parser.
+    """
+    if structured:
+        bullets = parse_structured_bullets(raw_response)
+        if bullets is not None:
+            stats = ParseStats()
+            stats.entries = stats.clean = len(bullets)
+            return bullets, stats
+    bullets, stats = parse_bullets(raw_response)
+    if structured:
+        stats.fallbacks += 1
+    return bullets, stats
+
+# Return the bullet text of the value between start and end of text and whether the
+# value was well formed.
+def parse_value(text: str, start: int, end: int) -> Tuple[str, bool]:
+    value = text[start:end].rstrip(_entry_junk)
+    tail = text[start + len(value):end]
+    if len(value) >= 2 and value[0] == '"' and value[-1] == '"':
+        try:
+            decoded = json.loads(value)
+            if _clean_tail_re.match(tail) and isinstance(decoded, str):
+                return decoded.strip(), True
+        except json.JSONDecodeError:
+            pass
+    # Repair: drop the quotes around the value (including doubled ones like '""}') and
+    # escape any quotes inside it so it can still be decoded as a json string.
+    inner = value[1:] if value.startswith('"') else value
+    while inner.endswith('"') and not inner.endswith('\\"'):
+        inner = inner[:-1]
+    try:
+        return json.loads('"' + _escaped_quote_re.sub('\\"', inner) + '"').strip(), False
+    except json.JSONDecodeError:
+        return inner.strip(), False
+
+def reduce_summaries(bullet_lists: List[List[str]], max_words: int = DEFAULT_REDUCE_WORDS,
+                     workers: int = DEFAULT_WORKERS, use_cache: bool = True,
+                     executor: Optional[ThreadPoolExecutor] = None) -> List[str]:
+    """
+    Combine per-chunk bullet lists into one overall list of bullets (map-reduce).
+
+    Consecutive bullet lists are packed into batches of at most max_words words and
+    each batch is summarized again with REDUCE_PROMPT; the batches of a level are
+    summarized concurrently.  This repeats until the bullets fit in a single batch
+    (or MAX_REDUCE_LEVELS is reached).  Every batch goes through the summary cache, so
+    a re-run only asks the model about batches whose input bullets changed.  The
+    batches are summarized on executor if it is given (see ordered_map).
+    """
+    level = [bullets for bullets in bullet_lists if bullets]
+    for depth in range(MAX_REDUCE_LEVELS):
+        total_words = sum(len(bullet.split()) for bullets in level for bullet in bullets)
+        if len(level) <= 1 and total_words <= max_words:
+            break
+        batches = pack_bullet_lists(level, max_words)
+        print(f"Reducing {len(level)} bullet lists in {len(batches)} batches (level {depth + 1})", file=sys.stderr)
+        raw_responses = summarize_chunks(['\n'.join(batch) for batch in batches], REDUCE_PROMPT, workers, use_cache,
+                                         executor=executor)
+        level = []
+        for batch, raw_response in zip(batches, raw_responses):
+            if isinstance(raw_response, LLMCallError):
+                # Carry the batch up unreduced rather than lose its bullets.
+                print(f"Reducing a batch failed ({raw_response}); keeping its bullets", file=sys.stderr)
+                level.append(batch)
+            else:
+                level.append(parse_bullets(raw_response)[0])
+    return [bullet for bullets in level for bullet in bullets]
+
+# Pack consecutive bullet lists into batches of at most max_words words.  A list that is
+# bigger than max_words on its own becomes a batch by itself.
+def pack_bullet_lists(bullet_lists: List[List[str]], max_words: int) -> List[List[str]]:
+    batches: List[List[str]] = []
+    batch: List[str] = []
+    batch_words = 0
+    for bullets in bullet_lists:
+        words = sum(len(bullet.split()) for bullet in bullets)
+        if batch and batch_words + words > max_words:
+            batches.append(batch)
+            batch = []
+            batch_words = 0
+        batch.extend(bullets)
+        batch_words += words
+    if batch:
+        batches.append(batch)
+    return batches
+
+# Highlighting reruns on every Streamlit rerun, so the compiled patterns and the match
+# spans of the last few (text, pattern) pairs are cached.  A pattern that backtracks
+# catastrophically is given up on after HIGHLIGHT_TIMEOUT_SECONDS.
+HIGHLIGHT_CACHE_SIZE = 32
+HIGHLIGHT_TIMEOUT_SECONDS = 1.0
+HIGHLIGHT_MARK = ('<mark style="background-color: yellow;">', '</mark>')
+
+class MatchIndex:
+    """
+    The (start, end) spans of the matches of a pattern in a text, in order, or the
+    reason they couldn't be found (an invalid pattern or a timeout) in error.
+    """
+
+    __slots__ = ('spans', 'starts', 'error')
+
+    def __init__(self, spans: List[Tuple[int, int]], error: str = '') -> None:
+        self.spans = spans
+        self.starts = [start for start, _ in spans]
+        self.error = error
+
+    def between(self, start: int, end: int) -> List[Tuple[int, int]]:
+        """Return the spans of the matches that overlap text[start:end], clipped to it."""
+        first = max(0, bisect.bisect_right(self.starts, start) - 1)
+        last = bisect.bisect_left(self.starts, end)
+        return [(max(span_start, start), min(span_end, end)) for span_start, span_end in self.spans[first:last]
+                if span_end > start]
+
+# The regex module is used for its matching timeout; the syntax is that of re.
+@functools.lru_cache(maxsize=HIGHLIGHT_CACHE_SIZE)
+def compile_highlight_pattern(pattern: str) -> Any:
+    import regex
+    return regex.compile(pattern, regex.IGNORECASE)
+
+@functools.lru_cache(maxsize=HIGHLIGHT_CACHE_SIZE)
+def find_regex_matches(text: str, pattern: str, timeout: float = HIGHLIGHT_TIMEOUT_SECONDS) -> MatchIndex:
+    """
+    Return the index of the (case insensitive, non empty) matches of pattern in text.
+    An invalid pattern or one that takes longer than timeout seconds gives an index
+    without matches and with the error; it is cached like any other, so a bad pattern
+    doesn't cost the timeout again on every rerun.
+    """
+    import regex
+    try:
+        compiled = compile_highlight_pattern(pattern)
+        spans = [match.span() for match in compiled.finditer(text, timeout=timeout) if match.end() > match.start()]
+    except regex.error as e:
+        return MatchIndex([], f"Invalid pattern: {e}")
+    except TimeoutError:
+        return MatchIndex([], f"The pattern took more than {timeout:g}s to match; try a simpler one")
+    return MatchIndex(spans)
 
 # Function to highlight regex matches in text
-def highlight_regex_matches(text, pattern):
-    highlighted_text = re.sub(pattern, r'<mark style="background-color: yellow;">\g<0></mark>', text, flags=re.IGNORECASE)
-    return highlighted_text
+# Only text[start:end] is returned (all of the text by default), so a long text can be
+# shown a window at a time (see match_window) without marking up the rest.
+def highlight_regex_matches(text, pattern, start=0, end=None):
+    end = len(text) if end is None else end
+    pieces = []
+    position = start
+    for span_start, span_end in find_regex_matches(text, pattern).between(start, end):
+        pieces.extend((text[position:span_start], HIGHLIGHT_MARK[0], text[span_start:span_end], HIGHLIGHT_MARK[1]))
+        position = span_end
+    pieces.append(text[position:end])
+    return ''.join(pieces)
+
+# Return the (start, end) of about `size` characters of text around a span, extended to
+# whole lines so that the markdown of the window renders like that of the whole text.
+def match_window(text: str, span: Tuple[int, int], size: int) -> Tuple[int, int]:
+    start = text.rfind('\n', 0, max(0, span[0] - size // 2)) + 1
+    end = text.find('\n', max(span[1], start + size))
+    return start, len(text) if end < 0 else end
 
 def speak_assitant_response(text_input: str) -> None:
     """
@@ -205,88 +1151,583 @@ def hear_user_input(timeout: int = 3) -> str:
     # Remove the temporary WAV file after transcription
     return transcription.text
 
-def call_openai_api(chunk, summary_prompt) -> str:
-    return "DO NOT USE YET!"
+# Summarize a chunk with an OpenAI compatible server (see OpenAIBackend).
+def call_openai_api(chunk, summary_prompt, use_cache=True, format='') -> str:
     messages = [
         {"role": "system", "content": summary_prompt},
         {"role": "user", "content": f"{chunk}."},
     ]
 
-    response, total_tokens, prompt_tokens, completion_tokens = openai_generate_response(
-        model="gpt-3.5-turbo",
-        max_tokens=500,
-        messages=messages
+    response, total_tokens, prompt_tokens, completion_tokens = OpenAIBackend().generate(
+        messages=messages,
+        max_tokens=SUMMARY_MAX_TOKENS,
+        use_cache=use_cache,
+        format=format
     )
-    # We only return the message content to match the original function's return type
     return response.strip()
 
-def call_ollama_api(chunk, summary_prompt) -> str:
+# Summaries are cached on disk by default (see utils/llm_cache.py) so re-running a
+# summary over unchanged text costs a file read instead of an LLM call; pass
+# use_cache=False (or set LLM_CACHE_DISABLE=1) to always ask the model.
+# Pass format="json" to have the model produce valid json.
+# The chunk goes to the configured backend (see get_backend), which is ollama unless
+# LLM_BACKEND says otherwise.  Raises LLMCallError if the chunk can't be summarized.
+# The prompt goes first, as the system message, and is the same for every chunk, so
+# ollama only evaluates it once per parallel slot and reuses that for the next chunks
+# (see the prompt_reused and prompt_full cases of python/benchmark/bench.py).
+def call_ollama_api(chunk, summary_prompt, use_cache=True, format='') -> str:
     messages = [
         {"role": "system", "content": summary_prompt},
         {"role": "user", "content": f"{chunk}."},
     ]
 
-    response, total_tokens, prompt_tokens, completion_tokens = ollama_generate_response(
-        model="llama3:8b",
-        max_tokens=500,
-        messages=messages
+    response, total_tokens, prompt_tokens, completion_tokens = get_backend().generate(
+        messages=messages,
+        max_tokens=SUMMARY_MAX_TOKENS,
+        use_cache=use_cache,
+        format=format,
+        raise_errors=True
     )
     # We only return the message content to match the original function's return type
     return response.strip()
 
-def ollama_generate_response(model: str, max_tokens: int, messages: List[Dict[str, str]]) -> Tuple[str, int, int, int]:
+def failed_chunk_note(number: int, error: Exception) -> str:
+    """Return the note that takes the place of the bullets of a chunk that failed."""
+    return f"> **Chunk {number} could not be summarized:** {error}"
+
+def ollama_cache_key(model: str, max_tokens: int, messages: List[Dict[str, str]], options: Dict[str, Any],
+                     format: str = '') -> Optional[str]:
+    """Return the response cache key for a request, or None if the cache is disabled."""
+    if cache_disabled():
+        return None
+    if format:
+        return make_key("ollama", model, max_tokens, messages, options, format)
+    return make_key("ollama", model, max_tokens, messages, options)
+
+_default_keep_alive: Optional[str] = None
+
+def set_default_keep_alive(keep_alive: Optional[str]) -> None:
+    """Set this program's keep alive for ollama models (e.g., INTERACTIVE_KEEP_ALIVE)."""
+    global _default_keep_alive
+    _default_keep_alive = keep_alive
+
+def get_keep_alive() -> Union[float, str, None]:
+    """Return the keep alive to send with ollama requests, or None for the server's."""
+    keep_alive = os.getenv('LLM_KEEP_ALIVE') or _default_keep_alive
+    if keep_alive is None:
+        return None
+    try:
+        return float(keep_alive)
+    except ValueError:
+        return keep_alive
+
+_ollama_clients: Dict[Tuple[str, float], Any] = {}
+_ollama_clients_lock = threading.Lock()
+
+def get_ollama_client(host: Optional[str] = None, timeout: Optional[float] = None) -> Any:
     """
-    Generate a response from the Ollama API using the specified model and messages.
-    This requires that the Ollama server is running and available at 127.0.0.1:11434.
+    Return the shared ollama Client for host, creating it on first use.
+
+    The host defaults to $OLLAMA_HOST (or http://localhost:11434) and the timeout to
+    $OLLAMA_TIMEOUT seconds.  Clients are kept for the life of the process so every
+    call reuses the same pool of keep-alive connections instead of paying for a new
+    TCP connection per chunk.  The underlying httpx client is thread safe, so the
+    same client can be shared by all workers.
     """
-    from ollama import Client
-    client = Client(host='http://localhost:11434')
+    if host is None:
+        host = os.getenv('OLLAMA_HOST', DEFAULT_OLLAMA_HOST)
+    if timeout is None:
+        timeout = float(os.getenv('OLLAMA_TIMEOUT', str(DEFAULT_OLLAMA_TIMEOUT)))
 
-    try:
-        completion = client.chat(
-            model=model,
-            messages=messages,
-            options={
-                "temperature": 0.7
-            }
-        )
-        response = completion['message']['content'].strip()
-    except Exception as e:
-        error_text = f"Error in ollama server: Error: {str(e)}"
-        response = error_text
-        return response, 0, 0, 0
+    key = (host, timeout)
+    with _ollama_clients_lock:
+        client = _ollama_clients.get(key)
+        if client is None:
+            import httpx
+            from ollama import Client
+            limits = httpx.Limits(max_connections=OLLAMA_MAX_CONNECTIONS,
+                                  max_keepalive_connections=OLLAMA_MAX_CONNECTIONS)
+            client = Client(host=host, timeout=timeout, limits=limits)
+            _ollama_clients[key] = client
+        return client
+
+def get_ollama_hosts() -> List[str]:
+    """Return the ollama servers to use: $OLLAMA_HOSTS (comma separated) or $OLLAMA_HOST."""
+    hosts = [host.strip() for host in os.getenv('OLLAMA_HOSTS', '').split(',') if host.strip()]
+    return hosts or [os.getenv('OLLAMA_HOST', DEFAULT_OLLAMA_HOST)]
 
-    prompt_tokens = completion['eval_count']
-    #completion_tokens = completion['prompt_eval_count']
-    completion_tokens = 0
-    total_tokens = prompt_tokens + completion_tokens
+class HostState:
+    """Load and health of one ollama server, as seen by an OllamaRouter."""
+    __slots__ = ('host', 'outstanding', 'failures', 'down_until')
 
-    return response, total_tokens, prompt_tokens, completion_tokens
+    def __init__(self, host: str) -> None:
+        self.host = host
+        self.outstanding = 0
+        self.failures = 0
+        self.down_until = 0.0
 
-def openai_generate_response(model: str, max_tokens: int, messages: List[Dict[str, str]]) -> Tuple[str, int, int, int]:
-    return "DO NOT USE YET!", 0, 0, 0
+class OllamaRouter:
     """
-    Generate a response from the Openai API using the specified model and messages.
+    Spread requests over several ollama servers.
+
+    Each request goes to the server with the fewest outstanding requests (ties go round
+    robin), so a faster or less busy server gets more of the work.  A server whose
+    request fails is marked down and skipped for a while (HOST_RETRY_SECONDS, doubled
+    for each consecutive failure); after that it gets requests again and the first one
+    that succeeds marks it up.  If every server is down, the one that comes back first
+    is tried anyway.
     """
-    import openai
-    openai.api_key = "sk-XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX"
 
-    try:
-        completion = openai.ChatCompletion.create(
-            model=model,
+    def __init__(self, hosts: List[str]) -> None:
+        self.hosts = [HostState(host) for host in hosts]
+        self._lock = threading.Lock()
+        self._next = 0
+        if len(self.hosts) > 1:
+            self.check_health()
+
+    def acquire(self, exclude: Iterable[str] = ()) -> HostState:
+        """Pick a server for a request (not one of exclude, if possible) and count the request."""
+        now = time.monotonic()
+        with self._lock:
+            candidates = [state for state in self.hosts if state.host not in exclude] or self.hosts
+            up = [state for state in candidates if state.down_until <= now]
+            if up:
+                count = len(self.hosts)
+                state = min(up, key=lambda state: (state.outstanding,
+                                                   (self.hosts.index(state) - self._next) % count))
+                self._next = (self.hosts.index(state) + 1) % count
+            else:
+                state = min(candidates, key=lambda state: state.down_until)
+            state.outstanding += 1
+            return state
+
+    def release(self, state: HostState, ok: bool) -> None:
+        """Count the end of a request to state's server and whether the server answered."""
+        with self._lock:
+            state.outstanding -= 1
+            if ok:
+                state.failures = 0
+                state.down_until = 0.0
+            else:
+                state.failures += 1
+                delay = min(HOST_MAX_RETRY_SECONDS, HOST_RETRY_SECONDS * 2 ** (state.failures - 1))
+                state.down_until = time.monotonic() + delay
+
+    def check_health(self, timeout: float = HEALTH_CHECK_TIMEOUT) -> Dict[str, bool]:
+        """Ask every server for its models (at the same time); mark the ones that don't answer down."""
+        def check(state: HostState) -> bool:
+            try:
+                get_ollama_client(state.host, timeout).list()
+                return True
+            except Exception:
+                return False
+
+        with ThreadPoolExecutor(max_workers=len(self.hosts)) as executor:
+            results = list(executor.map(check, self.hosts))
+        with self._lock:
+            for state, ok in zip(self.hosts, results):
+                if ok:
+                    state.failures = 0
+                    state.down_until = 0.0
+                else:
+                    state.failures += 1
+                    state.down_until = time.monotonic() + HOST_RETRY_SECONDS
+        return {state.host: ok for state, ok in zip(self.hosts, results)}
+
+_ollama_routers: Dict[Tuple[str, ...], OllamaRouter] = {}
+_ollama_routers_lock = threading.Lock()
+
+def get_ollama_router(hosts: Optional[List[str]] = None) -> OllamaRouter:
+    """Return the shared router for hosts (by default get_ollama_hosts())."""
+    key = tuple(hosts or get_ollama_hosts())
+    with _ollama_routers_lock:
+        router = _ollama_routers.get(key)
+        if router is None:
+            router = OllamaRouter(list(key))
+            _ollama_routers[key] = router
+        return router
+
+# Usage of a response in ollama's terms (prompt_eval_count, eval_count and the
+# durations), plus the server that answered ("host"); see utils.llm_metrics.
+Usage = Dict[str, Any]
+
+class LLMBackend:
+    """
+    A chat model behind some API.  generate() and stream() put the response cache,
+    the metrics and error handling around the backend specific _complete() and
+    _stream().  Requests go through the call policy of the backend's server(s) (see
+    utils.llm_policy: timeouts, retries with backoff, a circuit breaker and an adaptive
+    concurrency limit).  Requests that still fail raise LLMCallError if raise_errors
+    is True, or else return (or yield) text starting with error_prefix instead of a
+    response; errors are never cached.
+    """
+
+    name = ''
+    error_prefix = ''
+
+    def __init__(self, model: str) -> None:
+        self.model = model
+
+    def cache_key(self, max_tokens: int, messages: List[Dict[str, str]], format: str) -> Optional[str]:
+        raise NotImplementedError
+
+    # Return what identifies the endpoint the requests go to, which has one call policy.
+    def policy_key(self) -> Tuple[str, ...]:
+        raise NotImplementedError
+
+    def warm_up(self, site: Optional[str] = None) -> float:
+        """
+        Load the model ahead of the first request, if the backend has to, and return
+        how many seconds loading took.  Failures are ignored: the requests that follow
+        will report them.
+        """
+        return 0.0
+
+    # Return the response text and its usage.
+    def _complete(self, messages: List[Dict[str, str]], max_tokens: int, format: str) -> Tuple[str, Usage]:
+        raise NotImplementedError
+
+    # Yield (piece, None) for each piece of the response and ('', usage) at the end.
+    def _stream(self, messages: List[Dict[str, str]], max_tokens: int) -> Iterator[Tuple[str, Optional[Usage]]]:
+        raise NotImplementedError
+
+    def generate(self, messages: List[Dict[str, str]], max_tokens: int = SUMMARY_MAX_TOKENS,
+                 use_cache: bool = False, format: str = '', site: Optional[str] = None,
+                 raise_errors: bool = False) -> Tuple[str, int, int, int]:
+        """
+        Return the response to messages and its total, prompt and completion token
+        counts.  With format="json" the model is made to produce valid json.  If
+        use_cache is True, the response is looked up in (and saved to) the on-disk
+        cache.  Every call is recorded in the metrics (see utils.llm_metrics) under
+        site, which defaults to the program's call site.
+        """
+        start_time = time.perf_counter()
+        cache_key = self.cache_key(max_tokens, messages, format) if use_cache and not cache_disabled() else None
+        if cache_key is not None:
+            cached = get_default_cache().get_json(cache_key)
+            if cached is not None:
+                get_metrics().record_call(site, self.model, time.perf_counter() - start_time, cached=True)
+                return cached[0], cached[1], cached[2], cached[3]
+
+        try:
+            response, usage = get_call_policy(self.policy_key()).call(
+                lambda: self._complete(messages, max_tokens, format))
+        except LLMCallError as e:
+            get_metrics().record_call(site, self.model, time.perf_counter() - start_time, error=str(e))
+            if raise_errors:
+                raise
+            return f"{self.error_prefix}: Error: {str(e)}", 0, 0, 0
+        get_metrics().record_call(site, self.model, time.perf_counter() - start_time, response=usage)
+
+        # ollama leaves prompt_eval_count out when the whole prompt was already in its cache.
+        prompt_tokens = usage.get('prompt_eval_count', 0) or 0
+        completion_tokens = usage.get('eval_count', 0) or 0
+        total_tokens = prompt_tokens + completion_tokens
+
+        if cache_key is not None:
+            get_default_cache().put_json(cache_key, [response, total_tokens, prompt_tokens, completion_tokens])
+
+        return response, total_tokens, prompt_tokens, completion_tokens
+
+    def stream(self, messages: List[Dict[str, str]], max_tokens: int = SUMMARY_MAX_TOKENS,
+               use_cache: bool = False, site: Optional[str] = None, raise_errors: bool = False) -> Iterator[str]:
+        """
+        Like generate but yield the response text piece by piece as the model generates
+        it.  A cached response is yielded in one piece; a complete streamed response is
+        saved to the cache.  The wall time recorded in the metrics runs until the last
+        piece has been consumed.
+        """
+        start_time = time.perf_counter()
+        cache_key = self.cache_key(max_tokens, messages, '') if use_cache and not cache_disabled() else None
+        if cache_key is not None:
+            cached = get_default_cache().get_json(cache_key)
+            if cached is not None:
+                get_metrics().record_call(site, self.model, time.perf_counter() - start_time, cached=True)
+                yield cached[0]
+                return
+
+        pieces = []
+        usage: Usage = {}
+        try:
+            for piece, final_usage in get_call_policy(self.policy_key()).stream(
+                    lambda: self._stream(messages, max_tokens)):
+                if final_usage is not None:
+                    usage = final_usage
+                if piece:
+                    pieces.append(piece)
+                    yield piece
+        except LLMCallError as e:
+            get_metrics().record_call(site, self.model, time.perf_counter() - start_time, error=str(e))
+            if raise_errors:
+                raise
+            yield f"\n{self.error_prefix}: Error: {str(e)}"
+            return
+        get_metrics().record_call(site, self.model, time.perf_counter() - start_time, response=usage)
+
+        if cache_key is not None:
+            response = ''.join(pieces).strip()
+            prompt_tokens = usage.get('prompt_eval_count', 0) or 0
+            completion_tokens = usage.get('eval_count', 0) or 0
+            get_default_cache().put_json(cache_key, [response, prompt_tokens + completion_tokens, prompt_tokens,
+                                                     completion_tokens])
+
+class OllamaBackend(LLMBackend):
+    """
+    Models served by one or more ollama servers (by default get_ollama_hosts()).
+    Requests are spread over the servers by an OllamaRouter; a request that fails
+    because its server is unreachable or overloaded is retried on the next server.
+    The servers share one call policy (see CallPolicy), so LLM_MAX_CONCURRENCY is the
+    limit for all of them together.
+    """
+
+    name = 'ollama'
+    error_prefix = OLLAMA_ERROR_PREFIX
+
+    def __init__(self, model: Optional[str] = None, hosts: Optional[List[str]] = None,
+                 timeout: Optional[float] = None) -> None:
+        super().__init__(model or os.getenv('LLM_MODEL') or DEFAULT_OLLAMA_MODEL)
+        self.router = get_ollama_router(hosts)
+        self.timeout = timeout
+        self.keep_alive = get_keep_alive()
+
+    def cache_key(self, max_tokens: int, messages: List[Dict[str, str]], format: str) -> Optional[str]:
+        # The same key for every server so that they share the cache.
+        return ollama_cache_key(self.model, max_tokens, messages, OLLAMA_OPTIONS, format)
+
+    def policy_key(self) -> Tuple[str, ...]:
+        return (self.name,) + tuple(state.host for state in self.router.hosts)
+
+    def warm_up(self, site: Optional[str] = None) -> float:
+        """
+        Load the model on every server (a chat request without messages only loads it)
+        and return the longest load time; a server that already has it loaded answers
+        at once.  Each server's load is recorded in the metrics as a warm-up.
+        """
+        def load(state: HostState) -> float:
+            start_time = time.perf_counter()
+            try:
+                response = get_ollama_client(state.host, self.timeout).chat(
+                    model=self.model, messages=[], keep_alive=self.keep_alive)
+            except Exception:
+                return 0.0
+            get_metrics().record_call(site, self.model, time.perf_counter() - start_time,
+                                      response=dict(response, host=state.host), warmup=True)
+            return (response.get('load_duration', 0) or 0) / NANOSECONDS
+
+        with ThreadPoolExecutor(max_workers=len(self.router.hosts)) as pool:
+            return max(pool.map(load, self.router.hosts))
+
+    # Errors that say something is wrong with the request rather than with the server
+    # (e.g., an unknown model) are not worth trying on another server.
+    @staticmethod
+    def _is_request_error(error: Exception) -> bool:
+        status_code = getattr(error, 'status_code', None)
+        return isinstance(status_code, int) and 400 <= status_code < 500 and status_code != 429
+
+    def _complete(self, messages: List[Dict[str, str]], max_tokens: int, format: str) -> Tuple[str, Usage]:
+        tried: List[str] = []
+        while True:
+            state = self.router.acquire(tried)
+            tried.append(state.host)
+            try:
+                completion = get_ollama_client(state.host, self.timeout).chat(
+                    model=self.model,
+                    messages=messages,
+                    options=OLLAMA_OPTIONS,
+                    format=format,
+                    keep_alive=self.keep_alive
+                )
+            except Exception as e:
+                request_error = self._is_request_error(e)
+                self.router.release(state, request_error)
+                if request_error or len(tried) >= len(self.router.hosts):
+                    raise
+                continue
+            self.router.release(state, True)
+            return completion['message']['content'].strip(), dict(completion, host=state.host)
+
+    def _stream(self, messages: List[Dict[str, str]], max_tokens: int) -> Iterator[Tuple[str, Optional[Usage]]]:
+        tried: List[str] = []
+        while True:
+            state = self.router.acquire(tried)
+            tried.append(state.host)
+            started = False
+            try:
+                for part in get_ollama_client(state.host, self.timeout).chat(
+                        model=self.model, messages=messages, options=OLLAMA_OPTIONS, stream=True,
+                        keep_alive=self.keep_alive):
+                    started = True
+                    yield part['message']['content'], dict(part, host=state.host) if part.get('done') else None
+            except Exception as e:
+                request_error = self._is_request_error(e)
+                self.router.release(state, request_error)
+                # Once part of the response has been handed out, it can't be taken back.
+                if started or request_error or len(tried) >= len(self.router.hosts):
+                    raise
+                continue
+            except GeneratorExit:
+                self.router.release(state, True)
+                raise
+            self.router.release(state, True)
+            return
+
+_openai_clients: Dict[Tuple[Optional[str], Optional[str], float], Any] = {}
+_openai_clients_lock = threading.Lock()
+
+def get_openai_client(base_url: Optional[str] = None, api_key: Optional[str] = None,
+                      timeout: Optional[float] = None) -> Any:
+    """
+    Return the shared OpenAI client for base_url (default $OPENAI_BASE_URL, or OpenAI
+    itself) with api_key (default $OPENAI_API_KEY), creating it on first use.
+    """
+    base_url = base_url or os.getenv('OPENAI_BASE_URL') or None
+    api_key = api_key or os.getenv('OPENAI_API_KEY') or None
+    if timeout is None:
+        timeout = float(os.getenv('OLLAMA_TIMEOUT', str(DEFAULT_OLLAMA_TIMEOUT)))
+    key = (base_url, api_key, timeout)
+    with _openai_clients_lock:
+        client = _openai_clients.get(key)
+        if client is None:
+            from openai import OpenAI
+            # Local OpenAI compatible servers don't check the key, but the client wants one.
+            client = OpenAI(base_url=base_url, api_key=api_key or ("none" if base_url else None),
+                            timeout=timeout, max_retries=0)
+            _openai_clients[key] = client
+        return client
+
+class OpenAIBackend(LLMBackend):
+    """
+    Models behind an OpenAI compatible chat completions API: OpenAI itself (set
+    OPENAI_API_KEY) or a local server such as vLLM or llama.cpp's (set OPENAI_BASE_URL).
+    """
+
+    name = 'openai'
+    error_prefix = OPENAI_ERROR_PREFIX
+
+    def __init__(self, model: Optional[str] = None, base_url: Optional[str] = None,
+                 api_key: Optional[str] = None) -> None:
+        super().__init__(model or os.getenv('LLM_MODEL') or DEFAULT_OPENAI_MODEL)
+        self.base_url = base_url or os.getenv('OPENAI_BASE_URL') or None
+        self.api_key = api_key
+
+    def cache_key(self, max_tokens: int, messages: List[Dict[str, str]], format: str) -> Optional[str]:
+        return make_key("openai", self.base_url or "", self.model, max_tokens, messages, OPENAI_TEMPERATURE, format)
+
+    def policy_key(self) -> Tuple[str, ...]:
+        return (self.name, self.base_url or "")
+
+    def _client(self) -> Any:
+        return get_openai_client(self.base_url, self.api_key)
+
+    # Put OpenAI's usage in ollama's terms (see Usage).
+    def _usage(self, usage: Any) -> Usage:
+        return {
+            "prompt_eval_count": getattr(usage, 'prompt_tokens', 0) or 0,
+            "eval_count": getattr(usage, 'completion_tokens', 0) or 0,
+            "host": self.base_url or "api.openai.com",
+        }
+
+    def _complete(self, messages: List[Dict[str, str]], max_tokens: int, format: str) -> Tuple[str, Usage]:
+        extra: Dict[str, Any] = {"response_format": {"type": "json_object"}} if format == 'json' else {}
+        completion = self._client().chat.completions.create(
+            model=self.model,
             messages=messages,
             max_tokens=max_tokens,
             n=1,
-            stop=None,
-            temperature=0.5,
+            temperature=OPENAI_TEMPERATURE,
+            **extra
         )
-        response = completion.choices[0]['message']['content'].strip()
-    except Exception as e:
-        error_text = f"Error in OpenAI API: Error: {str(e)}"
-        response = error_text
-        return response, 0, 0, 0
+        response = (completion.choices[0].message.content or '').strip()
+        return response, self._usage(completion.usage)
+
+    def _stream(self, messages: List[Dict[str, str]], max_tokens: int) -> Iterator[Tuple[str, Optional[Usage]]]:
+        usage = None
+        for part in self._client().chat.completions.create(
+                model=self.model, messages=messages, max_tokens=max_tokens, n=1,
+                temperature=OPENAI_TEMPERATURE, stream=True, stream_options={"include_usage": True}):
+            if part.usage is not None:
+                usage = part.usage
+            if part.choices and part.choices[0].delta.content:
+                yield part.choices[0].delta.content, None
+        yield '', self._usage(usage)
+
+BACKENDS = {
+    OllamaBackend.name: OllamaBackend,
+    OpenAIBackend.name: OpenAIBackend,
+}
+
+def get_backend(name: Optional[str] = None, model: Optional[str] = None) -> LLMBackend:
+    """
+    Return the backend called name (default $LLM_BACKEND or "ollama") for model
+    (default $LLM_MODEL or the backend's own default).  Backends share their clients
+    and routers, so they are cheap to get for every request.
+    """
+    name = name or os.getenv('LLM_BACKEND') or DEFAULT_BACKEND
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown LLM backend {name!r}; use one of {', '.join(BACKENDS)}")
+    return BACKENDS[name](model)
+
+# Use this when the caller wants to act on the response as soon as each line is
+# complete rather than waiting for the whole completion.  Iterating raises
+# LLMCallError if the chunk can't be summarized.
+def call_ollama_api_stream(chunk, summary_prompt, use_cache=True) -> Iterator[str]:
+    messages = [
+        {"role": "system", "content": summary_prompt},
+        {"role": "user", "content": f"{chunk}."},
+    ]
+
+    pieces = get_backend().stream(
+        messages=messages,
+        max_tokens=SUMMARY_MAX_TOKENS,
+        use_cache=use_cache,
+        raise_errors=True
+    )
+    return iter_response_lines(pieces)
 
-    return response, completion.total_tokens, completion.prompt_tokens, completion.completion_tokens
+def iter_response_lines(pieces: Iterable[str]) -> Iterator[str]:
+    """
+    Join streamed pieces of text and yield each line (without the newline) as soon as
+    it is complete.  The last line is yielded when the stream ends.
+    """
+    buffer = ''
+    for piece in pieces:
+        buffer += piece
+        if '\n' not in piece:
+            continue
+        lines = buffer.split('\n')
+        buffer = lines.pop()
+        yield from lines
+    if buffer:
+        yield buffer
+
+def ollama_stream_response(model: str, max_tokens: int, messages: List[Dict[str, str]],
+                           use_cache: bool = False, host: Optional[str] = None,
+                           site: Optional[str] = None) -> Iterator[str]:
+    """
+    Like ollama_generate_response but yield the response text piece by piece as the
+    model generates it (ollama's stream=True chat API); see LLMBackend.stream.
+    """
+    return OllamaBackend(model, [host] if host else None).stream(messages, max_tokens, use_cache, site)
+
+def ollama_generate_response(model: str, max_tokens: int, messages: List[Dict[str, str]],
+                             use_cache: bool = False, host: Optional[str] = None,
+                             format: str = '', site: Optional[str] = None) -> Tuple[str, int, int, int]:
+    """
+    Generate a response from the Ollama API using the specified model and messages.
+    This requires that the Ollama server is running and available at host (by default
+    the servers of get_ollama_hosts(), spread by an OllamaRouter).  See
+    LLMBackend.generate for the cache, the metrics and the returned token counts.
+    """
+    return OllamaBackend(model, [host] if host else None).generate(messages, max_tokens, use_cache, format, site)
+
+def openai_generate_response(model: str, max_tokens: int, messages: List[Dict[str, str]],
+                             use_cache: bool = False, format: str = '',
+                             site: Optional[str] = None) -> Tuple[str, int, int, int]:
+    """
+    Generate a response from an OpenAI compatible API (see OpenAIBackend) using the
+    specified model and messages.
+    """
+    return OpenAIBackend(model).generate(messages, max_tokens, use_cache, format, site)
 
 def get_multiline_input(prompt: str) -> str:
     """Get multiline input from the user."""
@@ -0,0 +1,231 @@
+import os
+import time
+import uuid
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Jobs run at the same time (LLM_JOB_SLOTS); the others wait in the queue.  The chunks of
+# the running jobs share one pool of CHUNK_WORKERS threads (LLM_JOB_CHUNK_WORKERS).
+DEFAULT_JOB_SLOTS = 2
+DEFAULT_CHUNK_WORKERS = 8
+
+# Finished jobs are kept for this long so that their page can still fetch the result.
+FINISHED_JOB_SECONDS = 3600.0
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class Job:
+    """
+    One summarization (or other) job: a function that yields the parts of its result,
+    run in the background by a JobQueue.  The parts are appended to `parts` as they
+    arrive so that a page can show them while the job runs; `total` is the number of
+    parts the job expects, if it knows (the function may set it once it has planned
+    the work).
+    """
+
+    __slots__ = ('id', 'owner', 'label', 'func', 'status', 'parts', 'total', 'error',
+                 'submitted', 'started', 'finished', '_cancel')
+
+    def __init__(self, owner: str, label: str, func: Callable[['Job'], Iterable[str]]) -> None:
+        self.id = uuid.uuid4().hex[:12]
+        self.owner = owner
+        self.label = label
+        self.func = func
+        self.status = QUEUED
+        self.parts: List[str] = []
+        self.total: Optional[int] = None
+        self.error = ''
+        self.submitted = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self._cancel = threading.Event()
+
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def active(self) -> bool:
+        return self.status in (QUEUED, RUNNING)
+
+    def progress(self) -> Tuple[int, Optional[int]]:
+        """Return the number of parts done so far and the expected total (or None)."""
+        return len(self.parts), self.total
+
+
+class JobQueue:
+    """
+    Run jobs in the background, `slots` at a time, for any number of owners (e.g., the
+    browser tabs of the streamlit app).  A free slot goes to the owner with the fewest
+    running jobs, round robin among equals, so an owner that queues many jobs (or one
+    huge one, then more) doesn't keep the others waiting while it holds a slot.
+
+    Running jobs can hand their LLM calls to `executor`, which is shared and first come
+    first served.  A job that keeps no more than chunk_share() calls submitted to it
+    (see ordered_map) leaves room for the other running jobs, so they take turns on the
+    server chunk by chunk instead of one job's chunks holding up the others.
+    """
+
+    def __init__(self, slots: int = DEFAULT_JOB_SLOTS, chunk_workers: int = DEFAULT_CHUNK_WORKERS) -> None:
+        self.slots = max(1, slots)
+        self.chunk_workers = max(1, chunk_workers)
+        self.executor = ThreadPoolExecutor(max_workers=self.chunk_workers, thread_name_prefix='job-chunk')
+        self.jobs: Dict[str, Job] = {}
+        # The queued jobs of each owner, and the owners with queued jobs in the order
+        # they get their next turn.
+        self.queues: Dict[str, Deque[Job]] = {}
+        self.turns: Deque[str] = deque()
+        self.running: Dict[str, int] = {}
+        self._condition = threading.Condition()
+        self._runners: List[threading.Thread] = []
+
+    def submit(self, owner: str, label: str, func: Callable[[Job], Iterable[str]]) -> Job:
+        """Queue func to be run as a job of owner and return the job."""
+        job = Job(owner, label, func)
+        with self._condition:
+            self._prune()
+            self.jobs[job.id] = job
+            if owner not in self.queues:
+                self.queues[owner] = deque()
+                self.turns.append(owner)
+            self.queues[owner].append(job)
+            # Runner threads are started on first use, so importing this is free.
+            while len(self._runners) < self.slots:
+                runner = threading.Thread(target=self._run, daemon=True, name=f'job-runner-{len(self._runners)}')
+                self._runners.append(runner)
+                runner.start()
+            self._condition.notify()
+        return job
+
+    def get(self, job_id: Optional[str]) -> Optional[Job]:
+        with self._condition:
+            return self.jobs.get(job_id) if job_id else None
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Cancel a job.  A queued job is dropped at once; a running job stops before its
+        next part (the calls it already started still finish).  Returns False if the
+        job is unknown or already over.
+        """
+        with self._condition:
+            job = self.jobs.get(job_id)
+            if job is None or not job.active():
+                return False
+            job._cancel.set()
+            if job.status == QUEUED:
+                self._dequeue(job)
+                job.status = CANCELLED
+                job.finished = time.time()
+            return True
+
+    def chunk_share(self) -> int:
+        """Return the number of calls a running job may keep submitted to executor."""
+        return max(1, self.chunk_workers // self.slots)
+
+    def position(self, job: Job) -> int:
+        """Return the number of jobs that will start before a queued job (0 if it isn't queued)."""
+        with self._condition:
+            if job.status != QUEUED:
+                return 0
+            # Replay the scheduling (see _next) until the job comes up, as if no running
+            # job finished in the meantime.
+            queues = {owner: list(queue) for owner, queue in self.queues.items()}
+            turns = deque(self.turns)
+            running = dict(self.running)
+            ahead = 0
+            while turns:
+                owner = min(turns, key=lambda owner: running.get(owner, 0))
+                turns.remove(owner)
+                running[owner] = running.get(owner, 0) + 1
+                if queues[owner].pop(0) is job:
+                    return ahead
+                ahead += 1
+                if queues[owner]:
+                    turns.append(owner)
+            return ahead
+
+    def counts(self) -> Tuple[int, int]:
+        """Return the numbers of running and queued jobs."""
+        with self._condition:
+            return sum(self.running.values()), sum(len(queue) for queue in self.queues.values())
+
+    def _dequeue(self, job: Job) -> None:
+        queue = self.queues[job.owner]
+        queue.remove(job)
+        if not queue:
+            del self.queues[job.owner]
+            self.turns.remove(job.owner)
+
+    # Return the next job to start: the first queued job of the first owner in turn with
+    # the fewest running jobs.
+    def _next(self) -> Job:
+        with self._condition:
+            while not self.turns:
+                self._condition.wait()
+            owner = min(self.turns, key=lambda owner: self.running.get(owner, 0))
+            self.turns.remove(owner)
+            self.running[owner] = self.running.get(owner, 0) + 1
+            queue = self.queues[owner]
+            job = queue.popleft()
+            if queue:
+                self.turns.append(owner)
+            else:
+                del self.queues[owner]
+            job.status = RUNNING
+            job.started = time.time()
+            return job
+
+    def _run(self) -> None:
+        while True:
+            job = self._next()
+            parts: Optional[Iterator[str]] = None
+            try:
+                parts = iter(job.func(job))
+                for part in parts:
+                    job.parts.append(part)
+                    if job.cancelled():
+                        break
+                status = CANCELLED if job.cancelled() else DONE
+            except Exception as e:
+                job.error = str(e)
+                status = FAILED
+            finally:
+                # Stop a generator that was cancelled, so it cancels its pending calls.
+                close = getattr(parts, 'close', None)
+                if close is not None:
+                    close()
+            with self._condition:
+                job.status = status
+                job.finished = time.time()
+                self.running[job.owner] -= 1
+                if not self.running[job.owner]:
+                    del self.running[job.owner]
+
+    # Forget the jobs that finished more than FINISHED_JOB_SECONDS ago.
+    def _prune(self) -> None:
+        cutoff = time.time() - FINISHED_JOB_SECONDS
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.finished is not None and job.finished < cutoff]:
+            del self.jobs[job_id]
+
+
+_job_queue: Optional[JobQueue] = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    """
+    Return the process wide job queue, configured by LLM_JOB_SLOTS and
+    LLM_JOB_CHUNK_WORKERS; in the streamlit app it is shared by all browser tabs.
+    """
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            slots = int(os.getenv("LLM_JOB_SLOTS", str(DEFAULT_JOB_SLOTS)))
+            chunk_workers = int(os.getenv("LLM_JOB_CHUNK_WORKERS", str(DEFAULT_CHUNK_WORKERS)))
+            _job_queue = JobQueue(slots, chunk_workers)
+        return _job_queue
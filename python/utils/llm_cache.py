@@ -0,0 +1,138 @@
+import os
+import json
+import hashlib
+import threading
+from typing import Any, Optional
+
+# Where cached LLM responses are kept and how large the cache may grow.  Set
+# LLM_CACHE_DISABLE=1 to bypass the cache entirely (nothing is read or written).
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "llm-text-handling")
+DEFAULT_CACHE_MAX_MB = 512
+
+
+def make_key(*parts: Any) -> str:
+    """
+    Return a content address (sha256 hex digest) for the given parts.  The parts must
+    be json serializable; dicts are serialized with sorted keys so that the key does
+    not depend on insertion order.
+    """
+    blob = json.dumps(parts, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+
+class DiskCache:
+    """
+    Content-addressed on-disk cache with size-based LRU eviction.
+
+    Each value is stored in its own file named after its key.  Reading an entry
+    touches the file, so the file modification times give the LRU order; when the
+    total size goes over max_bytes, the least recently used files are removed.
+    Writes go through a temporary file and os.replace so concurrent readers (other
+    threads or other processes) never see a partially written entry.
+    """
+
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_CACHE_MAX_MB * 1024 * 1024) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size: Optional[int] = None
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached value for key or None if there is no such entry."""
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                value = file.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return value
+
+    def put(self, key: str, value: str) -> None:
+        """Store value under key and evict old entries if the cache is too big."""
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        data = value.encode('utf-8')
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            # The cache is only an optimization; never fail the caller because of it.
+            return
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def get_json(self, key: str) -> Any:
+        value = self.get(key)
+        if value is None:
+            return None
+        try:
+            return json.loads(value)
+        except json.JSONDecodeError:
+            return None
+
+    def put_json(self, key: str, value: Any) -> None:
+        self.put(key, json.dumps(value, ensure_ascii=False))
+
+    def _entries(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def _scan_size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    # Remove least recently used entries until the cache is 10% under its limit so
+    # that we don't have to walk the directory on every write.  Called with the lock held.
+    def _evict(self) -> None:
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        target = int(self.max_bytes * 0.9)
+        for path, size, _ in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        self._size = total
+
+
+_default_cache: Optional[DiskCache] = None
+_default_cache_lock = threading.Lock()
+
+
+def cache_disabled() -> bool:
+    return os.getenv("LLM_CACHE_DISABLE", "") not in ("", "0", "false", "False")
+
+
+def get_default_cache() -> DiskCache:
+    """
+    Return the process wide cache configured by LLM_CACHE_DIR and LLM_CACHE_MAX_MB.
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            directory = os.getenv("LLM_CACHE_DIR", DEFAULT_CACHE_DIR)
+            max_mb = int(os.getenv("LLM_CACHE_MAX_MB", str(DEFAULT_CACHE_MAX_MB)))
+            _default_cache = DiskCache(directory, max_mb * 1024 * 1024)
+        return _default_cache
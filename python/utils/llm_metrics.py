@@ -0,0 +1,209 @@
+import os
+import sys
+import json
+import time
+import threading
+from typing import Any, Dict, Iterable, Optional, TextIO
+
+# Each program names its own call site (e.g., "osummarize") with set_default_site so
+# that its calls can be told apart from other programs' calls in a shared trace.
+DEFAULT_SITE = "default"
+
+# ollama reports durations in nanoseconds.
+NANOSECONDS = 1e9
+
+# A call that spent at least this many seconds loading the model was a cold start; its
+# latency is kept out of the steady state (warm) latency.
+COLD_LOAD_SECONDS = 0.5
+
+
+def call_record(site: str, model: str, wall_seconds: float, response: Optional[Dict[str, Any]] = None,
+                error: Optional[str] = None, cached: bool = False, warmup: bool = False) -> Dict[str, Any]:
+    """
+    Return the trace record of one LLM call.  response is the final message of an
+    ollama chat response, which carries the token counts and the load, prompt eval
+    and eval durations, plus the server that answered ("host"); cached calls and
+    errors have no response.  warmup marks a request that only loaded the model.
+    """
+    response = response or {}
+    completion_tokens = response.get('eval_count', 0) or 0
+    eval_seconds = (response.get('eval_duration', 0) or 0) / NANOSECONDS
+    return {
+        "time": time.time(),
+        "site": site,
+        "model": model,
+        "host": response.get('host', ''),
+        "cached": cached,
+        "warmup": warmup,
+        "error": error,
+        "wall_s": wall_seconds,
+        # ollama leaves prompt_eval_count out when the whole prompt was already in its cache.
+        "prompt_tokens": response.get('prompt_eval_count', 0) or 0,
+        "completion_tokens": completion_tokens,
+        "load_s": (response.get('load_duration', 0) or 0) / NANOSECONDS,
+        "prompt_eval_s": (response.get('prompt_eval_duration', 0) or 0) / NANOSECONDS,
+        "eval_s": eval_seconds,
+        "total_s": (response.get('total_duration', 0) or 0) / NANOSECONDS,
+        "tokens_per_s": completion_tokens / eval_seconds if eval_seconds else 0.0,
+    }
+
+
+class SiteStats:
+    """
+    Totals of the LLM calls made from one call site.  Warm-ups (requests that only load
+    the model) add to the load time and the cold starts but aren't counted as calls;
+    warm_seconds totals the wall time of the calls that found the model loaded.
+    """
+
+    __slots__ = ('calls', 'errors', 'cache_hits', 'prompt_tokens', 'completion_tokens',
+                 'load_seconds', 'prompt_eval_seconds', 'eval_seconds', 'wall_seconds',
+                 'cold_calls', 'warm_calls', 'warm_seconds')
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.load_seconds = 0.0
+        self.prompt_eval_seconds = 0.0
+        self.eval_seconds = 0.0
+        self.wall_seconds = 0.0
+        self.cold_calls = 0
+        self.warm_calls = 0
+        self.warm_seconds = 0.0
+
+    def add(self, record: Dict[str, Any]) -> None:
+        cold = record['load_s'] >= COLD_LOAD_SECONDS
+        if record.get('warmup'):
+            self.load_seconds += record['load_s']
+            self.cold_calls += cold
+            return
+        self.calls += 1
+        self.wall_seconds += record['wall_s']
+        if record['error']:
+            self.errors += 1
+            return
+        if record['cached']:
+            self.cache_hits += 1
+            return
+        self.prompt_tokens += record['prompt_tokens']
+        self.completion_tokens += record['completion_tokens']
+        self.load_seconds += record['load_s']
+        self.prompt_eval_seconds += record['prompt_eval_s']
+        self.eval_seconds += record['eval_s']
+        if cold:
+            self.cold_calls += 1
+        else:
+            self.warm_calls += 1
+            self.warm_seconds += record['wall_s']
+
+    def row(self, site: str) -> str:
+        # Generation rate of the model (eval) and of the calls as seen by the caller (wall).
+        eval_rate = self.completion_tokens / self.eval_seconds if self.eval_seconds else 0.0
+        wall_rate = self.completion_tokens / self.wall_seconds if self.wall_seconds else 0.0
+        error_rate = 100.0 * self.errors / self.calls if self.calls else 0.0
+        # Steady state latency: the mean wall time of the calls that didn't load the model.
+        warm_latency = self.warm_seconds / self.warm_calls if self.warm_calls else 0.0
+        return (f"{site:<12} {self.calls:>6} {error_rate:>5.1f}% {self.cache_hits:>6} {self.prompt_tokens:>9} "
+                f"{self.completion_tokens:>9} {self.cold_calls:>5} {self.load_seconds:>7.1f} "
+                f"{self.prompt_eval_seconds:>7.1f} {self.eval_seconds:>7.1f} {self.wall_seconds:>8.1f} "
+                f"{warm_latency:>7.2f} {eval_rate:>6.1f} {wall_rate:>6.1f}")
+
+
+SUMMARY_HEADER = (f"{'site':<12} {'calls':>6} {'errors':>6} {'cached':>6} {'prompt':>9} {'complet.':>9} "
+                  f"{'cold':>5} {'load_s':>7} {'prompt_s':>7} {'eval_s':>7} {'wall_s':>8} {'warm_s':>7} "
+                  f"{'tok/s':>6} {'wall/s':>6}")
+
+
+class LLMMetrics:
+    """
+    Thread safe collector of LLM call statistics, kept per call site.
+
+    Every call is added to the totals of its site and, if trace_path is set, appended
+    to a json-lines trace (one call_record per line) so runs can be compared later or
+    several programs' calls combined (see summarize_trace).
+    """
+
+    def __init__(self, trace_path: Optional[str] = None) -> None:
+        self.trace_path = trace_path
+        self.sites: Dict[str, SiteStats] = {}
+        self._lock = threading.Lock()
+        self._trace: Optional[TextIO] = None
+
+    def record(self, record: Dict[str, Any]) -> None:
+        with self._lock:
+            stats = self.sites.get(record['site'])
+            if stats is None:
+                stats = self.sites[record['site']] = SiteStats()
+            stats.add(record)
+            if self.trace_path:
+                try:
+                    if self._trace is None:
+                        self._trace = open(self.trace_path, 'a')
+                    self._trace.write(json.dumps(record) + '\n')
+                    self._trace.flush()
+                except OSError:
+                    # The trace is only for diagnosis; never fail the caller because of it.
+                    self.trace_path = None
+
+    def record_call(self, site: Optional[str], model: str, wall_seconds: float,
+                    response: Optional[Dict[str, Any]] = None, error: Optional[str] = None,
+                    cached: bool = False, warmup: bool = False) -> None:
+        self.record(call_record(site or get_default_site(), model, wall_seconds, response, error, cached, warmup))
+
+    def summary_table(self) -> str:
+        """Return a table of the totals of each call site."""
+        with self._lock:
+            rows = [stats.row(site) for site, stats in sorted(self.sites.items())]
+        return '\n'.join([SUMMARY_HEADER] + rows)
+
+
+_default_site = DEFAULT_SITE
+_metrics: Optional[LLMMetrics] = None
+_metrics_lock = threading.Lock()
+
+
+def set_default_site(site: str) -> None:
+    """Name the call site of this program's LLM calls (e.g., "osummarize")."""
+    global _default_site
+    _default_site = site
+
+
+def get_default_site() -> str:
+    return _default_site
+
+
+def get_metrics() -> LLMMetrics:
+    """
+    Return the process wide metrics; calls are traced to $LLM_TRACE_FILE if it is set.
+    """
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = LLMMetrics(os.getenv("LLM_TRACE_FILE") or None)
+        return _metrics
+
+
+def summarize_trace(lines: Iterable[str]) -> str:
+    """Return the per call site summary table of the records in a json-lines trace."""
+    metrics = LLMMetrics()
+    for line in lines:
+        try:
+            metrics.record(json.loads(line))
+        except (json.JSONDecodeError, KeyError, TypeError):
+            continue
+    return metrics.summary_table()
+
+
+# Print the summary of one or more trace files, e.g., to size ollama hosts from the
+# traces of a few days of runs.
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} <trace_file> [<trace_file> ...]")
+        sys.exit(1)
+    trace_lines = []
+    for trace_file in sys.argv[1:]:
+        with open(trace_file, 'r') as file:
+            trace_lines.extend(file.readlines())
+    print(summarize_trace(trace_lines))
@@ -0,0 +1,278 @@
+import os
+import sys
+import time
+import random
+import threading
+from typing import Callable, Dict, Iterator, Optional, Tuple, TypeVar
+
+# Attempts per LLM call (LLM_RETRIES) and the delay before the first retry in seconds
+# (LLM_RETRY_DELAY); the delay doubles with every attempt up to MAX_RETRY_DELAY and
+# each actual wait is a random fraction of it (full jitter) so that the workers don't
+# all come back at the same moment.
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 30.0
+
+# After BREAKER_FAILURES failed calls in a row, calls fail at once for
+# BREAKER_RESET_SECONDS instead of waiting on a server that is down.
+BREAKER_FAILURES = 5
+BREAKER_RESET_SECONDS = 30.0
+
+# Most calls in flight per server (LLM_MAX_CONCURRENCY); the limiter lowers this when
+# the server is overloaded.  A smoothed latency of more than LATENCY_TOLERANCE times the
+# baseline counts as overload.  The baseline is the lowest smoothed latency seen, but it
+# drifts up towards the current one by BASELINE_DRIFT per call, so that calls that are
+# slower for good (bigger chunks, reduce batches, another job on the server) become the
+# new normal instead of looking like overload for ever.
+DEFAULT_MAX_CONCURRENCY = 32
+LATENCY_TOLERANCE = 2.0
+LATENCY_SMOOTHING = 0.2
+BASELINE_DRIFT = 0.05
+DECREASE_FACTOR = 0.5
+
+T = TypeVar('T')
+
+
+class LLMCallError(Exception):
+    """An LLM call failed, after any retries; the message says why."""
+
+
+class CircuitOpenError(LLMCallError):
+    """The call wasn't made because the server has been failing (see CircuitBreaker)."""
+
+
+def error_status(error: Exception) -> Optional[int]:
+    """Return the HTTP status of an ollama, openai or httpx error, if it has one."""
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status if isinstance(status, int) else None
+
+
+def is_timeout(error: Exception) -> bool:
+    return isinstance(error, TimeoutError) or 'Timeout' in type(error).__name__
+
+
+def is_overload(error: Exception) -> bool:
+    """True for errors that mean the server is too busy: 429, 503 and timeouts."""
+    return error_status(error) in (429, 503) or is_timeout(error)
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    True for errors that may go away on their own: network errors, timeouts, 408, 429
+    and 5xx.  Other 4xx errors (e.g., an unknown model) will fail again.
+    """
+    status = error_status(error)
+    if status is None:
+        return True
+    return status in (408, 429) or status >= 500
+
+
+class CircuitBreaker:
+    """
+    Stop calling a server that keeps failing.  After `failures` failed calls in a row
+    the breaker opens and calls fail at once for reset_seconds; then a single trial call
+    is let through (half open).  If it succeeds the breaker closes, otherwise it opens
+    again.
+    """
+
+    def __init__(self, failures: int = BREAKER_FAILURES, reset_seconds: float = BREAKER_RESET_SECONDS) -> None:
+        self.threshold = failures
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.last_error = ''
+        self.opened_at: Optional[float] = None
+        self.trial = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_seconds or self.trial:
+                return False
+            self.trial = True
+            return True
+
+    def record(self, ok: bool, error: Optional[Exception] = None) -> None:
+        with self._lock:
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                self.last_error = str(error)
+                if self.trial or self.failures >= self.threshold:
+                    self.opened_at = time.monotonic()
+            self.trial = False
+
+    def retry_in(self) -> float:
+        """Seconds until a trial call will be let through."""
+        with self._lock:
+            if self.opened_at is None:
+                return 0.0
+            return max(0.0, self.opened_at + self.reset_seconds - time.monotonic())
+
+
+class AdaptiveLimiter:
+    """
+    Limit the number of calls in flight and adapt the limit AIMD style (like TCP
+    congestion control).  While calls use up the whole limit and succeed, it grows by
+    one per limit's worth of calls.  When a call fails with an overload error or the
+    smoothed latency climbs above LATENCY_TOLERANCE times the baseline (requests are
+    queuing on the server), the limit is halved, at most once per call duration so that
+    one burst of slow calls counts once.  As the baseline drifts up to a lasting change
+    in latency, the limit then grows back.
+    """
+
+    def __init__(self, max_limit: int = DEFAULT_MAX_CONCURRENCY, min_limit: int = 1) -> None:
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.average: Optional[float] = None
+        self.baseline: Optional[float] = None
+        self.last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self) -> None:
+        with self._condition:
+            while self.in_flight >= max(self.min_limit, int(self.limit)):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency: Optional[float], overloaded: bool = False) -> None:
+        """End a call that took latency seconds (None if it failed early)."""
+        with self._condition:
+            observed = self.in_flight
+            self.in_flight -= 1
+            congested = overloaded
+            if latency is not None and not overloaded:
+                if self.average is None:
+                    self.average = latency
+                else:
+                    self.average += LATENCY_SMOOTHING * (latency - self.average)
+                if self.baseline is None or self.average < self.baseline:
+                    self.baseline = self.average
+                else:
+                    self.baseline += BASELINE_DRIFT * (self.average - self.baseline)
+                congested = self.average > self.baseline * LATENCY_TOLERANCE
+            now = time.monotonic()
+            if congested:
+                # Calls that failed early have no latency of their own; use the usual one.
+                duration = latency if latency is not None else (self.average or 0.0)
+                if now - self.last_decrease >= duration:
+                    self.limit = max(float(self.min_limit), min(self.limit, observed) * DECREASE_FACTOR)
+                    self.last_decrease = now
+            elif observed >= int(self.limit):
+                self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            self._condition.notify_all()
+
+
+class CallPolicy:
+    """
+    How calls to one backend endpoint are made: a server, or the pool of ollama servers
+    an OllamaRouter fails over between, which share one policy.  Each attempt waits for
+    a slot from the limiter and is refused while the circuit breaker is open; failed
+    attempts with retryable errors are retried after an exponential backoff with full
+    jitter.  Calls that still fail raise LLMCallError.  Per request timeouts are set on
+    the clients (OLLAMA_TIMEOUT).
+
+    For a pool the limiter caps the requests in flight on all its servers together and
+    an attempt only fails (and counts against the breaker) once every server it was
+    tried on failed; the health of each server is tracked by the router.
+    """
+
+    def __init__(self, retries: int = DEFAULT_RETRIES, retry_delay: float = DEFAULT_RETRY_DELAY,
+                 breaker: Optional[CircuitBreaker] = None, limiter: Optional[AdaptiveLimiter] = None) -> None:
+        self.retries = max(1, retries)
+        self.retry_delay = retry_delay
+        self.breaker = breaker or CircuitBreaker()
+        self.limiter = limiter or AdaptiveLimiter()
+
+    def _admit(self) -> None:
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"{self.breaker.failures} calls in a row failed (last: {self.breaker.last_error}); "
+                                   f"not calling the server for another {self.breaker.retry_in():.0f}s")
+        self.limiter.acquire()
+
+    def _finish(self, latency: Optional[float], error: Optional[Exception]) -> None:
+        self.limiter.release(latency, error is not None and is_overload(error))
+        # A request the server rejected (e.g., an unknown model) says nothing about its health.
+        self.breaker.record(error is None or not is_retryable(error), error)
+
+    # Wait before the next attempt and return True, or return False if there is none.
+    def _backoff(self, error: Exception, attempt: int) -> bool:
+        if attempt + 1 >= self.retries or not is_retryable(error) or self.breaker.retry_in() > 0:
+            return False
+        delay = random.uniform(0, min(MAX_RETRY_DELAY, self.retry_delay * 2 ** attempt))
+        print(f"LLM call failed ({error}); retrying in {delay:.1f}s", file=sys.stderr)
+        time.sleep(delay)
+        return True
+
+    def call(self, func: Callable[[], T]) -> T:
+        """Return func(), retrying it as the policy says; raise LLMCallError if it keeps failing."""
+        attempt = 0
+        while True:
+            self._admit()
+            start = time.monotonic()
+            try:
+                result = func()
+            except Exception as e:
+                self._finish(None if is_timeout(e) else time.monotonic() - start, e)
+                if not self._backoff(e, attempt):
+                    raise LLMCallError(f"{e} (attempt {attempt + 1} of {self.retries})") from e
+                attempt += 1
+                continue
+            self._finish(time.monotonic() - start, None)
+            return result
+
+    def stream(self, func: Callable[[], Iterator[T]]) -> Iterator[T]:
+        """
+        Yield the items of func(), retrying as the policy says until the first item
+        arrives; after that a failure can't be retried (the caller already has part of
+        the response) and raises LLMCallError.  The latency given to the limiter is the
+        time to the first item, so a slow consumer doesn't look like a slow server.
+        """
+        attempt = 0
+        while True:
+            self._admit()
+            start = time.monotonic()
+            latency = None
+            try:
+                for item in func():
+                    if latency is None:
+                        latency = time.monotonic() - start
+                    yield item
+            except GeneratorExit:
+                self._finish(latency, None)
+                raise
+            except Exception as e:
+                self._finish(latency, e)
+                if latency is not None or not self._backoff(e, attempt):
+                    raise LLMCallError(f"{e} (attempt {attempt + 1} of {self.retries})") from e
+                attempt += 1
+                continue
+            self._finish(latency if latency is not None else time.monotonic() - start, None)
+            return
+
+
+_policies: Dict[Tuple[str, ...], CallPolicy] = {}
+_policies_lock = threading.Lock()
+
+
+def get_call_policy(key: Tuple[str, ...]) -> CallPolicy:
+    """
+    Return the shared policy for the endpoint identified by key, configured by
+    LLM_RETRIES, LLM_RETRY_DELAY and LLM_MAX_CONCURRENCY.
+    """
+    with _policies_lock:
+        policy = _policies.get(key)
+        if policy is None:
+            retries = int(os.getenv("LLM_RETRIES", str(DEFAULT_RETRIES)))
+            retry_delay = float(os.getenv("LLM_RETRY_DELAY", str(DEFAULT_RETRY_DELAY)))
+            max_concurrency = int(os.getenv("LLM_MAX_CONCURRENCY", str(DEFAULT_MAX_CONCURRENCY)))
+            policy = CallPolicy(retries, retry_delay, limiter=AdaptiveLimiter(max_concurrency))
+            _policies[key] = policy
+        return policy
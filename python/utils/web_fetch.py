@@ -0,0 +1,147 @@
+import os
+import asyncio
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Union
+from utils.llm_cache import make_key, get_default_cache, cache_disabled
+
+# Seconds to wait for a page (WEB_FETCH_TIMEOUT) and the most pages fetched at the same
+# time (WEB_FETCH_CONCURRENCY).
+DEFAULT_FETCH_TIMEOUT = 30.0
+DEFAULT_FETCH_CONCURRENCY = 16
+
+_http_client: Any = None
+_http_client_lock = threading.Lock()
+
+
+def get_fetch_timeout() -> float:
+    return float(os.getenv("WEB_FETCH_TIMEOUT", str(DEFAULT_FETCH_TIMEOUT)))
+
+
+def get_fetch_concurrency() -> int:
+    return max(1, int(os.getenv("WEB_FETCH_CONCURRENCY", str(DEFAULT_FETCH_CONCURRENCY))))
+
+
+def get_http_client() -> Any:
+    """
+    Return the shared httpx Client for single page fetches, creating it on first use,
+    so that every fetch reuses its pool of keep-alive connections.
+    """
+    global _http_client
+    with _http_client_lock:
+        if _http_client is None:
+            import httpx
+            _http_client = httpx.Client(timeout=get_fetch_timeout(), follow_redirects=True)
+        return _http_client
+
+
+def html_to_text(html: str) -> str:
+    """Convert a page to markdown-ish text; a module level function so a process pool can run it."""
+    import html2text
+    return html2text.html2text(html)
+
+
+# Responses are kept in the LLM cache (see DiskCache) with their ETag and Last-Modified
+# headers, and fetched again with If-None-Match / If-Modified-Since, so a page that
+# hasn't changed costs a 304 instead of its whole body.
+# Return the cache key of a request and its cache entry ({"etag", "last_modified",
+# "text"}), or (None, None) if the cache is off.
+def _cached(url: str, headers: Dict[str, str], use_cache: bool):
+    if not use_cache or cache_disabled():
+        return None, None
+    key = make_key("http", url, headers)
+    return key, get_default_cache().get_json(key)
+
+
+# Leave out the headers that aren't set (e.g., an API key from an unset variable).
+def _given_headers(headers: Optional[Dict[str, Optional[str]]]) -> Dict[str, str]:
+    return {name: value for name, value in (headers or {}).items() if value is not None}
+
+
+# Return the headers of a request: the caller's plus the validators of the cached response.
+def _request_headers(headers: Dict[str, str], entry: Optional[Dict[str, Any]]) -> Dict[str, str]:
+    request_headers = dict(headers)
+    if entry is not None:
+        if entry.get('etag'):
+            request_headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            request_headers['If-Modified-Since'] = entry['last_modified']
+    return request_headers
+
+
+# Return the body of a response, or that of the cached response if the server says it
+# hasn't changed (304), caching it if the server gave validators; raise httpx.HTTPError
+# for other errors.
+def _response_text(response: Any, key: Optional[str], entry: Optional[Dict[str, Any]]) -> str:
+    if response.status_code == 304 and entry is not None:
+        return entry['text']
+    response.raise_for_status()
+    text = response.text
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if key is not None and (etag or last_modified):
+        get_default_cache().put_json(key, {"etag": etag, "last_modified": last_modified, "text": text})
+    return text
+
+
+def fetch_url(url: str, headers: Optional[Dict[str, Optional[str]]] = None, use_cache: bool = True) -> str:
+    """
+    Return the body of the page at url, revalidating a cached copy if there is one.
+    Raises httpx.HTTPError if the page can't be fetched.
+    """
+    given = _given_headers(headers)
+    key, entry = _cached(url, given, use_cache)
+    response = get_http_client().get(url, headers=_request_headers(given, entry))
+    return _response_text(response, key, entry)
+
+
+async def fetch_urls_async(urls: List[str], headers: Optional[Dict[str, Optional[str]]] = None, to_text: bool = False,
+                           use_cache: bool = True, concurrency: Optional[int] = None,
+                           pool: Optional[ProcessPoolExecutor] = None) -> List[Union[str, Exception]]:
+    """
+    Fetch the pages at urls, up to concurrency at a time over one pooled async client,
+    and return their bodies (converted with html_to_text on pool if to_text is True)
+    in the order of urls.  A page that can't be fetched or converted gives its
+    exception instead, so one bad url doesn't lose the others.
+    """
+    import httpx
+
+    concurrency = concurrency or get_fetch_concurrency()
+    given = _given_headers(headers)
+    # The semaphore, rather than the connection pool, makes the other requests wait, so
+    # that waiting for a turn doesn't count against the pool timeout.
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(timeout=get_fetch_timeout(), follow_redirects=True, limits=limits) as client:
+        async def fetch(url: str) -> Union[str, Exception]:
+            try:
+                key, entry = _cached(url, given, use_cache)
+                async with semaphore:
+                    response = await client.get(url, headers=_request_headers(given, entry))
+                text = _response_text(response, key, entry)
+                if to_text:
+                    # Converting is cpu bound (html2text is pure python), so it runs in
+                    # other processes while the fetches go on.
+                    text = await loop.run_in_executor(pool, html_to_text, text)
+                return text
+            except Exception as e:
+                return e
+
+        return list(await asyncio.gather(*(fetch(url) for url in urls)))
+
+
+def fetch_urls(urls: List[str], headers: Optional[Dict[str, Optional[str]]] = None, to_text: bool = False,
+               use_cache: bool = True, concurrency: Optional[int] = None,
+               workers: Optional[int] = None) -> List[Union[str, Exception]]:
+    """
+    Fetch many pages at once (see fetch_urls_async) from synchronous code.  Pages are
+    converted to text by a pool of `workers` processes (default: one per cpu, see
+    process_pool).
+    """
+    if not to_text or len(urls) <= 1:
+        return asyncio.run(fetch_urls_async(urls, headers, to_text, use_cache, concurrency))
+    from utils.chat_utils import process_pool
+    with process_pool(workers or os.cpu_count() or 1) as pool:
+        return asyncio.run(fetch_urls_async(urls, headers, to_text, use_cache, concurrency, pool))
@@ -8,10 +8,14 @@
 # Goto system preferences on macos and allow terminal to use microphone.
 
 import warnings
+import threading
 from simple_term_menu import TerminalMenu
-from utils.chat_utils import hear_user_input, speak_assitant_response, ollama_generate_response, get_multiline_input
+from utils.chat_utils import hear_user_input, speak_assitant_response, get_backend, get_multiline_input, set_default_keep_alive, INTERACTIVE_KEEP_ALIVE
+from utils.llm_metrics import get_metrics, set_default_site
 
 warnings.filterwarnings("ignore", category=DeprecationWarning)
+set_default_site("voice_chat")
+set_default_keep_alive(INTERACTIVE_KEEP_ALIVE)
 
 # The system message can be what you want.
 
@@ -41,6 +45,10 @@ while True:
         # Escape was pressed so do nothing.
         continue
 
+    # Load the model (in case it was unloaded while idle) while the user speaks or types.
+    if options[selected_option] in ("Speak", "Type"):
+      threading.Thread(target=get_backend().warm_up, daemon=True).start()
+
     if options[selected_option] == "Speak":
       user_input = hear_user_input(timeout=2)
       if user_input is "":
@@ -54,6 +62,7 @@ while True:
         continue
 
     elif options[selected_option] == "Exit":
+      print(get_metrics().summary_table())
       print("Goodbye!")
       break
 
@@ -74,7 +83,8 @@ while True:
     # assistant_answer = response.choices[0].message.content
 
     print("Processing ...\n")
-    response, total_tokens, prompt_tokens, completion_tokens = ollama_generate_response("llama3:8b", 500, messages)
+    # The backend and model come from LLM_BACKEND and LLM_MODEL (ollama's llama3:8b by default).
+    response, total_tokens, prompt_tokens, completion_tokens = get_backend().generate(messages, 500)
     assistant_answer = response
 
     print(f"Assistant: {assistant_answer}\n")